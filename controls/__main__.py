@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 
 import copy
+from pathlib import Path
 import click
+from datetime import datetime, timedelta
 from setup import make_config, setup_logger
-from parse import main_parse
+from parse import main_parse, main_plan
 from report import main_report
-from tools.db_functions import create_control_types
+from watch import main_watch
+from cluster import main_cluster_run, main_cluster_merge
+from jobs import enqueue_jobs, enqueue_new_samples, main_worker, get_queue_status, retry_failed_jobs
+from compact import main_compact
+from archive import main_archive
+from tools.db_functions import create_control_types, rebuild_control_summaries
+from tools.subprocesses import pull_from_irida
+from tools.codec_functions import codecs
+from tools.excel_functions import tabular_formats
+from tools.anomaly_functions import get_anomaly_alerts, rebuild_control_statistics
+from tools.profile_functions import find_similar_controls, rebuild_profile_store, get_profile_store_stale
+from tools.mash_functions import get_sample_distances, use_sketch_store
 from pyfiglet import Figlet
 
 logger = setup_logger()
@@ -39,7 +52,9 @@ def cli(ctx, verbose, config):
 @click.option("-s", "--storage", type=click.Path(exists=True), help="Folder for storage of fastq files. Overwrites config.yml path.")
 # TODO: Possibly load in modes from config.yml 
 @click.option('--mode', type=click.Choice(modes_all), default="all", help="Refseq_masher mode to be run. Defaults to 'both'.")
-def parse(ctx, storage, mode):
+@click.option("--plan", is_flag=True, help="List pending samples with predicted run times, longest first, without pulling or running anything.")
+@click.option("--plan-workers", type=click.IntRange(min=1), default=1, help="Number of parallel workers the plan's makespan is estimated for. Defaults to 1.")
+def parse(ctx, storage, mode, plan, plan_workers):
     """Pulls fastq files from Irida, runs refseq_masher/kraken2 and stores results."""
     if storage != None:
         ctx.obj['settings']['irida']['storage'] = storage
@@ -48,23 +63,306 @@ def parse(ctx, storage, mode):
     else:
         ctx.obj['settings']['mode'] = [mode]
     # click.echo(ctx.obj['settings'])
+    if plan:
+        found = main_plan(ctx.obj['settings'], workers=plan_workers)
+        click.echo("Sample\tMode\tInput MB\tPredicted s")
+        for item in found['plan']:
+            predicted = f"{item['predicted']:.0f}" if item['predicted'] != None else "-"
+            click.echo(f"{item['sample']}\t{item['mode']}\t{item['input_bytes']/1e6:.1f}\t{predicted}")
+        click.echo(f"{len(found['plan'])} pending. Predicted makespan on {plan_workers} worker(s): {found['makespan']:.0f}s.")
+        if found['unpredicted'] > 0:
+            click.echo(f"{found['unpredicted']} have no run history for their mode and aren't included in the makespan.")
+        return
     main_parse(ctx.obj['settings'])
     click.echo("The parse run has finished.")
     
 
+@cli.command("watch")
+@click.pass_context
+@click.option("-s", "--storage", type=click.Path(exists=True), help="Folder for storage of fastq files. Overwrites config.yml path.")
+@click.option('--mode', type=click.Choice(modes_all), default="all", help="Mode(s) to run on new samples. Defaults to 'all'.")
+@click.option("--settle", type=click.FloatRange(min=0), default=60, help="Seconds a sample's fastq files must go unchanged before it is parsed. Defaults to 60.")
+@click.option("--interval", type=click.FloatRange(min=1), default=30, help="Seconds between rescans when polling. Defaults to 30.")
+@click.option("--poll", "force_polling", is_flag=True, help="Poll with scandir even where inotify is available.")
+def watch(ctx, storage, mode, settle, interval, force_polling):
+    """Parses new samples as they land in the irida storage, until stopped."""
+    if storage != None:
+        ctx.obj['settings']['irida']['storage'] = storage
+    if mode == "all":
+        ctx.obj['settings']['mode'] = modes
+    else:
+        ctx.obj['settings']['mode'] = [mode]
+    main_watch(ctx.obj['settings'], settle=settle, interval=interval, force_polling=force_polling)
+    click.echo("The watch has stopped.")
+
+
+@cli.command("enqueue")
+@click.pass_context
+@click.argument("folders", nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option("-s", "--storage", type=click.Path(exists=True), help="Folder for storage of fastq files. Overwrites config.yml path.")
+@click.option('--mode', type=click.Choice(modes_all), default="all", help="Mode(s) to queue. Defaults to 'all'.")
+@click.option("-p", "--priority", type=int, default=0, help="Higher priorities are run first. Defaults to 0.")
+@click.option("--pull", is_flag=True, help="Pull from irida first.")
+def enqueue(ctx, folders, storage, mode, priority, pull):
+    """Queues sample folders for the worker command. Without FOLDERS, queues every sample not yet in the database."""
+    if storage != None:
+        ctx.obj['settings']['irida']['storage'] = storage
+    queue_modes = modes if mode == "all" else [mode]
+    if pull:
+        pull_from_irida(ctx.obj['settings']['irida'])
+    if folders:
+        count = enqueue_jobs(ctx.obj['settings'], folders=list(folders), modes=queue_modes, priority=priority)
+    else:
+        count = enqueue_new_samples(ctx.obj['settings'], modes=queue_modes, priority=priority)
+    click.echo(f"Queued {count} jobs.")
+
+
+@cli.command("worker")
+@click.pass_context
+@click.option("-n", "--concurrency", type=click.IntRange(min=1), default=1, help="Number of worker processes. Defaults to 1.")
+@click.option("--exit-when-empty", is_flag=True, help="Stop once no jobs are queued or running.")
+@click.option("--poll-interval", type=click.FloatRange(min=0.1), default=5, help="Seconds a worker waits when no job is available. Defaults to 5.")
+def worker(ctx, concurrency, exit_when_empty, poll_interval):
+    """Runs queued jobs until stopped."""
+    ctx.obj['settings']['mode'] = modes
+    main_worker(ctx.obj['settings'], concurrency=concurrency, exit_when_empty=exit_when_empty, poll_interval=poll_interval)
+    click.echo("The workers have stopped.")
+
+
+@cli.group("queue")
+def queue():
+    """Inspects and manages the job queue."""
+    pass
+
+
+@queue.command("status")
+@click.pass_context
+def queue_status(ctx):
+    """Shows queue depth, running jobs and throughput over the last hour."""
+    status = get_queue_status(ctx.obj['settings'])
+    click.echo("State\tJobs")
+    for state in ["queued", "running", "done", "failed"]:
+        click.echo(f"{state}\t{status['states'].get(state, 0)}")
+    if status['oldest_queued'] != None:
+        click.echo(f"Oldest queued job was queued at {status['oldest_queued']:%Y-%m-%d %H:%M:%S}.")
+    for job in status['running']:
+        elapsed = f"{job['elapsed']:.0f}s" if job['elapsed'] != None else "-"
+        click.echo(f"Running: {job['sample']} {job['mode']} on {job['worker']} for {elapsed} (attempt {job['attempts']})")
+    click.echo(f"Done in the last hour: {status['done_last_hour']}")
+    for mode, seconds in status['mean_seconds'].items():
+        click.echo(f"Mean run time for {mode}: {seconds:.1f}s")
+
+
+@queue.command("retry")
+@click.pass_context
+def queue_retry(ctx):
+    """Queues failed jobs again."""
+    count = retry_failed_jobs(ctx.obj['settings'])
+    click.echo(f"Queued {count} failed jobs again.")
+
+
+@cli.group("cluster")
+def cluster():
+    """Parses samples on several nodes sharing the irida storage."""
+    pass
+
+
+@cluster.command("run")
+@click.pass_context
+@click.option("-s", "--storage", type=click.Path(exists=True), help="Folder for storage of fastq files. Overwrites config.yml path.")
+@click.option('--mode', type=click.Choice(modes_all), default="all", help="Mode(s) to run. Defaults to 'all'.")
+@click.option("--node", help="Name of this node, which names its staging database. Defaults to host-pid.")
+@click.option("--poll-interval", type=click.FloatRange(min=0.1), default=30, help="Seconds to wait when every outstanding sample is leased by other nodes. Defaults to 30.")
+@click.option("--keep-running", is_flag=True, help="Keep looking for new samples instead of stopping once nothing is outstanding.")
+def cluster_run(ctx, storage, mode, node, poll_interval, keep_running):
+    """Claims and parses outstanding samples into this node's staging database."""
+    if storage != None:
+        ctx.obj['settings']['irida']['storage'] = storage
+    if mode == "all":
+        ctx.obj['settings']['mode'] = modes
+    else:
+        ctx.obj['settings']['mode'] = [mode]
+    count = main_cluster_run(ctx.obj['settings'], node=node, poll_interval=poll_interval, exit_when_done=not keep_running)
+    click.echo(f"Parsed {count} samples on this node. Run 'controls cluster merge' to add them to the database.")
+
+
+@cluster.command("merge")
+@click.pass_context
+def cluster_merge(ctx):
+    """Moves the staged controls of every node into the database."""
+    count = main_cluster_merge(ctx.obj['settings'])
+    click.echo(f"Merged {count} controls.")
+
+
 @cli.command("report")
 @click.pass_context
 @click.option("-o", "--output-dir", type=click.Path(exists=True), help="Folder for storage of reports. Overwrites config.yml path.")
 @click.option("-t", "--text-only", is_flag=True, help="Export full results to json and excel files only.")
-def report(ctx, output_dir, text_only):
+@click.option("-f", "--force", is_flag=True, help="Rebuild reports for every control type, even if unchanged since the last run.")
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=1, help="Number of processes building control types in parallel.")
+@click.option("--format", "formats", type=click.Choice(tabular_formats), multiple=True, default=["xlsx"], help="Tabular format(s) to write each control type in. Repeatable. Defaults to xlsx.")
+@click.option("--gzip", "use_gzip", is_flag=True, help="Gzip the streamed full output (__fulloutput.ndjson.gz).")
+@click.option("--legacy-json", is_flag=True, help="Write the full output as the old nested __fulloutput.json instead of newline delimited JSON.")
+@click.option("--html-mode", type=click.Choice(["cdn", "local"]), help="Load plotly.js from its CDN or from one local copy in the output folder. Overwrites config.yml html plotlyjs.")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), help="Only report controls submitted on or after this date.")
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), help="Only report controls submitted on or before this date.")
+@click.option("--last-n-days", type=click.IntRange(min=1), help="Only report controls submitted in the last N days. Can't be used with --since.")
+@click.option("--type", "ct_types", multiple=True, help="Only report this control type. Repeatable.")
+@click.option("--dashboard", is_flag=True, help="Write a single page dashboard with per year data files instead of one html file per control type.")
+def report(ctx, output_dir, text_only, force, workers, formats, use_gzip, legacy_json, html_mode, since, until, last_n_days, ct_types, dashboard):
     """Generates html and xlsx reports."""
+    if last_n_days != None:
+        if since != None:
+            raise click.BadParameter("Use either --since or --last-n-days, not both.", param_hint="--last-n-days")
+        since = datetime.now() - timedelta(days=last_n_days)
     if output_dir != None:
         ctx.obj['settings']['folder']['output'] = output_dir
     ctx.obj['settings']['text_only'] = text_only
+    ctx.obj['settings']['force'] = force
+    ctx.obj['settings']['workers'] = workers
+    ctx.obj['settings']['formats'] = list(formats)
+    ctx.obj['settings']['gzip'] = use_gzip
+    ctx.obj['settings']['legacy_json'] = legacy_json
+    ctx.obj['settings']['since'] = since.date() if since != None else None
+    ctx.obj['settings']['until'] = until.date() if until != None else None
+    ctx.obj['settings']['report_types'] = list(ct_types)
+    ctx.obj['settings']['dashboard'] = dashboard
+    if html_mode != None:
+        if not 'html' in ctx.obj['settings'] or ctx.obj['settings']['html'] == None:
+            ctx.obj['settings']['html'] = {}
+        ctx.obj['settings']['html']['plotlyjs'] = html_mode
     main_report(ctx.obj['settings'])
     click.echo("The reports run has finished.")
 
 
+@cli.command("compact")
+@click.pass_context
+@click.option("--codec", type=click.Choice(codecs), default="msgpack+zstd", help="Codec to rewrite stored results with. Defaults to 'msgpack+zstd'.")
+@click.option("-b", "--batch-size", type=int, default=500, help="Number of controls rewritten per commit.")
+@click.option("--vacuum", is_flag=True, help="Run VACUUM afterwards to shrink the database file.")
+def compact(ctx, codec, batch_size, vacuum):
+    """Rewrites stored results with a compact codec."""
+    stats = main_compact(ctx.obj['settings'], codec=codec, batch_size=batch_size, vacuum=vacuum)
+    if not stats:
+        click.echo("The compact run failed, see log for details.")
+        return
+    saved = stats['bytes_before'] - stats['bytes_after']
+    click.echo(f"Rewrote {stats['rows']} controls: {stats['bytes_before']/1e6:.2f} MB -> {stats['bytes_after']/1e6:.2f} MB ({saved/1e6:.2f} MB saved).")
+    if stats['decode_after'] > 0:
+        click.echo(f"Decode time {stats['decode_before']:.3f}s -> {stats['decode_after']:.3f}s ({stats['decode_before']/stats['decode_after']:.1f}x).")
+    if 'codec' not in ctx.obj['settings'] or ctx.obj['settings']['codec'] != codec:
+        click.echo(f"Set 'codec: {codec}' in config.yml so new results are stored the same way.")
+
+
+@cli.command("archive")
+@click.pass_context
+@click.option("-b", "--before", type=click.DateTime(formats=["%Y-%m-%d"]), help="Archive controls submitted before this date. Defaults to archive cutoff_days in config.yml.")
+@click.option("--vacuum", is_flag=True, help="Run VACUUM afterwards to shrink the live database file.")
+def archive(ctx, before, vacuum):
+    """Moves old controls into the archive database."""
+    if before != None:
+        before = before.date()
+    moved = main_archive(ctx.obj['settings'], before=before, vacuum=vacuum)
+    click.echo(f"Archived {moved} controls.")
+
+
+@cli.command("rebuild-summaries")
+@click.pass_context
+def rebuild_summaries(ctx):
+    """Rebuilds the per-date summary table from all controls."""
+    rows = rebuild_control_summaries(settings=ctx.obj['settings'])
+    click.echo(f"Wrote {rows} summary rows.")
+
+
+@cli.command("alerts")
+@click.pass_context
+@click.option("-z", "--z-threshold", type=float, help="Absolute z-score to alert on. Overwrites config.yml anomalies z_threshold (default 3).")
+@click.option("-e", "--ewma-threshold", type=float, help="Absolute EWMA score to alert on. Overwrites config.yml anomalies ewma_threshold (default 3).")
+@click.option("-m", "--min-samples", type=click.IntRange(min=2), help="Earlier controls needed before a control can alert. Overwrites config.yml anomalies min_samples (default 10).")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), help="Only list controls submitted on or after this date.")
+@click.option("--last-n-days", type=click.IntRange(min=1), help="Only list controls submitted in the last N days. Can't be used with --since.")
+@click.option("--type", "ct_types", multiple=True, help="Only list this control type. Repeatable.")
+def alerts(ctx, z_threshold, ewma_threshold, min_samples, since, last_n_days, ct_types):
+    """Lists controls whose contamination metrics drifted from their control type's history."""
+    if last_n_days != None:
+        if since != None:
+            raise click.BadParameter("Use either --since or --last-n-days, not both.", param_hint="--last-n-days")
+        since = datetime.now() - timedelta(days=last_n_days)
+    found = get_anomaly_alerts(settings=ctx.obj['settings'], z_threshold=z_threshold, ewma_threshold=ewma_threshold,
+        min_samples=min_samples, since=since.date() if since != None else None, ct_types=list(ct_types))
+    for alert in found:
+        zscore = f"{alert['zscore']:.2f}" if alert['zscore'] != None else "-"
+        ewma_score = f"{alert['ewma_score']:.2f}" if alert['ewma_score'] != None else "-"
+        click.echo(f"{alert['submitted_date']}\t{alert['controltype']}\t{alert['name']}\t{alert['mode']}\t{alert['metric']}\t"
+            f"{alert['genus']}\t{alert['value']:.4g}\tz={zscore}\tewma={ewma_score}")
+    click.echo(f"{len(found)} alerts.")
+
+
+@cli.command("rebuild-anomalies")
+@click.pass_context
+def rebuild_anomalies(ctx):
+    """Rebuilds the anomaly statistics and scores from all controls."""
+    scored = rebuild_control_statistics(settings=ctx.obj['settings'])
+    click.echo(f"Scored {scored} controls.")
+
+
+@cli.command("similar")
+@click.pass_context
+@click.argument("names", nargs=-1, required=True)
+@click.option("-k", "--top-k", type=click.IntRange(min=1), help="Number of similar controls to list. Overwrites config.yml similarity top_k (default 10).")
+@click.option("--include-later", is_flag=True, help="Also list controls submitted after the queried control.")
+@click.option("--type", "ct_types", multiple=True, help="Only list controls of this control type. Repeatable.")
+def similar(ctx, names, top_k, include_later, ct_types):
+    """Lists the past controls whose genus profiles are most similar to the named control(s)."""
+    if top_k == None:
+        try:
+            top_k = int(ctx.obj['settings']['similarity']['top_k'])
+        except (KeyError, TypeError):
+            top_k = 10
+    found = find_similar_controls(settings=ctx.obj['settings'], names=list(names), top_k=top_k, include_later=include_later, ct_types=list(ct_types))
+    for name, matches in found.items():
+        click.echo(f"{name}:")
+        for rank, match in enumerate(matches, start=1):
+            click.echo(f"{rank}\t{match['similarity']:.4f}\t{match['submitted_date']}\t{match['controltype']}\t{match['name']}")
+
+
+@cli.command("distances")
+@click.pass_context
+@click.argument("names", nargs=-1, required=True)
+@click.option("-s", "--storage", type=click.Path(exists=True), help="Folder for storage of fastq files. Overwrites config.yml path.")
+def distances(ctx, names, storage):
+    """Lists mash distances between the named samples, closest first, from the sketch store."""
+    if storage != None:
+        ctx.obj['settings']['irida']['storage'] = storage
+    if not use_sketch_store(ctx.obj['settings']):
+        click.echo("Set mash sketch_store in config.yml and put mash on the PATH to compare samples.")
+        return
+    project_dir = Path(ctx.obj['settings']['irida']['storage']).joinpath(ctx.obj['settings']['irida']['project_name'])
+    folders = []
+    for name in names:
+        if not project_dir.joinpath(name).is_dir():
+            click.echo(f"No sample folder for {name} in {project_dir}, leaving it out.")
+            continue
+        folders.append(project_dir.joinpath(name).__str__())
+    for item in get_sample_distances(ctx.obj['settings'], folders=folders):
+        click.echo(f"{item['sample']}\t{item['other']}\t{item['distance']:.5f}\t{item['shared']}")
+
+
+@cli.command("rebuild-profiles")
+@click.pass_context
+@click.option("--stale-only", is_flag=True, help="Only rebuild if the profile store was marked stale.")
+def rebuild_profiles(ctx, stale_only):
+    """Rebuilds the similar profile store from all controls."""
+    stale = get_profile_store_stale(settings=ctx.obj['settings'])
+    for reason in stale:
+        click.echo(f"Marked stale: {reason}")
+    if stale_only and not stale:
+        click.echo("The profile store is up to date.")
+        return
+    count = rebuild_profile_store(settings=ctx.obj['settings'])
+    click.echo(f"Stored profiles of {count} controls.")
+
+
 @cli.command("DBinit")
 @click.pass_context
 def DBinit(ctx):
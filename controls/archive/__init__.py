@@ -0,0 +1,44 @@
+from tools.db_functions import make_engine, archive_controls
+from tools.profile_functions import mark_profile_store_stale
+from sqlalchemy import text
+import logging
+from datetime import datetime, date, timedelta
+
+logger = logging.getLogger("controls.archive")
+
+
+def main_archive(settings:dict, before:date=None, vacuum:bool=False) -> int:
+    """
+    Moves old controls out of the live database into the archive database, marking the profile store stale.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        before (date, optional): archive controls submitted before this date. Defaults to the configured cutoff_days.
+        vacuum (bool, optional): run VACUUM on the live database afterwards. Defaults to False.
+
+    Returns:
+        int: number of controls archived.
+    """
+    if not 'archive' in settings or settings['archive'] == None or settings['archive']['db_path'] == None:
+        logger.error("No archive db_path set in config.yml, exiting.")
+        return 0
+    if before == None:
+        try:
+            before = date.today() - timedelta(days=int(settings['archive']['cutoff_days']))
+        except (KeyError, TypeError):
+            logger.error("No archive cutoff_days set in config.yml and no date given, exiting.")
+            return 0
+    logger.debug(f"Archiving controls submitted before {before}")
+    engine = make_engine(settings=settings)
+    with engine.connect() as connection:
+        due = connection.execute(text('SELECT COUNT(*) FROM "_control_samples" WHERE submitted_date < :cutoff'), {"cutoff": before.isoformat()}).scalar()
+    # The profile store only holds live controls. Marked before the move, so it can't be missed if the run dies.
+    if due > 0:
+        mark_profile_store_stale(settings=settings, reason=f"controls submitted before {before} archived")
+    moved = archive_controls(settings=settings, cutoff=before, engine=engine)
+    if vacuum and moved > 0:
+        logger.info("Running VACUUM on the live database.")
+        with engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+    logger.info(f"The ARCHIVE run has ended at {datetime.now()}.")
+    return moved
@@ -0,0 +1,460 @@
+from tools.db_functions import make_engine, check_samples_against_database, get_control_type_by_name, add_control_to_db, link_control_to_submission
+from tools.lease_functions import acquire_lease, LeaseKeeper
+from tools.hook_functions import run_post_write_hooks
+from parse import parse_folder
+from tools.schedule_functions import plan_longest_first
+from tools.mash_functions import get_sketch_dir
+from models import Control, AnalysisRun
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+import os
+import re
+import json
+import time
+import signal
+import socket
+import logging
+from pathlib import Path
+from datetime import datetime
+
+logger = logging.getLogger("controls.cluster")
+
+
+def get_cluster_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the cluster section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['cluster'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def get_cluster_dirs(settings:dict) -> tuple:
+    """
+    Lease and staging folders shared by every node, by default under the irida storage.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        tuple: lease folder and staging folder, both created if missing.
+    """
+    default = Path(settings['irida']['storage']).joinpath(".controls_cluster")
+    lease_dir = Path(get_cluster_setting(settings, "lease_dir", default=default.joinpath("leases")))
+    staging_dir = Path(get_cluster_setting(settings, "staging_dir", default=default.joinpath("staging")))
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    return lease_dir, staging_dir
+
+
+def get_main_db_path(settings:dict) -> str:
+    """
+    Absolute path of the main database.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        str: database path.
+    """
+    return Path(make_engine(settings=settings).url.database).absolute().__str__()
+
+
+def make_staging_settings(settings:dict, staging_dir:Path, node:str) -> dict:
+    """
+    Settings for a node's staging database, with its own profile store so the shared one is only written by merge,
+    and the main sketch store.
+
+    Args:
+        settings (dict): settings passed down from click
+        staging_dir (Path): shared staging folder
+        node (str): name of the node
+
+    Returns:
+        dict: copy of the settings pointed at the staging database.
+    """
+    staging_settings = dict(settings)
+    staging_settings['db_path'] = staging_dir.joinpath(f"{node}.db").absolute().__str__()
+    staging_settings['similarity'] = dict(settings['similarity'] if 'similarity' in settings and settings['similarity'] else {})
+    staging_settings['similarity']['store_path'] = staging_dir.joinpath(f"{node}_profiles").__str__()
+    # Sketches are shared, so every node reuses the ones already made.
+    staging_settings['mash'] = dict(settings['mash'] if 'mash' in settings and settings['mash'] else {})
+    staging_settings['mash']['sketch_dir'] = get_sketch_dir(settings).absolute().__str__()
+    return staging_settings
+
+
+def create_staging_db(settings:dict, staging_settings:dict):
+    """
+    Gives a staging database the main database's schema and control types.
+    The main database is attached and its schema copied verbatim.
+
+    Args:
+        settings (dict): settings passed down from click
+        staging_settings (dict): settings of the staging database
+    """
+    engine = make_engine(settings=staging_settings)
+    with engine.connect() as connection:
+        connection.execute(text("ATTACH DATABASE :path AS source"), {"path": get_main_db_path(settings)})
+        try:
+            existing = [row[0] for row in connection.execute(text("SELECT name FROM main.sqlite_master"))]
+            statements = connection.execute(text("SELECT name, type, sql FROM source.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type != 'table'")).fetchall()
+            with connection.begin():
+                for (name, kind, sql) in statements:
+                    if name not in existing:
+                        connection.execute(text(sql))
+                columns = ", ".join([f'"{row[1]}"' for row in connection.execute(text('PRAGMA main.table_info("_control_types")'))])
+                connection.execute(text(f'INSERT OR REPLACE INTO main."_control_types" ({columns}) SELECT {columns} FROM source."_control_types"'))
+        finally:
+            connection.execute(text("DETACH DATABASE source"))
+
+
+def get_done_path(lease_dir:Path, key:str) -> Path:
+    """
+    Marker left once a sample and mode is in a staging database.
+
+    Args:
+        lease_dir (Path): shared lease folder
+        key (str): lease key of the sample and mode
+
+    Returns:
+        Path: marker file
+    """
+    return lease_dir.joinpath(f"{key}.done")
+
+
+def get_failed_path(lease_dir:Path, key:str) -> Path:
+    """
+    Marker recording the failed attempts at a sample and mode.
+
+    Args:
+        lease_dir (Path): shared lease folder
+        key (str): lease key of the sample and mode
+
+    Returns:
+        Path: marker file
+    """
+    return lease_dir.joinpath(f"{key}.failed")
+
+
+def read_failures(lease_dir:Path, key:str) -> dict:
+    """
+    Reads the failed attempts at a sample and mode.
+
+    Args:
+        lease_dir (Path): shared lease folder
+        key (str): lease key of the sample and mode
+
+    Returns:
+        dict: attempts, last (epoch seconds), node and error, None if no attempt failed.
+    """
+    try:
+        with open(get_failed_path(lease_dir, key).__str__(), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def record_failure(lease_dir:Path, key:str, node:str, error:str) -> dict:
+    """
+    Counts a failed attempt at a sample and mode. Only the lease holder writes the marker.
+
+    Args:
+        lease_dir (Path): shared lease folder
+        key (str): lease key of the sample and mode
+        node (str): name of the node that failed
+        error (str): what went wrong
+
+    Returns:
+        dict: failures as now recorded.
+    """
+    failures = read_failures(lease_dir, key) or dict(attempts=0)
+    failures = dict(attempts=failures['attempts'] + 1, last=time.time(), node=node, error=error)
+    path = get_failed_path(lease_dir, key)
+    temp_path = path.with_name(f".{path.name}.{node}.tmp")
+    temp_path.write_text(json.dumps(failures))
+    os.replace(temp_path.__str__(), path.__str__())
+    return failures
+
+
+def get_retry_time(settings:dict, failures:dict) -> float:
+    """
+    When a failed sample and mode may be tried again, backing off exponentially.
+
+    Args:
+        settings (dict): settings passed down from click
+        failures (dict): as returned by read_failures
+
+    Returns:
+        float: epoch seconds, 0 if it never failed, None once it's out of attempts.
+    """
+    if failures == None:
+        return 0
+    if failures['attempts'] >= int(get_cluster_setting(settings, "max_attempts", default=3)):
+        return None
+    backoff = float(get_cluster_setting(settings, "backoff_seconds", default=60))
+    return failures['last'] + backoff * 2 ** (failures['attempts'] - 1)
+
+
+def get_lease_key(folder:str, mode:str) -> str:
+    """
+    File name safe key of a sample and mode.
+
+    Args:
+        folder (str): sample folder
+        mode (str): mode being parsed
+
+    Returns:
+        str: lease key
+    """
+    return re.sub(r"[^\w.-]", "_", f"{Path(folder).name}__{mode}")
+
+
+def is_parsed(name:str, mode:str, engine) -> bool:
+    """
+    Checks if the main database already holds results for a sample and mode.
+
+    Args:
+        name (str): sample name
+        mode (str): mode being parsed
+        engine (engine): engine of the main database.
+
+    Returns:
+        bool: True if the mode isn't empty.
+    """
+    session = Session(engine)
+    value = session.query(getattr(Control, mode)).filter(Control.name == name).scalar()
+    session.close()
+    return value != None
+
+
+def discard_staged_result(settings:dict, staging_engine, name:str, mode:str):
+    """
+    Removes a sample's results for a mode from a staging database, and the control if no other mode is left.
+
+    Args:
+        settings (dict): settings passed down from click
+        staging_engine (engine): engine of the staging database.
+        name (str): sample name
+        mode (str): mode to remove
+    """
+    session = Session(staging_engine)
+    control = session.query(Control).filter(Control.name == name).first()
+    if control != None:
+        setattr(control, mode, None)
+        if all(getattr(control, item) == None for item in settings['modes']):
+            session.delete(control)
+        session.commit()
+    session.close()
+
+
+def list_cluster_work(settings:dict, lease_dir:Path, engine=None) -> list:
+    """
+    Samples and modes not yet in the main database nor finished in a staging database.
+    Those that failed as many times as cluster max_attempts are left out.
+
+    Args:
+        settings (dict): settings passed down from click
+        lease_dir (Path): shared lease folder
+        engine (engine, optional): engine of the main database. Defaults to None.
+
+    Returns:
+        list: (folder, mode, key, retry time) of the outstanding work, the retry time in epoch seconds (0 if it never failed).
+    """
+    work = []
+    for mode in settings['mode']:
+        for folder in check_samples_against_database(settings=settings, mode=mode, engine=engine):
+            key = get_lease_key(folder, mode)
+            if get_done_path(lease_dir, key).exists():
+                continue
+            retry_time = get_retry_time(settings, read_failures(lease_dir, key))
+            if retry_time == None:
+                logger.debug(f"{Path(folder).name} failed {mode} too many times, skipping.")
+                continue
+            work.append((folder, mode, key, retry_time))
+    return work
+
+
+def main_cluster_run(settings:dict, node:str=None, poll_interval:float=30, exit_when_done:bool=True) -> int:
+    """
+    Parses outstanding samples on this node, claiming each through a lease file on the shared storage
+    so no two nodes run the same sample. Leases are kept alive by a heartbeat thread; leases of crashed
+    nodes expire and are reclaimed. Results go to this node's staging database, combined by cluster merge.
+    Failed samples are retried after a backoff until they run out of attempts.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        node (str, optional): name of this node, which names its staging database. Defaults to host-pid.
+        poll_interval (float, optional): seconds to wait when everything left is leased by other nodes or backing off. Defaults to 30.
+        exit_when_done (bool, optional): stop once nothing is outstanding, otherwise keep looking. Defaults to True.
+
+    Returns:
+        int: number of samples and modes parsed on this node.
+    """
+    if node == None:
+        node = f"{socket.gethostname()}-{os.getpid()}"
+    ttl = float(get_cluster_setting(settings, "lease_seconds", default=600))
+    heartbeat = float(get_cluster_setting(settings, "heartbeat_seconds", default=ttl / 5))
+    lease_dir, staging_dir = get_cluster_dirs(settings)
+    engine = make_engine(settings=settings)
+    staging_settings = make_staging_settings(settings, staging_dir=staging_dir, node=node)
+    create_staging_db(settings, staging_settings)
+    staging_engine = make_engine(settings=staging_settings)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    logger.info(f"Node {node} started, staging to {staging_settings['db_path']}.")
+    count = 0
+    with LeaseKeeper(ttl=ttl, heartbeat=heartbeat) as keeper:
+        while not stopping:
+            work = list_cluster_work(settings, lease_dir=lease_dir, engine=engine)
+            if not work and exit_when_done:
+                break
+            now = time.time()
+            waiting = [retry_time for folder, mode, key, retry_time in work if retry_time > now]
+            # Longest predicted first on every node, a taken lease just moves a node on to the next one.
+            keys = {(folder, mode): key for folder, mode, key, retry_time in work if retry_time <= now}
+            work = [(item['folder'], item['mode'], keys[(item['folder'], item['mode'])])
+                for item in plan_longest_first(settings=settings, pending=list(keys), engine=engine)]
+            claimed = 0
+            for folder, mode, key in work:
+                if stopping:
+                    break
+                # Finished by another node since the list was made.
+                if get_done_path(lease_dir, key).exists():
+                    continue
+                lease = acquire_lease(lease_dir, key=key, node=node, ttl=ttl)
+                if lease == None:
+                    continue
+                claimed += 1
+                keeper.add(lease)
+                try:
+                    # Done and merged while this node was busy, or failed again on another node.
+                    if get_done_path(lease_dir, key).exists() or is_parsed(Path(folder).name, mode, engine):
+                        continue
+                    retry_time = get_retry_time(settings, read_failures(lease_dir, key))
+                    if retry_time == None or retry_time > time.time():
+                        continue
+                    logger.info(f"Node {node} parsing {Path(folder).name} for {mode}.")
+                    if not parse_folder(settings=staging_settings, folder=folder, mode=mode, engine=staging_engine):
+                        raise ValueError("no control was written.")
+                    if not keeper.holds(lease):
+                        # Another node reclaimed it and is parsing it too, leave the sample to that node.
+                        logger.error(f"Node {node} lost the lease on {Path(folder).name} for {mode}, discarding its result.")
+                        discard_staged_result(settings, staging_engine, name=Path(folder).name, mode=mode)
+                        continue
+                    # Marked done before the lease goes, so no other node picks it up in between.
+                    get_done_path(lease_dir, key).write_text(f"{node}\n")
+                    if get_failed_path(lease_dir, key).exists():
+                        get_failed_path(lease_dir, key).unlink()
+                    count += 1
+                except Exception as e:
+                    # Counted so a sample that always fails is backed off and eventually left, not retried at once forever.
+                    if keeper.holds(lease):
+                        failures = record_failure(lease_dir, key, node=node, error=f"{type(e).__name__}: {e}")
+                        logger.error(f"Node {node} failed parsing {Path(folder).name} for {mode} (attempt {failures['attempts']}): {e}")
+                    else:
+                        logger.error(f"Node {node} failed parsing {Path(folder).name} for {mode} after losing its lease: {e}")
+                finally:
+                    keeper.remove(lease)
+            if claimed == 0:
+                # Everything left is held by other nodes or backing off, wait in case one of them dies or until a retry is due.
+                time.sleep(max(0.0, min([poll_interval] + [retry_time - time.time() for retry_time in waiting])))
+    logger.info(f"Node {node} parsed {count} samples. The CLUSTER run has ended at {datetime.now()}.")
+    return count
+
+
+def merge_staged_control(settings:dict, control:Control, engine=None):
+    """
+    Writes one staged control into the main database, one mode at a time, so its summaries, anomaly scores
+    and profiles are updated just as if it had been parsed there.
+
+    Args:
+        settings (dict): settings passed down from click.
+        control (Control): control read from a staging database.
+        engine (engine, optional): engine of the main database. Defaults to None.
+    """
+    ct_type = get_control_type_by_name(control.controltype.name, settings=settings, engine=engine)
+    for mode in settings['modes']:
+        value = getattr(control, mode)
+        if value == None:
+            continue
+        merged = Control(name=control.name, submitted_date=control.submitted_date)
+        merged.controltype = ct_type
+        setattr(merged, mode, value)
+        merged = link_control_to_submission(settings=settings, control=merged, engine=engine)
+        control_id, old_value = add_control_to_db(merged, mode=mode, settings=settings, engine=engine)
+        run_post_write_hooks(settings=settings, control_id=control_id, mode=mode, old_value=old_value, engine=engine)
+
+
+def main_cluster_merge(settings:dict) -> int:
+    """
+    Moves every control in the staging databases into the main database. Only one merge runs at a time.
+    Each control is removed from its staging database once merged, so an interrupted merge can just be run again.
+
+    Args:
+        settings (dict): Settings passed down from click.
+
+    Returns:
+        int: number of controls merged.
+    """
+    lease_dir, staging_dir = get_cluster_dirs(settings)
+    ttl = float(get_cluster_setting(settings, "lease_seconds", default=600))
+    heartbeat = float(get_cluster_setting(settings, "heartbeat_seconds", default=ttl / 5))
+    lease = acquire_lease(lease_dir, key="merge", node=f"{socket.gethostname()}-{os.getpid()}", ttl=ttl)
+    if lease == None:
+        logger.error("Another merge is running, exiting.")
+        return 0
+    engine = make_engine(settings=settings)
+    count = 0
+    with LeaseKeeper(ttl=ttl, heartbeat=heartbeat) as keeper:
+        keeper.add(lease)
+        for staging_path in sorted(staging_dir.glob("*.db")):
+            if not keeper.holds(lease):
+                logger.error("Lost the merge lease to another merge, stopping.")
+                break
+            staging_engine = make_engine(settings=dict(db_path=staging_path.absolute().__str__()))
+            session = Session(staging_engine)
+            merged = 0
+            for control in session.query(Control).order_by(Control.id).all():
+                if not keeper.holds(lease):
+                    break
+                if control.controltype == None:
+                    logger.error(f"Staged control {control.name} in {staging_path.name} has no control type, leaving it.")
+                    continue
+                merge_staged_control(settings, control=control, engine=engine)
+                name = control.name
+                session.delete(control)
+                session.commit()
+                for mode in settings['modes']:
+                    done_path = get_done_path(lease_dir, get_lease_key(name, mode))
+                    if done_path.exists():
+                        done_path.unlink()
+                merged += 1
+            # Run times go along too, so the cost model learns from every node.
+            runs = session.query(AnalysisRun).all()
+            if runs:
+                main_session = Session(engine)
+                main_session.add_all([AnalysisRun(sample=run.sample, mode=run.mode, input_bytes=run.input_bytes, seconds=run.seconds,
+                    node=run.node, finished=run.finished, subsampled=run.subsampled, subsample_method=run.subsample_method,
+                    subsample_seed=run.subsample_seed, reads_total=run.reads_total, reads_used=run.reads_used) for run in runs])
+                main_session.commit()
+                main_session.close()
+                for run in runs:
+                    session.delete(run)
+                session.commit()
+            session.close()
+            logger.info(f"Merged {merged} controls from {staging_path.name}.")
+            count += merged
+    logger.info(f"The CLUSTER merge has ended at {datetime.now()}.")
+    return count
@@ -0,0 +1,65 @@
+from tools.db_functions import make_engine
+from tools.codec_functions import encode_results, decode_results, check_codec_available
+from models import Control
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+import logging
+from datetime import datetime
+from time import perf_counter
+
+logger = logging.getLogger("controls.compact")
+
+
+def main_compact(settings:dict, codec:str, batch_size:int=500, vacuum:bool=False) -> dict:
+    """
+    Rewrites the stored results of every control with a new codec.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        codec (str): codec to rewrite the mode columns with.
+        batch_size (int, optional): controls rewritten per commit. Defaults to 500.
+        vacuum (bool, optional): run VACUUM afterwards to give the space back to the filesystem. Defaults to False.
+
+    Returns:
+        dict: rows rewritten, bytes before and after and decode times before and after.
+    """
+    if not check_codec_available(codec):
+        logger.error(f"Can't compact with {codec}, exiting.")
+        return {}
+    engine = make_engine(settings=settings)
+    session = Session(engine)
+    stats = dict(rows=0, bytes_before=0, bytes_after=0, decode_before=0.0, decode_after=0.0)
+    last_id = 0
+    while True:
+        batch = session.query(Control).filter(Control.id > last_id).order_by(Control.id).limit(batch_size).all()
+        if not batch:
+            break
+        for control in batch:
+            for mode in settings['modes']:
+                value = getattr(control, mode)
+                if value == None:
+                    continue
+                start = perf_counter()
+                data = decode_results(value)
+                stats['decode_before'] += perf_counter() - start
+                new_value = encode_results(data, codec=codec)
+                start = perf_counter()
+                decode_results(new_value)
+                stats['decode_after'] += perf_counter() - start
+                stats['bytes_before'] += len(str(value).encode("utf-8"))
+                stats['bytes_after'] += len(new_value.encode("utf-8"))
+                if new_value != value:
+                    setattr(control, mode, new_value)
+            stats['rows'] += 1
+        last_id = batch[-1].id
+        session.commit()
+        # Drop the rewritten objects so memory stays flat over the whole table.
+        session.expunge_all()
+        logger.debug(f"Compacted controls up to id {last_id}")
+    session.close()
+    if vacuum:
+        logger.info("Running VACUUM on the database.")
+        with engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+    logger.info(f"The COMPACT run has ended at {datetime.now()} with {stats}.")
+    return stats
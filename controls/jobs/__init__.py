@@ -0,0 +1,339 @@
+from tools.db_functions import make_engine, check_samples_against_database
+from models import Job
+from parse import parse_folder
+from tools.schedule_functions import fit_cost_model, get_input_bytes, predict_seconds
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func
+import os
+import time
+import uuid
+import socket
+import signal
+import logging
+import multiprocessing
+from pathlib import Path
+from datetime import datetime, timedelta
+from time import perf_counter
+
+logger = logging.getLogger("controls.jobs")
+
+
+def get_jobs_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the jobs section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['jobs'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def enqueue_jobs(settings:dict, folders:list, modes:list, priority:int=0, engine=None) -> int:
+    """
+    Queues sample folders for the given modes. Folders already queued or running for a mode are skipped.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        folders (list): sample folders to queue.
+        modes (list): modes to run on each folder.
+        priority (int, optional): higher priorities are claimed first. Defaults to 0.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of jobs queued.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    session = Session(engine)
+    max_attempts = int(get_jobs_setting(settings=settings, key="max_attempts", default=3))
+    active = set(session.query(Job.sample, Job.mode).filter(Job.state.in_(["queued", "running"])).all())
+    model = fit_cost_model(settings=settings, engine=engine)
+    now = datetime.now()
+    count = 0
+    for folder in folders:
+        for mode in modes:
+            sample = Path(folder).name
+            if (sample, mode) in active:
+                logger.debug(f"{sample} is already queued for {mode}.")
+                continue
+            predicted = predict_seconds(model, mode=mode, input_bytes=get_input_bytes(folder))
+            session.add(Job(sample=sample, folder=Path(folder).absolute().__str__(), mode=mode, state="queued", priority=priority,
+                predicted_seconds=predicted, attempts=0, max_attempts=max_attempts, enqueued=now, available_at=now))
+            active.add((sample, mode))
+            count += 1
+    session.commit()
+    session.close()
+    logger.info(f"Queued {count} jobs.")
+    return count
+
+
+def enqueue_new_samples(settings:dict, modes:list, priority:int=0, engine=None) -> int:
+    """
+    Queues every sample folder in irida storage that isn't in the database yet.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        modes (list): modes to queue.
+        priority (int, optional): higher priorities are claimed first. Defaults to 0.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of jobs queued.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    count = 0
+    for mode in modes:
+        folders = check_samples_against_database(settings=settings, mode=mode, engine=engine)
+        count += enqueue_jobs(settings=settings, folders=folders, modes=[mode], priority=priority, engine=engine)
+    return count
+
+
+def claim_job(engine, worker:str) -> dict:
+    """
+    Atomically claims the next available job, highest priority first, then longest predicted run time.
+    The claim is a single UPDATE, so two workers can never get the same job.
+
+    Args:
+        engine (engine): engine used.
+        worker (str): host:pid of the claiming worker.
+
+    Returns:
+        dict: id, sample, folder, mode, attempts and claim_token of the job, None if nothing is available.
+    """
+    session = Session(engine)
+    token = uuid.uuid4().hex
+    now = datetime.now()
+    # Aliased so the subquery isn't correlated with the table being updated.
+    queued = aliased(Job)
+    next_job = session.query(queued.id).filter(queued.state == "queued", queued.available_at <= now)\
+        .order_by(queued.priority.desc(), queued.predicted_seconds.desc(), queued.id).limit(1).scalar_subquery()
+    claimed = session.query(Job).filter(Job.id == next_job, Job.state == "queued")\
+        .update({Job.state: "running", Job.claim_token: token, Job.worker: worker, Job.started: now,
+            Job.attempts: Job.attempts + 1}, synchronize_session=False)
+    session.commit()
+    if claimed == 0:
+        session.close()
+        return None
+    job = session.query(Job).filter_by(claim_token=token).first()
+    claim = dict(id=job.id, sample=job.sample, folder=job.folder, mode=job.mode, attempts=job.attempts, claim_token=token)
+    session.close()
+    return claim
+
+
+def finish_job(engine, claim:dict, seconds:float, error:str=None, backoff:float=60):
+    """
+    Marks a claimed job done, or on error queues it again after an exponential backoff until it runs out of attempts.
+
+    Args:
+        engine (engine): engine used.
+        claim (dict): job as returned by claim_job.
+        seconds (float): run time of the attempt.
+        error (str, optional): error of a failed attempt. Defaults to None.
+        backoff (float, optional): seconds before the first retry, doubled each attempt. Defaults to 60.
+    """
+    session = Session(engine)
+    job = session.query(Job).filter_by(id=claim['id'], claim_token=claim['claim_token']).first()
+    if job == None:
+        logger.warning(f"Job {claim['id']} was reclaimed from this worker, not recording its result.")
+        session.close()
+        return
+    now = datetime.now()
+    job.finished = now
+    job.seconds = seconds
+    job.claim_token = None
+    if error == None:
+        job.state = "done"
+        job.error = None
+    elif job.attempts < job.max_attempts:
+        delay = backoff * 2 ** (job.attempts - 1)
+        logger.warning(f"Job {job.id} ({job.sample} {job.mode}) failed, retrying in {delay:.0f}s: {error}")
+        job.state = "queued"
+        job.available_at = now + timedelta(seconds=delay)
+        job.error = error
+    else:
+        logger.error(f"Job {job.id} ({job.sample} {job.mode}) failed after {job.attempts} attempts: {error}")
+        job.state = "failed"
+        job.error = error
+    session.commit()
+    session.close()
+
+
+def requeue_abandoned_jobs(engine) -> int:
+    """
+    Queues again the running jobs of workers on this host that no longer exist. A job whose worker died on its
+    last attempt is marked failed, so a job that kills its worker isn't run forever.
+
+    Args:
+        engine (engine): engine used.
+
+    Returns:
+        int: number of jobs queued again.
+    """
+    session = Session(engine)
+    host = socket.gethostname()
+    count = 0
+    for job in session.query(Job).filter(Job.state == "running", Job.worker.like(f"{host}:%")):
+        try:
+            os.kill(int(job.worker.rsplit(":", 1)[1]), 0)
+        except ProcessLookupError:
+            job.claim_token = None
+            job.error = f"Worker {job.worker} died."
+            if job.attempts >= job.max_attempts:
+                logger.error(f"Worker {job.worker} is gone, job {job.id} is out of attempts.")
+                job.state = "failed"
+                continue
+            logger.warning(f"Worker {job.worker} is gone, queueing job {job.id} again.")
+            job.state = "queued"
+            job.available_at = datetime.now()
+            count += 1
+        except (ValueError, PermissionError):
+            continue
+    session.commit()
+    session.close()
+    return count
+
+
+def worker_loop(settings:dict, exit_when_empty:bool=False, poll_interval:float=5):
+    """
+    Claims and runs jobs one at a time until stopped, or until the queue is empty if asked to.
+    Jobs of dead workers on this host are queued again before each claim, so they don't wait for a new worker.
+    An attempt fails if parse_folder raises or doesn't write a control from the sample's results.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        exit_when_empty (bool, optional): stop once nothing is queued or running. Defaults to False.
+        poll_interval (float, optional): seconds to wait when nothing is available. Defaults to 5.
+    """
+    engine = make_engine(settings=settings)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    backoff = float(get_jobs_setting(settings=settings, key="backoff_seconds", default=60))
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    logger.info(f"Worker {worker} started.")
+    while not stopping:
+        requeue_abandoned_jobs(engine)
+        claim = claim_job(engine, worker=worker)
+        if claim == None:
+            if exit_when_empty and count_active_jobs(engine) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        logger.info(f"Worker {worker} running job {claim['id']}: {claim['sample']} {claim['mode']} (attempt {claim['attempts']}).")
+        start = perf_counter()
+        error = None
+        try:
+            if not parse_folder(settings=settings, folder=claim['folder'], mode=claim['mode'], engine=engine):
+                error = "No control was written from the sample's results."
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finish_job(engine, claim=claim, seconds=perf_counter() - start, error=error, backoff=backoff)
+    logger.info(f"Worker {worker} stopped.")
+
+
+def count_active_jobs(engine) -> int:
+    """
+    Counts the queued and running jobs.
+
+    Args:
+        engine (engine): engine used.
+
+    Returns:
+        int: number of queued and running jobs.
+    """
+    session = Session(engine)
+    count = session.query(Job).filter(Job.state.in_(["queued", "running"])).count()
+    session.close()
+    return count
+
+
+def main_worker(settings:dict, concurrency:int=1, exit_when_empty:bool=False, poll_interval:float=5):
+    """
+    Runs worker processes on this node until interrupted.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        concurrency (int, optional): number of worker processes. Defaults to 1.
+        exit_when_empty (bool, optional): stop once nothing is queued or running. Defaults to False.
+        poll_interval (float, optional): seconds a worker waits when nothing is available. Defaults to 5.
+    """
+    engine = make_engine(settings=settings)
+    requeue_abandoned_jobs(engine)
+    if concurrency == 1:
+        worker_loop(settings, exit_when_empty=exit_when_empty, poll_interval=poll_interval)
+        return
+    # Don't hand pooled sqlite connections down to forked workers.
+    engine.dispose()
+    processes = [multiprocessing.Process(target=worker_loop, args=(settings, exit_when_empty, poll_interval)) for ii in range(concurrency)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("Stopping workers.")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    logger.info(f"The WORKER run has ended at {datetime.now()}.")
+
+
+def get_queue_status(settings:dict, engine=None) -> dict:
+    """
+    Summarizes the queue: depth by state, running jobs and recent throughput.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        dict: states (count by state), oldest_queued, running (list of dicts), done_last_hour and mean_seconds (by mode, last hour).
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    session = Session(engine)
+    now = datetime.now()
+    states = dict(session.query(Job.state, func.count(Job.id)).group_by(Job.state).all())
+    oldest = session.query(func.min(Job.enqueued)).filter(Job.state == "queued").scalar()
+    running = [dict(id=job.id, sample=job.sample, mode=job.mode, worker=job.worker, attempts=job.attempts,
+        elapsed=(now - job.started).total_seconds() if job.started != None else None)
+        for job in session.query(Job).filter(Job.state == "running").order_by(Job.started)]
+    hour_ago = now - timedelta(hours=1)
+    done_last_hour = session.query(Job).filter(Job.state == "done", Job.finished >= hour_ago).count()
+    mean_seconds = dict(session.query(Job.mode, func.avg(Job.seconds)).filter(Job.state == "done", Job.finished >= hour_ago)\
+        .group_by(Job.mode).all())
+    session.close()
+    return dict(states=states, oldest_queued=oldest, running=running, done_last_hour=done_last_hour, mean_seconds=mean_seconds)
+
+
+def retry_failed_jobs(settings:dict, engine=None) -> int:
+    """
+    Queues failed jobs again with fresh attempts.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of jobs queued again.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    session = Session(engine)
+    count = session.query(Job).filter(Job.state == "failed").update({Job.state: "queued", Job.attempts: 0,
+        Job.available_at: datetime.now()}, synchronize_session=False)
+    session.commit()
+    session.close()
+    return count
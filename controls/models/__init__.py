@@ -7,4 +7,8 @@ from .controls import Control, ControlType
 from .kits import KitType, ReagentType, Reagent
 from .submissions import BasicSubmission, BacterialCulture, Wastewater
 from .organizations import Organization, Contact
-from .samples import WWSample, BCSample
\ No newline at end of file
+from .samples import WWSample, BCSample
+from .summaries import ControlSummary, ControlTypeStamp
+from .anomalies import ControlStatistic, ControlScore
+from .jobs import Job
+from .runs import AnalysisRun
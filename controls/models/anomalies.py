@@ -0,0 +1,46 @@
+from . import Base
+from sqlalchemy import Column, String, DATE, FLOAT, INTEGER, BOOLEAN, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relationship
+
+
+class ControlStatistic(Base):
+    """
+    Running statistics of one metric of a control type, updated as each control is written.
+    """
+    __tablename__ = '_control_statistics'
+    __table_args__ = (UniqueConstraint('controltype_id', 'mode', 'metric', 'genus', name='uq_control_statistic'),)
+
+    id = Column(INTEGER, primary_key=True) #: primary key
+    controltype_id = Column(INTEGER, ForeignKey("_control_types.id", ondelete="CASCADE", name="fk_statistic_controltype_id"), index=True) #: controltype the statistics are for
+    controltype = relationship("ControlType") #: controltype the statistics are for
+    mode = Column(String(32)) #: mode the results came from (e.g. kraken)
+    metric = Column(String(64)) #: off_target_fraction, {mode}_ratio or {mode}_percent
+    genus = Column(String(255)) #: genus of a per genus metric, empty for off_target_fraction
+    count = Column(INTEGER) #: number of controls folded into the statistics
+    mean = Column(FLOAT) #: running mean (Welford)
+    m2 = Column(FLOAT) #: running sum of squared differences from the mean (Welford)
+    ewma = Column(FLOAT) #: exponentially weighted moving average
+    ewm_var = Column(FLOAT) #: exponentially weighted moving variance
+    last_date = Column(DATE) #: submitted date of the last control folded in
+    last_name = Column(String(255)) #: name of the last control folded in
+    stale = Column(BOOLEAN, default=False) #: a control dated before the last one was written, so these need rebuilding
+
+
+class ControlScore(Base):
+    """
+    How far one control's metric was from its control type's statistics at the time it was written.
+    """
+    __tablename__ = '_control_scores'
+    __table_args__ = (UniqueConstraint('control_id', 'mode', 'metric', 'genus', name='uq_control_score'),)
+
+    id = Column(INTEGER, primary_key=True) #: primary key
+    control_id = Column(INTEGER, ForeignKey("_control_samples.id", ondelete="CASCADE", name="fk_score_control_id"), index=True) #: control scored
+    control = relationship("Control") #: control scored
+    submitted_date = Column(DATE, index=True) #: control's submitted date
+    mode = Column(String(32)) #: mode the results came from (e.g. kraken)
+    metric = Column(String(64)) #: off_target_fraction, {mode}_ratio or {mode}_percent
+    genus = Column(String(255)) #: genus of a per genus metric, empty for off_target_fraction
+    value = Column(FLOAT) #: control's value of the metric
+    samples = Column(INTEGER) #: number of earlier controls the score is based on
+    zscore = Column(FLOAT) #: deviation from the running mean in standard deviations
+    ewma_score = Column(FLOAT) #: deviation from the EWMA in exponentially weighted standard deviations
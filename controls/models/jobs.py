@@ -0,0 +1,27 @@
+from . import Base
+from sqlalchemy import Column, String, TEXT, TIMESTAMP, FLOAT, INTEGER
+
+
+class Job(Base):
+    """
+    Analysis of one sample folder for one mode, queued for the worker command.
+    """
+    __tablename__ = '_jobs'
+
+    id = Column(INTEGER, primary_key=True) #: primary key
+    sample = Column(String(255), index=True) #: sample (folder) name
+    folder = Column(String(1024)) #: path of the sample folder
+    mode = Column(String(32)) #: mode to run (e.g. kraken)
+    state = Column(String(16), index=True) #: queued, running, done or failed
+    priority = Column(INTEGER, default=0) #: higher priorities are claimed first
+    predicted_seconds = Column(FLOAT) #: predicted run time, longer jobs of the same priority are claimed first
+    attempts = Column(INTEGER, default=0) #: number of times the job has been claimed
+    max_attempts = Column(INTEGER, default=3) #: attempts before the job is marked failed
+    claim_token = Column(String(64)) #: token of the worker holding the job
+    worker = Column(String(255)) #: host:pid of the worker holding or last holding the job
+    enqueued = Column(TIMESTAMP) #: when the job was queued
+    available_at = Column(TIMESTAMP) #: not claimed before this time, pushed back after failures
+    started = Column(TIMESTAMP) #: when the latest attempt started
+    finished = Column(TIMESTAMP) #: when the job finished or last failed
+    seconds = Column(FLOAT) #: run time of the latest attempt
+    error = Column(TEXT) #: error of the latest failed attempt
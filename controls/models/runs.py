@@ -0,0 +1,22 @@
+from . import Base
+from sqlalchemy import Column, String, TIMESTAMP, FLOAT, INTEGER, BigInteger, BOOLEAN
+
+
+class AnalysisRun(Base):
+    """
+    Run time of one analysis (refseq_masher or kraken2) of one sample, used to predict how long pending samples will take.
+    """
+    __tablename__ = '_analysis_runs'
+
+    id = Column(INTEGER, primary_key=True) #: primary key
+    sample = Column(String(255), index=True) #: sample (folder) name
+    mode = Column(String(32), index=True) #: mode run (e.g. kraken)
+    input_bytes = Column(BigInteger) #: total size of the fastq files the analysis read
+    seconds = Column(FLOAT) #: wall time of the analysis
+    node = Column(String(255)) #: host the analysis ran on
+    finished = Column(TIMESTAMP) #: when the analysis finished
+    subsampled = Column(BOOLEAN) #: whether the analysis ran on a subsample of the reads
+    subsample_method = Column(String(16)) #: max_reads or fraction, if the mode is set to be subsampled
+    subsample_seed = Column(String(64)) #: seed of the subsample
+    reads_total = Column(BigInteger) #: read pairs in the sample, if counted
+    reads_used = Column(BigInteger) #: read pairs the analysis ran on, if subsampled
@@ -0,0 +1,34 @@
+from . import Base
+from sqlalchemy import Column, String, DATE, FLOAT, INTEGER, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relationship
+
+
+class ControlSummary(Base):
+    """
+    Per-date totals of a control type's results, kept up to date as controls are written.
+    """
+    __tablename__ = '_control_summaries'
+    __table_args__ = (UniqueConstraint('controltype_id', 'submitted_date', 'mode', 'target', 'genus', name='uq_control_summary'),)
+
+    id = Column(INTEGER, primary_key=True) #: primary key
+    controltype_id = Column(INTEGER, ForeignKey("_control_types.id", ondelete="CASCADE", name="fk_summary_controltype_id"), index=True) #: controltype summarized
+    controltype = relationship("ControlType") #: controltype summarized
+    submitted_date = Column(DATE, index=True) #: date the summarized controls were submitted
+    mode = Column(String(32)) #: mode the results came from (e.g. contains)
+    target = Column(String(32)) #: 'Target' or 'Off-target'
+    genus = Column(String(255)) #: genus name without fastq date asterisk
+    metric = Column(String(64)) #: result column totalled (e.g. contains_ratio, kraken_count)
+    total = Column(FLOAT) #: sum of metric over the controls of this date
+    samples = Column(INTEGER) #: number of controls contributing to the total
+
+
+class ControlTypeStamp(Base):
+    """
+    Write counter of a control type, bumped in the same transaction as each control written, so reports can tell
+    it changed without reading its controls.
+    """
+    __tablename__ = '_control_type_stamps'
+
+    controltype_id = Column(INTEGER, ForeignKey("_control_types.id", ondelete="CASCADE", name="fk_stamp_controltype_id"), primary_key=True) #: controltype stamped
+    controltype = relationship("ControlType") #: controltype stamped
+    version = Column(INTEGER) #: number of control writes of the controltype
@@ -1,12 +1,20 @@
 from tools import enforce_valid_date
 from tools.excel_functions import read_tsv_string, read_tsv
-from tools.db_functions import get_control_type_by_name, add_control_to_db, check_samples_against_database, link_control_to_submission
-from tools.misc import write_output, parse_control_type_from_name, parse_sample_json, alter_genera_names, get_relevant_fastq_files
-from tools.subprocesses import run_refseq_masher, pull_from_irida, run_kraken
+from pandas import DataFrame
+from tools.db_functions import make_engine, get_control_type_by_name, add_control_to_db, check_samples_against_database, link_control_to_submission
+from tools.misc import write_output, parse_control_type_from_name, parse_sample_json, alter_genera_names
+from tools.subprocesses import pull_from_irida, run_kraken
+from tools.masher_functions import run_refseq_masher_backend, run_refseq_masher_batches
+from tools.codec_functions import encode_results, get_codec
+from tools.subsample_functions import SubsampledInput, read_subsample_sidecar
+from tools.mash_functions import run_mash_matches
+from tools.hook_functions import run_post_write_hooks
+from tools.schedule_functions import get_input_bytes, record_analysis_run, plan_longest_first, estimate_makespan
 from models import Control
 import logging
 from pathlib import Path
 from datetime import datetime
+from time import perf_counter
 import json
 from tqdm import tqdm
 
@@ -27,92 +35,153 @@ def main_parse(settings:dict):
     logger.debug(f"Pulling from irida with settings: {temp}")
     del temp
     pull_from_irida(settings['irida'])
+    # One engine for the whole run.
+    engine = make_engine(settings=settings)
     # loop through for each mode being run
     for mode in settings['mode']:
         logger.debug(f"Running parse for {mode}")
         # compare storage after pull to samples already in the database and remove any that are the same.
-        samples_of_interest = check_samples_against_database(settings=settings, mode=mode)
+        samples_of_interest = check_samples_against_database(settings=settings, mode=mode, engine=engine)
+        # Longest predicted first, so one big sample doesn't finish the run alone.
+        samples_of_interest = [item['folder'] for item in plan_longest_first(settings=settings, pending=[(folder, mode) for folder in samples_of_interest], engine=engine)]
+        # refseq_masher modes can run many folders per invocation first, leaving their tsv files for the loop below.
+        run_refseq_masher_batches(settings=settings, folders=samples_of_interest, mode=mode, engine=engine)
         if settings['verbose']:
             marker = samples_of_interest
         else:
             marker = tqdm(samples_of_interest, desc =f"Parsing folders for {mode}")
         # Perform parsing of any new control samples.
         for folder in marker:
-            sample_name = Path(folder).name
-            newControl = Control(name=sample_name)
-            tsv_file = Path(folder).joinpath(f"{sample_name}_{mode}.tsv")
-            # Get the control type from the database.
-            ct_name = parse_control_type_from_name(settings=settings, control_name=sample_name)
-            if ct_name == None:
-                logger.error(f"Couldn't get control type name from {sample_name}.")
-            try:
-                ct_name = ct_name.replace("_", "-")
-            except  AttributeError as e:
-                logger.error(f"Control type name is NONE, skipping this sample.")
-                continue
-            logger.debug(f"Control Type Name: {ct_name}")
-            # We need to get the object in order to get the targets
-            ct_type = get_control_type_by_name(ct_name, settings=settings)
-            newControl.controltype = ct_type
-            # if a tsv_file already exists...
-            if Path(tsv_file).exists():
-                logger.debug(f"Existing tsv file: {tsv_file}, reading...")
-                tsv_text = read_tsv(tsv_file)
-            elif Path(folder).joinpath(f"{mode}.tsv").exists():
-                tsv_text = read_tsv(Path(folder).joinpath(f"{mode}.tsv"))
-                write_output(tsv_file, tsv_text)
-            # if no tsv file already exists...
-            else:
-                logger.debug(f"No existing tsv file: {tsv_file}, running analysis subprocess for {mode}")
-                # setting parse function based on the mode
-                if mode == "contains" or mode == "matches":
-                    func = function_map["process_refseq_masher"]
-                else:
-                    func = function_map[f"process_{mode}"]
-                tsv_text = func(settings=settings, folder=folder.__str__(), mode=mode, tsv_file=tsv_file)
-            # If there's an error running refseq we're going make some dummy data from the test files with headers only to fill in the gap
-            if tsv_text == None:
-                logger.error(f"Failed to write {mode}.tsv file due to error, Using dummy data.")
-                # Set tsv_text to column headers only.
-                dummy_path = Path(__file__).absolute().parent.parent.joinpath("dummy.tsv")
-                if dummy_path.exists():
-                    logger.debug(f"Dummy path {dummy_path} exists, grabbing dummy data.")
-                    with open(dummy_path.__str__(), "r") as f:
-                        tsv_text = f.readlines()[0]
-            # create dataframe from the text of tsv or directly from refseq_masher
-            try:
-                reads_json = read_tsv_string(tsv_text).T.to_dict()
-            except AttributeError as e:
-                logger.warning(f"The {mode} file for {folder} must have been empty. Using empty dict.")
-                reads_json = {}
-            # pare down data to only include most relevant results sorted by genus
-            reads_json = parse_sample_json(reads_json, mode=mode)
-            if reads_json == None:
-                logger.warning(f"JSON for {Path(folder).name} was NONE. Using empty dict instead.")
-                reads_json = {}
-            # Insert data into Control object 'mode' (contains or matches) column
-            logger.debug(f"Attempting to find date with format (YYYY-MM-DD) in folder path.")
-            # Uses the old_db_path -- if it's set -- to avoid having to input it for each sample.
-            newControl.submitted_date, got_fastq_date = enforce_valid_date(settings=settings, inpath=Path(folder))
-            if got_fastq_date and reads_json != {}:
-                logger.warning(f"Got date from fastq file, adding asterisks to genera names.")
-                reads_json = alter_genera_names(reads_json)
-            setattr(newControl, mode, json.dumps(reads_json))
-            # check for matching samples in a submission and add submission as control parent if found.
-            newControl = link_control_to_submission(settings=settings, control=newControl)
-            if getattr(newControl, mode) == json.dumps({}) and newControl.submitted_date == None:
-                logger.warning(f"Sample {newControl.name} has no {settings['mode']} or date. Skipping")
-                continue
-            else:
-                add_control_to_db(newControl, mode=mode, settings=settings)
+            parse_folder(settings=settings, folder=folder, mode=mode, engine=engine)
     logger.info(f"The PARSE run has ended at {datetime.now()}.")
 
 
+def main_plan(settings:dict, workers:int=1) -> dict:
+    """
+    Lists the pending samples and modes with their predicted run times, longest first, without running anything.
+
+    Args:
+        settings (dict): settings passed down from click.
+        workers (int, optional): number of parallel workers to estimate the makespan for. Defaults to 1.
+
+    Returns:
+        dict: plan (list of dicts of sample, mode, input_bytes and predicted), makespan (seconds) and unpredicted (count).
+    """
+    engine = make_engine(settings=settings)
+    pending = [(folder, mode) for mode in settings['mode'] for folder in check_samples_against_database(settings=settings, mode=mode, engine=engine)]
+    plan = plan_longest_first(settings=settings, pending=pending, engine=engine)
+    predictions = [item['predicted'] for item in plan if item['predicted'] != None]
+    return dict(plan=plan, makespan=estimate_makespan(predictions, workers=workers), unpredicted=len(plan) - len(predictions))
+
+
+def parse_folder(settings:dict, folder:str, mode:str, engine=None) -> bool:
+    """
+    Runs or reads the analysis of one sample folder for a mode and writes the control to the database.
+    Used by parse for each new folder and by watch as folders land.
+
+    Args:
+        settings (dict): settings passed down from click.
+        folder (str): sample folder.
+        mode (str): mode being parsed.
+        engine (engine, optional): engine used. Defaults to None (new engine).
+
+    Returns:
+        bool: True if a control was written from the sample's results. False if it was skipped, or its analysis failed
+        and it was written with dummy data.
+    """
+    sample_name = Path(folder).name
+    newControl = Control(name=sample_name)
+    tsv_file = Path(folder).joinpath(f"{sample_name}_{mode}.tsv")
+    # Get the control type from the database.
+    ct_name = parse_control_type_from_name(settings=settings, control_name=sample_name)
+    if ct_name == None:
+        logger.error(f"Couldn't get control type name from {sample_name}.")
+    try:
+        ct_name = ct_name.replace("_", "-")
+    except  AttributeError as e:
+        logger.error(f"Control type name is NONE, skipping this sample.")
+        return False
+    logger.debug(f"Control Type Name: {ct_name}")
+    # We need to get the object in order to get the targets
+    ct_type = get_control_type_by_name(ct_name, settings=settings, engine=engine)
+    newControl.controltype = ct_type
+    # if a tsv_file already exists...
+    if Path(tsv_file).exists():
+        logger.debug(f"Existing tsv file: {tsv_file}, reading...")
+        tsv_text = read_tsv(tsv_file)
+    elif Path(folder).joinpath(f"{mode}.tsv").exists():
+        tsv_text = read_tsv(Path(folder).joinpath(f"{mode}.tsv"))
+        write_output(tsv_file, tsv_text)
+    # if no tsv file already exists...
+    else:
+        logger.debug(f"No existing tsv file: {tsv_file}, running analysis subprocess for {mode}")
+        # setting parse function based on the mode
+        if mode == "contains" or mode == "matches":
+            func = function_map["process_refseq_masher"]
+        else:
+            func = function_map[f"process_{mode}"]
+        start = perf_counter()
+        # refseq_masher modes hand back their table, others the text of their tsv.
+        tsv_text = func(settings=settings, folder=folder.__str__(), mode=mode, tsv_file=tsv_file)
+        subsample = read_subsample_sidecar(tsv_file) if tsv_text is not None else None
+        # Matches from a stored sketch didn't read the sample, so they'd skew the cost model.
+        if subsample != None and subsample.get('sketch_reused', False):
+            logger.debug(f"{sample_name} {mode} reused a stored sketch, not recording its run time.")
+        elif tsv_text is not None:
+            if subsample != None and subsample['subsampled']:
+                input_bytes = subsample['bytes_used']
+            else:
+                input_bytes = get_input_bytes(folder)
+            record_analysis_run(settings=settings, sample=sample_name, mode=mode, input_bytes=input_bytes,
+                seconds=perf_counter() - start, subsample=subsample, engine=engine)
+    # If there's an error running refseq we're going make some dummy data from the test files with headers only to fill in the gap
+    analysis_failed = tsv_text is None
+    if analysis_failed:
+        logger.error(f"Failed to write {mode}.tsv file due to error, Using dummy data.")
+        # Set tsv_text to column headers only.
+        dummy_path = Path(__file__).absolute().parent.parent.joinpath("dummy.tsv")
+        if dummy_path.exists():
+            logger.debug(f"Dummy path {dummy_path} exists, grabbing dummy data.")
+            with open(dummy_path.__str__(), "r") as f:
+                tsv_text = f.readlines()[0]
+    # create dataframe from the text of tsv or directly from refseq_masher
+    try:
+        if isinstance(tsv_text, DataFrame):
+            reads_json = tsv_text.T.to_dict()
+        else:
+            reads_json = read_tsv_string(tsv_text).T.to_dict()
+    except AttributeError as e:
+        logger.warning(f"The {mode} file for {folder} must have been empty. Using empty dict.")
+        reads_json = {}
+    # pare down data to only include most relevant results sorted by genus
+    reads_json = parse_sample_json(reads_json, mode=mode)
+    if reads_json == None:
+        logger.warning(f"JSON for {Path(folder).name} was NONE. Using empty dict instead.")
+        reads_json = {}
+    # Insert data into Control object 'mode' (contains or matches) column
+    logger.debug(f"Attempting to find date with format (YYYY-MM-DD) in folder path.")
+    # Uses the old_db_path -- if it's set -- to avoid having to input it for each sample.
+    newControl.submitted_date, got_fastq_date = enforce_valid_date(settings=settings, inpath=Path(folder))
+    if got_fastq_date and reads_json != {}:
+        logger.warning(f"Got date from fastq file, adding asterisks to genera names.")
+        reads_json = alter_genera_names(reads_json)
+    setattr(newControl, mode, encode_results(reads_json, codec=get_codec(settings)))
+    # check for matching samples in a submission and add submission as control parent if found.
+    newControl = link_control_to_submission(settings=settings, control=newControl, engine=engine)
+    if reads_json == {} and newControl.submitted_date == None:
+        logger.warning(f"Sample {newControl.name} has no {settings['mode']} or date. Skipping")
+        return False
+    else:
+        control_id, old_value = add_control_to_db(newControl, mode=mode, settings=settings, engine=engine)
+        run_post_write_hooks(settings=settings, control_id=control_id, mode=mode, old_value=old_value, engine=engine)
+        return not analysis_failed
+
+
 # Below this point are the individual parsing functions. They must be named "parse_{mode name}" and
 # take only settings, folder, mode and tsv_file in order to hook into the main function
 
 
-def process_refseq_masher(settings:dict, folder:str, mode:str, tsv_file:Path) -> str:
+def process_refseq_masher(settings:dict, folder:str, mode:str, tsv_file:Path) -> DataFrame:
     """
     Gets refseq masher results.
 
@@ -123,16 +192,21 @@ def process_refseq_masher(settings:dict, folder:str, mode:str, tsv_file:Path) ->
         tsv_file (Path): filepath to check for already existing results.
 
     Returns:
-        str: output from process
+        DataFrame: output from process
     """    
-    tsv_text = run_refseq_masher(settings=settings, folder=folder.__str__(), mode=mode)
-    logger.debug(f"Writing refseq_masher results to tsv_file: {tsv_file}")
-    try:
-        write_output(tsv_file, tsv_text)
-    except:
+    table = None
+    # matches can come from the sample's stored sketch, contains screens the reads themselves.
+    if mode == "matches":
+        table = run_mash_matches(settings=settings, folder=folder, tsv_file=tsv_file)
+    if table is None:
+        with SubsampledInput(settings=settings, folder=folder, mode=mode, tsv_file=tsv_file) as subsampled:
+            table = run_refseq_masher_backend(settings=settings, folder=subsampled.input_folder.__str__(), mode=mode)
+    if table is None:
         logger.error("No tsv text found, using NONE")
-        tsv_text = None
-    return tsv_text
+        return None
+    logger.debug(f"Writing refseq_masher results to tsv_file: {tsv_file}")
+    write_output(tsv_file, table.to_csv(sep="\t", index=False))
+    return table
 
 
 def process_kraken(settings:dict, folder:str, tsv_file:Path, mode:str='kraken') -> str:
@@ -148,7 +222,8 @@ def process_kraken(settings:dict, folder:str, tsv_file:Path, mode:str='kraken')
     Returns:
         str: output from process
     """    
-    run_kraken(settings=settings, folder=folder.__str__(), fastQ_pair=get_relevant_fastq_files(Path(folder)), tsv_file=tsv_file)
+    with SubsampledInput(settings=settings, folder=folder, mode=mode, tsv_file=tsv_file) as subsampled:
+        run_kraken(settings=settings, folder=folder.__str__(), fastQ_pair=subsampled.pair, tsv_file=tsv_file)
     return read_tsv(tsv_file)
 
 
@@ -1,11 +1,13 @@
-from tools.db_functions import get_all_Control_Types_names, convert_control_to_dict, get_all_samples_by_control_type
+from tools.db_functions import make_engine, get_all_Control_Types_names, get_control_records_by_control_type, get_control_type_watermark
 from tools.excel_functions import construct_df_from_json
 from tools.vis_functions import create_charts, output_figures
+from tools.manifest_functions import read_report_manifest, write_report_manifest, update_report_manifest, report_is_current
+from tools.dashboard_functions import use_dashboard, write_dashboard_data, write_dashboard_index
+from tools.output_functions import use_legacy_full_output, get_full_output_path, read_previous_full_output, write_legacy_full_output, write_full_output
 import logging
 from datetime import datetime
 from tqdm import tqdm
-import json
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 logger = logging.getLogger("controls.report")
 
@@ -15,31 +17,100 @@ def main_report(settings:dict):
 
     Args:
         settings (dict): Settings passed down from click.
-    """        
+    """
     logger.debug(f"Full settings: {settings}")
     logger.debug(f"Output folder: {settings['folder']['output']}")
+    engine = make_engine(settings=settings)
     # Get all names of all control types for grouping.
-    ct_types = get_all_Control_Types_names(settings=settings)
+    ct_types = get_all_Control_Types_names(settings=settings, engine=engine)
+    if 'report_types' in settings and settings['report_types']:
+        unknown = [ct_type for ct_type in settings['report_types'] if ct_type not in ct_types]
+        if unknown:
+            logger.warning(f"Control types {unknown} aren't in the database, skipping them.")
+        ct_types = [ct_type for ct_type in ct_types if ct_type in settings['report_types']]
     logger.debug(f"CT-TYPES: {ct_types}")
-    # Construct dictionary assigning all controls of a type to that key.
-    by_type = {ct_type: [convert_control_to_dict(sample, settings=settings) for sample in get_all_samples_by_control_type(ct_type, settings=settings)] for ct_type in ct_types}
-    # Convert dictionaries to dataframes (Also writes xlsx)
-    by_type = [construct_df_from_json(settings=settings, group_name=group, group_in=by_type[group], output_dir=settings['folder']['output']) for group in by_type]
-    with open(Path(settings['folder']['output']).joinpath("__fulloutput.json").__str__(), "w") as f:
-        json.dump([{key:json.loads(ct_type[key].to_json(orient="records")) for key in ct_type} for ct_type in by_type], f, indent=4)
-    if settings['text_only']:
-        logger.info(f"The REPORT run has ended at {datetime.now()}.")
+    since = settings['since'] if 'since' in settings else None
+    until = settings['until'] if 'until' in settings else None
+    logger.debug(f"Report window: {since} to {until}")
+    # Work out which control types have changed since the last run.
+    manifest = read_report_manifest(settings=settings)
+    # Control types that can be carried over from the previous full output.
+    if use_legacy_full_output(settings=settings):
+        previous_output = read_previous_full_output(settings=settings)
+        previous_types = list(previous_output.keys())
+    elif get_full_output_path(settings=settings).exists():
+        # The manifest vouches for which types the file holds, see report_is_current.
+        previous_types = ct_types
+    else:
+        previous_types = []
+    watermarks = {ct_type: get_control_type_watermark(ct_type, settings=settings, engine=engine, since=since, until=until) for ct_type in ct_types}
+    if 'force' in settings and settings['force']:
+        stale_types = ct_types
+    else:
+        stale_types = [ct_type for ct_type in ct_types if ct_type not in previous_types or
+            not report_is_current(settings=settings, manifest=manifest, group_name=ct_type, watermark=watermarks[ct_type])]
+    logger.info(f"Regenerating {len(stale_types)} of {len(ct_types)} control types: {stale_types}")
+    if not stale_types:
+        logger.info(f"All reports are current. The REPORT run has ended at {datetime.now()}.")
         return
-    if settings['verbose']:
-        marker = by_type
+    # Each control type is built independently, in worker processes if asked for.
+    by_type = {}
+    workers = settings['workers'] if 'workers' in settings and settings['workers'] != None else 1
+    if workers > 1:
+        # Don't hand pooled sqlite connections down to forked workers.
+        engine.dispose()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(report_control_type, settings, ct_type) for ct_type in stale_types]
+            marker = as_completed(futures)
+            if not settings['verbose']:
+                marker = tqdm(marker, total=len(futures), desc ="Generating reports")
+            for future in marker:
+                by_type.update(future.result())
+    else:
+        marker = stale_types
+        if not settings['verbose']:
+            marker = tqdm(stale_types, desc ="Generating reports")
+        for ct_type in marker:
+            by_type.update(report_control_type(settings, ct_type, engine=engine))
+    # Unchanged control types are carried over from the previous full output.
+    if use_legacy_full_output(settings=settings):
+        write_legacy_full_output(settings=settings, ct_types=ct_types, frames=by_type, previous_output=previous_output)
+    else:
+        write_full_output(settings=settings, ct_types=ct_types, frames=by_type)
+    if use_dashboard(settings=settings) and not settings['text_only']:
+        write_dashboard_index(settings=settings)
+    write_report_manifest(settings=settings, manifest=update_report_manifest(settings=settings, manifest=manifest, watermarks={ct_type: watermarks[ct_type] for ct_type in stale_types}))
+    logger.info(f"The REPORT run has ended at {datetime.now()}.")
+
+
+def report_control_type(settings:dict, ct_type:str, engine=None) -> dict:
+    """
+    Loads one control type, limited to the report window, and writes its xlsx and html or dashboard outputs.
+    Runs in a worker process when report is given --workers, so it loads its own data.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        ct_type (str): Name of the control type.
+        engine (engine, optional): engine used. Defaults to None (new engine).
+
+    Returns:
+        dict: dataframe of the control type keyed by its name.
+    """
+    logger.debug(f"Group name: {ct_type}")
+    records = get_control_records_by_control_type(ct_type, settings=settings, engine=engine,
+        since=settings['since'] if 'since' in settings else None, until=settings['until'] if 'until' in settings else None)
+    # Convert dictionaries to dataframes (Also writes xlsx)
+    group = construct_df_from_json(settings=settings, group_name=ct_type, group_in=records, output_dir=settings['folder']['output'])
+    if group[ct_type].empty:
+        logger.warning(f"No results to chart for {ct_type}.")
+    elif settings['text_only']:
+        pass
+    elif use_dashboard(settings=settings):
+        # The dashboard page fetches these files itself, nothing is charted here.
+        write_dashboard_data(settings=settings, df=group[ct_type].copy(), group_name=ct_type)
     else:
-        marker = tqdm(by_type, desc ="Generating reports")
-    for ct_type in marker:
-        logger.debug(f"Group name: {list(ct_type.keys())[0]}")
-        # Grab list name for chart title
-        group_name = list(ct_type.keys())[0]
-        # Construct stacked bar chart.
-        figs = create_charts(settings=settings, df=ct_type[group_name], group_name=group_name)
+        # Construct stacked bar chart. Charts alter the frame, so give them a copy.
+        figs = create_charts(settings=settings, df=group[ct_type].copy(), group_name=ct_type)
         # Write bar chart to html file.
-        output_figures(settings=settings, figs=figs, group_name=group_name)
-    logger.info(f"The REPORT run has ended at {datetime.now()}.")
\ No newline at end of file
+        output_figures(settings=settings, figs=figs, group_name=ct_type)
+    return group
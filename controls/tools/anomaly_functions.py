@@ -0,0 +1,376 @@
+import logging
+import numpy as np
+from datetime import date, datetime
+from sqlalchemy.orm import Session
+from sqlalchemy import engine, func, or_
+from models import Control, ControlType, ControlStatistic, ControlScore
+from .db_functions import make_engine, summarize_results, get_control_records_by_control_types
+from .codec_functions import decode_results
+from .misc import parse_date
+
+
+logger = logging.getLogger("controls.tools.anomaly_functions")
+
+
+def get_anomaly_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the anomalies section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['anomalies'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def compute_control_metrics(results:dict, mode:str, targets:list) -> dict:
+    """
+    Calculates the tracked metrics of one control's results for a mode.
+    Refseq modes are tracked by their per genus ratio, kraken modes by the percent of reads of each genus.
+
+    Args:
+        results (dict): decoded results of the mode.
+        mode (str): mode used by the main parser.
+        targets (list): target genera of the controltype.
+
+    Returns:
+        dict: values keyed by (metric, genus), empty if the control has no results.
+    """
+    summary = summarize_results(results=results, mode=mode, targets=targets)
+    total = sum(summary.values())
+    if total <= 0:
+        return {}
+    off_target = sum(value for (target, genus), value in summary.items() if target == "Off-target")
+    metrics = {("off_target_fraction", ""): off_target / total}
+    for (target, genus), value in summary.items():
+        if mode == "contains" or mode == "matches":
+            metrics[(f"{mode}_ratio", genus)] = value
+        else:
+            metrics[(f"{mode}_percent", genus)] = 100 * value / total
+    return metrics
+
+
+def get_fold_key(submitted_date, name:str) -> tuple:
+    """
+    Position of a control in the order controls are folded into the statistics: by submitted date, then name.
+    Both the incremental update and the rebuild use it, so they give the same statistics.
+
+    Args:
+        submitted_date: date, datetime or 'YYYY-MM-DD' string the control was submitted.
+        name (str): control name
+
+    Returns:
+        tuple: ('YYYY-MM-DD', name)
+    """
+    if not isinstance(submitted_date, str):
+        submitted_date = parse_date(submitted_date)
+    return (submitted_date, name)
+
+
+def score_value(value, count:int, mean, m2, ewma, ewm_var) -> tuple:
+    """
+    Scores a value against statistics built from earlier controls. Works on single values or arrays of metrics.
+
+    Args:
+        value: value to score
+        count (int): number of earlier controls
+        mean: running mean
+        m2: running sum of squared differences from the mean
+        ewma: exponentially weighted moving average
+        ewm_var: exponentially weighted moving variance
+
+    Returns:
+        tuple: z-score and EWMA score, NaN where the spread is still zero.
+    """
+    value, mean, m2, ewma, ewm_var = [np.asarray(item, dtype=float) for item in (value, mean, m2, ewma, ewm_var)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zscore = np.where((count >= 2) & (m2 > 0), (value - mean) / np.sqrt(m2 / max(count - 1, 1)), np.nan)
+        ewma_score = np.where((count >= 2) & (ewm_var > 0), (value - ewma) / np.sqrt(ewm_var), np.nan)
+    return zscore, ewma_score
+
+
+def fold_value(value, count:int, mean, m2, ewma, ewm_var, alpha:float) -> tuple:
+    """
+    Folds a control's value into the statistics: Welford's update of the mean and squared differences, and the
+    exponentially weighted mean and variance. Works on single values or arrays of metrics.
+
+    Args:
+        value: value to fold in
+        count (int): number of controls already folded in
+        mean: running mean
+        m2: running sum of squared differences from the mean
+        ewma: exponentially weighted moving average
+        ewm_var: exponentially weighted moving variance
+        alpha (float): EWMA smoothing factor.
+
+    Returns:
+        tuple: count, mean, m2, ewma and ewm_var after the value.
+    """
+    count += 1
+    delta = value - mean
+    mean = mean + delta / count
+    m2 = m2 + delta * (value - mean)
+    if count == 1:
+        ewma = value
+    else:
+        diff = value - ewma
+        increment = alpha * diff
+        ewma = ewma + increment
+        ewm_var = (1 - alpha) * (ewm_var + diff * increment)
+    return count, mean, m2, ewma, ewm_var
+
+
+def update_control_statistics(session:Session, control:Control, mode:str, settings:dict={}):
+    """
+    Scores a newly written control against its control type's statistics, then folds it into them.
+    Controls already scored for the mode are skipped, so re-parsing doesn't count them twice.
+    Controls are folded in submitted date order. One dated before the last control folded in can't be added
+    on the end, so the control type's statistics for the mode are marked stale and rebuilt before alerts are listed.
+
+    Args:
+        session (Session): session the control is being written in.
+        control (Control): control just written.
+        mode (str): mode that was written.
+        settings (dict, optional): settings passed down from click. Defaults to {}.
+    """
+    if control.controltype == None or control.submitted_date == None:
+        return
+    if session.query(ControlScore.id).filter_by(control_id=control.id, mode=mode).first() != None:
+        logger.debug(f"{control.name} already scored for {mode}, skipping.")
+        return
+    try:
+        results = decode_results(getattr(control, mode))
+    except TypeError:
+        return
+    targets = control.controltype.targets if control.controltype.targets != None else []
+    metrics = compute_control_metrics(results=results, mode=mode, targets=targets)
+    if not metrics:
+        return
+    alpha = float(get_anomaly_setting(settings=settings, key="alpha", default=0.1))
+    try:
+        submitted_date = control.submitted_date.date()
+    except AttributeError:
+        submitted_date = control.submitted_date
+    fold_key = get_fold_key(submitted_date, control.name)
+    stats = {(row.metric, row.genus): row for row in session.query(ControlStatistic)\
+        .filter_by(controltype_id=control.parent_id, mode=mode)}
+    if any(row.stale for row in stats.values()):
+        logger.debug(f"Statistics of {control.controltype.name} {mode} are waiting to be rebuilt, not scoring {control.name}.")
+        return
+    latest = max((get_fold_key(row.last_date, row.last_name) for row in stats.values() if row.last_date != None), default=None)
+    if latest != None and fold_key < latest:
+        logger.info(f"{control.name} is dated before controls already scored, {control.controltype.name} {mode} statistics will be rebuilt.")
+        for row in stats.values():
+            row.stale = True
+        return
+    try:
+        seen = stats[("off_target_fraction", "")].count
+    except KeyError:
+        seen = 0
+    for key in set(stats) | set(metrics):
+        value = metrics.get(key, 0.0)
+        try:
+            row = stats[key]
+        except KeyError:
+            # A genus seen for the first time was absent, so zero, in every earlier control.
+            row = ControlStatistic(controltype_id=control.parent_id, mode=mode, metric=key[0], genus=key[1],
+                count=seen, mean=0.0, m2=0.0, ewma=0.0, ewm_var=0.0, stale=False)
+            session.add(row)
+        zscore, ewma_score = score_value(value, row.count, row.mean, row.m2, row.ewma, row.ewm_var)
+        # Absent genera are only worth a score when they are supposed to be there.
+        if key in metrics or key[1] in targets:
+            session.add(ControlScore(control_id=control.id, submitted_date=submitted_date, mode=mode, metric=key[0],
+                genus=key[1], value=value, samples=row.count, zscore=None if np.isnan(zscore) else float(zscore),
+                ewma_score=None if np.isnan(ewma_score) else float(ewma_score)))
+        row.count, row.mean, row.m2, row.ewma, row.ewm_var = fold_value(value, row.count, row.mean, row.m2, row.ewma, row.ewm_var, alpha=alpha)
+        row.last_date = submitted_date
+        row.last_name = control.name
+
+
+def mark_control_statistics_stale(session:Session, controltype_id:int, mode:str):
+    """
+    Marks a control type's statistics for a mode for rebuilding, as when a control can't be folded into them.
+    A control type without statistics yet gets a stale placeholder row, so the rebuild still finds it.
+
+    Args:
+        session (Session): session to mark them in.
+        controltype_id (int): id of the control type.
+        mode (str): mode of the statistics.
+    """
+    marked = session.query(ControlStatistic).filter_by(controltype_id=controltype_id, mode=mode)\
+        .update(dict(stale=True), synchronize_session=False)
+    if not marked:
+        session.add(ControlStatistic(controltype_id=controltype_id, mode=mode, metric="off_target_fraction", genus="",
+            count=0, mean=0.0, m2=0.0, ewma=0.0, ewm_var=0.0, stale=True))
+
+
+def build_statistics(values:np.ndarray, alpha:float) -> dict:
+    """
+    Folds a whole time series of controls into statistics with the same update as update_control_statistics,
+    scoring each control against the statistics of the controls before it.
+    Rows are controls in fold order, columns are metrics.
+
+    Args:
+        values (np.ndarray): metric values, zero where a genus was absent.
+        alpha (float): EWMA smoothing factor.
+
+    Returns:
+        dict: zscore and ewma_score arrays with NaN where undefined, and final count, mean, m2, ewma and ewm_var.
+    """
+    zscore = np.full(values.shape, np.nan)
+    ewma_score = np.full(values.shape, np.nan)
+    count = 0
+    mean = np.zeros(values.shape[1])
+    m2 = np.zeros(values.shape[1])
+    ewma = np.zeros(values.shape[1])
+    ewm_var = np.zeros(values.shape[1])
+    for ii in range(values.shape[0]):
+        zscore[ii], ewma_score[ii] = score_value(values[ii], count, mean, m2, ewma, ewm_var)
+        count, mean, m2, ewma, ewm_var = fold_value(values[ii], count, mean, m2, ewma, ewm_var, alpha=alpha)
+    return dict(zscore=zscore, ewma_score=ewma_score, count=count, mean=mean, m2=m2, ewma=ewma, ewm_var=ewm_var)
+
+
+def rebuild_control_statistics(settings:dict, engine:engine=None, stale_only:bool=False) -> int:
+    """
+    Recreates the statistics and scores of every control type from its full history, archived controls included,
+    folding controls in the same order as update_control_statistics. Archived controls count towards the
+    statistics but only live controls are scored.
+
+    Args:
+        settings (dict): settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+        stale_only (bool, optional): only rebuild the control types and modes marked stale. Defaults to False.
+
+    Returns:
+        int: number of controls scored.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    session = Session(engine)
+    alpha = float(get_anomaly_setting(settings=settings, key="alpha", default=0.1))
+    if stale_only:
+        stale = {tuple(row) for row in session.query(ControlStatistic.controltype_id, ControlStatistic.mode)\
+            .filter(ControlStatistic.stale == True).distinct()}
+    else:
+        stale = None
+    if stale == set():
+        session.close()
+        return 0
+    control_types = session.query(ControlType).all()
+    control_ids = dict(session.query(Control.name, Control.id).all())
+    statistics = []
+    scores = []
+    scored = set()
+    for ct in control_types:
+        modes = [mode for mode in settings['modes'] if stale == None or (ct.id, mode) in stale]
+        if not modes:
+            continue
+        records = sorted(get_control_records_by_control_types([ct.name], settings=settings, engine=engine),
+            key=lambda record: get_fold_key(record['submitted_date'] or "", record['name']))
+        targets = ct.targets if ct.targets != None else []
+        for mode in modes:
+            rows = []
+            for record in records:
+                if record['submitted_date'] == None or record[mode] == None:
+                    continue
+                metrics = compute_control_metrics(results=record[mode], mode=mode, targets=targets)
+                if metrics:
+                    rows.append((record, metrics))
+            if stale != None:
+                session.query(ControlStatistic).filter_by(controltype_id=ct.id, mode=mode).delete(synchronize_session=False)
+                ids = [control_ids[record['name']] for record in records if record['name'] in control_ids]
+                for start in range(0, len(ids), 500):
+                    session.query(ControlScore).filter(ControlScore.mode == mode, ControlScore.control_id.in_(ids[start:start + 500]))\
+                        .delete(synchronize_session=False)
+            if not rows:
+                continue
+            keys = sorted({key for record, metrics in rows for key in metrics})
+            index = {key: ii for ii, key in enumerate(keys)}
+            values = np.zeros((len(rows), len(keys)))
+            present = np.zeros((len(rows), len(keys)), dtype=bool)
+            for ii, (record, metrics) in enumerate(rows):
+                for key, value in metrics.items():
+                    values[ii, index[key]] = value
+                    present[ii, index[key]] = True
+            result = build_statistics(values=values, alpha=alpha)
+            last = rows[-1][0]
+            for jj, (metric, genus) in enumerate(keys):
+                statistics.append(dict(controltype_id=ct.id, mode=mode, metric=metric, genus=genus, count=result['count'],
+                    mean=float(result['mean'][jj]), m2=float(result['m2'][jj]), ewma=float(result['ewma'][jj]), ewm_var=float(result['ewm_var'][jj]),
+                    last_date=datetime.strptime(last['submitted_date'], "%Y-%m-%d").date(), last_name=last['name'], stale=False))
+            # Same rule as update_control_statistics: absent genera are only scored if they are targets.
+            keep = present | np.array([genus in targets for metric, genus in keys])[None, :]
+            for ii, jj in zip(*np.nonzero(keep)):
+                record = rows[ii][0]
+                if record['name'] not in control_ids:
+                    continue
+                zscore = result['zscore'][ii, jj]
+                ewma_score = result['ewma_score'][ii, jj]
+                scores.append(dict(control_id=control_ids[record['name']], submitted_date=datetime.strptime(record['submitted_date'], "%Y-%m-%d").date(),
+                    mode=mode, metric=keys[jj][0], genus=keys[jj][1], value=float(values[ii, jj]), samples=int(ii),
+                    zscore=None if np.isnan(zscore) else float(zscore), ewma_score=None if np.isnan(ewma_score) else float(ewma_score)))
+                scored.add(record['name'])
+    if stale == None:
+        session.query(ControlScore).delete()
+        session.query(ControlStatistic).delete()
+    session.bulk_insert_mappings(ControlStatistic, statistics)
+    session.bulk_insert_mappings(ControlScore, scores)
+    session.commit()
+    session.close()
+    logger.info(f"Rebuilt {len(statistics)} statistics and {len(scores)} scores.")
+    return len(scored)
+
+
+def get_anomaly_alerts(settings:dict={}, engine:engine=None, z_threshold:float=None, ewma_threshold:float=None,
+        min_samples:int=None, since:date=None, ct_types:list=[]) -> list:
+    """
+    Lists control metrics that broke the z-score or EWMA thresholds against the controls dated before them.
+    Statistics marked stale by out of order writes are rebuilt first.
+
+    Args:
+        settings (dict, optional): settings passed down from click. Defaults to {}.
+        engine (engine, optional): engine used. Defaults to None.
+        z_threshold (float, optional): absolute z-score to alert on. Defaults to anomalies z_threshold, then 3.
+        ewma_threshold (float, optional): absolute EWMA score to alert on. Defaults to anomalies ewma_threshold, then 3.
+        min_samples (int, optional): earlier controls needed before a score counts. Defaults to anomalies min_samples, then 10.
+        since (date, optional): Earliest submitted date to include. Defaults to None.
+        ct_types (list, optional): only these control types. Defaults to [] (all).
+
+    Returns:
+        list: dictionaries of name, controltype, submitted_date, mode, metric, genus, value, zscore and ewma_score, newest first.
+    """
+    if z_threshold == None:
+        z_threshold = float(get_anomaly_setting(settings=settings, key="z_threshold", default=3))
+    if ewma_threshold == None:
+        ewma_threshold = float(get_anomaly_setting(settings=settings, key="ewma_threshold", default=3))
+    if min_samples == None:
+        min_samples = int(get_anomaly_setting(settings=settings, key="min_samples", default=10))
+    if engine == None:
+        engine = make_engine(settings=settings)
+    # Control types that were written out of date order are brought up to date first.
+    rebuild_control_statistics(settings=settings, engine=engine, stale_only=True)
+    session = Session(engine)
+    query = session.query(ControlScore, Control.name, ControlType.name)\
+        .join(Control, ControlScore.control_id == Control.id)\
+        .join(ControlType, Control.parent_id == ControlType.id)\
+        .filter(ControlScore.samples >= min_samples)\
+        .filter(or_(func.abs(ControlScore.zscore) >= z_threshold, func.abs(ControlScore.ewma_score) >= ewma_threshold))
+    if since != None:
+        query = query.filter(ControlScore.submitted_date >= since)
+    if ct_types:
+        query = query.filter(ControlType.name.in_(ct_types))
+    alerts = [dict(name=name, controltype=ct_name, submitted_date=parse_date(score.submitted_date), mode=score.mode,
+        metric=score.metric, genus=score.genus, value=score.value, zscore=score.zscore, ewma_score=score.ewma_score)
+        for score, name, ct_name in query.order_by(ControlScore.submitted_date.desc(), Control.name)]
+    session.close()
+    return alerts
@@ -0,0 +1,125 @@
+import json
+import base64
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger("controls.tools.codec_functions")
+
+# Binary codecs are stored as "{tag}:{base64 payload}" so they survive the JSON typed columns.
+# Rows without a tag are plain JSON, which covers everything written before codecs existed.
+codecs = ["json", "orjson", "msgpack", "msgpack+zstd"]
+
+
+def get_codec(settings:dict) -> str:
+    """
+    Gets the codec used to store results from the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        str: codec name, defaults to 'json'
+    """
+    if 'codec' in settings and settings['codec'] != None:
+        return settings['codec']
+    return "json"
+
+
+def check_codec_available(codec:str) -> bool:
+    """
+    Checks that the optional packages a codec needs are installed.
+
+    Args:
+        codec (str): codec name
+
+    Returns:
+        bool: True if the codec can be used.
+    """
+    if codec not in codecs:
+        logger.error(f"Unknown codec {codec}. Choose from {codecs}.")
+        return False
+    if codec == "orjson" and orjson == None:
+        logger.error("Codec orjson requires the orjson package.")
+        return False
+    if codec.startswith("msgpack") and msgpack == None:
+        logger.error(f"Codec {codec} requires the msgpack package.")
+        return False
+    if codec.endswith("zstd") and zstandard == None:
+        logger.error(f"Codec {codec} requires the zstandard package.")
+        return False
+    return True
+
+
+def encode_results(data:dict, codec:str="json") -> str:
+    """
+    Encodes a results dictionary for storage in a mode column.
+
+    Args:
+        data (dict): parsed results for one mode
+        codec (str, optional): codec to use. Defaults to "json".
+
+    Returns:
+        str: encoded results.
+    """
+    if not check_codec_available(codec):
+        logger.warning(f"Falling back to json.")
+        codec = "json"
+    if codec == "json":
+        return json.dumps(data)
+    if codec == "orjson":
+        # orjson writes compact plain JSON, so no tag is needed to read it back.
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    payload = msgpack.packb(data, use_bin_type=True)
+    if codec == "msgpack+zstd":
+        payload = zstandard.ZstdCompressor(level=10).compress(payload)
+    return f"{codec}:{base64.b64encode(payload).decode('ascii')}"
+
+
+def decode_results(value:str) -> dict:
+    """
+    Decodes a stored mode column, whichever codec wrote it.
+
+    Args:
+        value (str): value from the database
+
+    Raises:
+        TypeError: if there is no value to decode, as json.loads would.
+
+    Returns:
+        dict: results for one mode.
+    """
+    if value == None:
+        raise TypeError("Cannot decode an empty value.")
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    # Values written through a JSON column by an older sqlalchemy can come back already decoded.
+    if isinstance(value, dict):
+        return value
+    tag, _, payload = value.partition(":")
+    if tag == "msgpack" or tag == "msgpack+zstd":
+        if not check_codec_available(tag):
+            raise ValueError(f"Cannot decode {tag} value without its packages installed.")
+        payload = base64.b64decode(payload)
+        if tag == "msgpack+zstd":
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    if orjson != None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # json.dumps writes NaN, which orjson won't read.
+            pass
+    return json.loads(value)
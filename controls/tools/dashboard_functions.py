@@ -0,0 +1,303 @@
+import json
+import logging
+import pandas as pd
+from pathlib import Path
+from .misc import get_window_suffix
+from .vis_functions import prepare_chart_df, recalculate_percent, get_plotlyjs_path, get_html_setting
+from plotly.offline import get_plotlyjs_version
+
+
+logger = logging.getLogger("controls.tools.dashboard_functions")
+
+# Bumped when the layout of the data files changes, so reports made with the old layout are rebuilt.
+dashboard_layout = 2
+
+# Single page that lists control types and loads their data scripts only when they are picked. Data is loaded
+# with script tags rather than fetched, so the page works when opened as a file.
+# The catalog and plotly.js script tag are filled in by write_dashboard_index.
+dashboard_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Controls dashboard</title>
+__PLOTLYJS__
+<style>
+body { font-family: sans-serif; margin: 1em; }
+#controls label { margin-right: 1em; }
+#chart { height: 80vh; }
+</style>
+</head>
+<body>
+<div id="controls">
+<label>Control type <select id="type"></select></label>
+<label>Chart <select id="chart-select"></select></label>
+<label>From <select id="from"></select></label>
+<label>To <select id="to"></select></label>
+<span id="status"></span>
+</div>
+<div id="chart"></div>
+<script>
+const catalog = __CATALOG__;
+const palette = ["#636EFA", "#EF553B", "#00CC96", "#AB63FA", "#FFA15A", "#19D3F3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"];
+const cache = {};
+const pending = {};
+const typeSelect = document.getElementById("type");
+const chartSelect = document.getElementById("chart-select");
+const fromSelect = document.getElementById("from");
+const toSelect = document.getElementById("to");
+const statusSpan = document.getElementById("status");
+
+function fillSelect(select, values, selected) {
+    select.innerHTML = "";
+    values.forEach((value, ii) => {
+        const option = document.createElement("option");
+        option.value = ii;
+        option.textContent = value;
+        option.selected = value === selected;
+        select.appendChild(option);
+    });
+}
+
+// Called by each data script as it loads.
+function dashboardData(data) {
+    const key = data.controltype + "/" + data.period;
+    if (key in pending) {
+        pending[key](data);
+        delete pending[key];
+    }
+}
+
+function loadPeriod(type, period) {
+    const key = type + "/" + period;
+    if (!(key in cache)) {
+        cache[key] = new Promise((resolve, reject) => {
+            pending[key] = resolve;
+            const script = document.createElement("script");
+            script.src = "data/" + encodeURIComponent(type) + "/" + period + ".js";
+            script.onload = () => script.remove();
+            script.onerror = () => {
+                script.remove();
+                delete pending[key];
+                delete cache[key];
+                reject(new Error("Couldn't load " + key));
+            };
+            document.head.appendChild(script);
+        });
+    }
+    return cache[key];
+}
+
+function selectType() {
+    const periods = catalog.types[typeSelect.options[typeSelect.selectedIndex].textContent];
+    // Only the latest period is loaded until a wider range is asked for.
+    fillSelect(fromSelect, periods, periods[periods.length - 1]);
+    fillSelect(toSelect, periods, periods[periods.length - 1]);
+    draw();
+}
+
+async function draw() {
+    const type = typeSelect.options[typeSelect.selectedIndex].textContent;
+    const chart = catalog.charts[chartSelect.value];
+    const periods = catalog.types[type].slice(Number(fromSelect.value), Number(toSelect.value) + 1);
+    statusSpan.textContent = "Loading...";
+    let parts;
+    try {
+        parts = await Promise.all(periods.map(period => loadPeriod(type, period)));
+    } catch (error) {
+        statusSpan.textContent = error + ". Rerun report to rebuild the dashboard data.";
+        return;
+    }
+    const groups = new Map();
+    parts.forEach(part => {
+        const columns = part.columns;
+        if (!(chart.y in columns)) return;
+        for (let ii = 0; ii < columns.submitted_date.length; ii++) {
+            const name = columns[chart.color][ii];
+            if (!groups.has(name)) groups.set(name, {x: [], y: [], text: [], customdata: []});
+            const group = groups.get(name);
+            group.x.push(columns.submitted_date[ii]);
+            group.y.push(columns[chart.y][ii]);
+            group.text.push(columns.genera[ii]);
+            group.customdata.push(chart.hover.map(column => column in columns ? columns[column][ii] : null));
+        }
+    });
+    const hover = ["submitted_date=%{x}", chart.y + "=%{y}"].concat(chart.hover.map((column, ii) => column + "=%{customdata[" + ii + "]}"));
+    const traces = Array.from(groups.entries()).map(([name, group], ii) => ({
+        type: "bar", name: String(name), x: group.x, y: group.y, text: group.text, customdata: group.customdata,
+        marker: {color: palette[ii % palette.length]},
+        hovertemplate: hover.join("<br>") + "<extra>" + name + "</extra>"
+    }));
+    Plotly.react("chart", traces, {
+        title: type + " " + chart.label,
+        barmode: "stack",
+        showlegend: true,
+        xaxis: {title: "Submitted Date (* - Date parsed from fastq file creation date)", rangeslider: {visible: true}},
+        yaxis: {title: chart.y}
+    });
+    statusSpan.textContent = "";
+}
+
+fillSelect(typeSelect, Object.keys(catalog.types), Object.keys(catalog.types)[0]);
+fillSelect(chartSelect, catalog.charts.map(chart => chart.label), catalog.charts.length ? catalog.charts[0].label : null);
+typeSelect.addEventListener("change", selectType);
+chartSelect.addEventListener("change", draw);
+fromSelect.addEventListener("change", draw);
+toSelect.addEventListener("change", draw);
+if (typeSelect.options.length) selectType();
+</script>
+</body>
+</html>
+"""
+
+
+def use_dashboard(settings:dict) -> bool:
+    """
+    Checks if report should write the dashboard instead of one html file per control type.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        bool: True if dashboard mode is on.
+    """
+    return 'dashboard' in settings and settings['dashboard']
+
+
+def get_dashboard_dir(settings:dict) -> Path:
+    """
+    Location of the dashboard in the output folder. Windowed reports get their own dashboard.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: dashboard folder.
+    """
+    return Path(settings['folder']['output']).joinpath(f"dashboard{get_window_suffix(settings)}")
+
+
+def get_dashboard_charts(settings:dict) -> list:
+    """
+    Lists the charts the dashboard can draw, matching the traces of the html reports.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        list: dicts of label, y column, colour column and hover columns.
+    """
+    charts = []
+    for mode in settings['modes']:
+        if mode == "contains" or mode == "matches":
+            charts.append(dict(label=mode, y=f"{mode}_ratio", color="target", hover=["genus", "name", f"{mode}_hashes"]))
+        else:
+            for entry in settings['modes'][mode]:
+                charts.append(dict(label=entry, y=entry, color="genus", hover=["genus", "name", "target"]))
+    return charts
+
+
+def write_if_changed(path:Path, data:bytes) -> bool:
+    """
+    Writes a file only if its contents differ, so unchanged files keep their timestamps and caches.
+
+    Args:
+        path (Path): file to write
+        data (bytes): new contents
+
+    Returns:
+        bool: True if the file was written.
+    """
+    if path.exists() and path.read_bytes() == data:
+        return False
+    temp_path = path.with_name(f".tmp{path.name}")
+    temp_path.write_bytes(data)
+    temp_path.replace(path)
+    return True
+
+
+def make_data_script(data:dict) -> bytes:
+    """
+    Wraps a dictionary as compact JSON in a call the dashboard page answers, so it can be loaded with a script tag.
+
+    Args:
+        data (dict): data of one control type and period
+
+    Returns:
+        bytes: javascript
+    """
+    return f"dashboardData({json.dumps(data, separators=(',', ':'), default=str)});\n".encode("utf-8")
+
+
+def write_dashboard_data(settings:dict, df:pd.DataFrame, group_name:str) -> list:
+    """
+    Writes a control type's chart data as one column oriented data script per year.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (pd.DataFrame): dataframe containing all sample data for the group.
+        group_name (str): controltype
+
+    Returns:
+        list: periods written for the control type.
+    """
+    # Each period is loaded separately, so there's no need to bin old controls.
+    df = prepare_chart_df(settings=settings, df=df, aggregate=False)
+    charts = get_dashboard_charts(settings=settings)
+    for mode in settings['modes']:
+        if mode == "contains" or mode == "matches":
+            df[f'{mode}_ratio'] = pd.to_numeric(df[f'{mode}_ratio'], errors='coerce')
+        else:
+            df = recalculate_percent(df=df, mode=mode)
+    wanted = ["submitted_date", "genera"]
+    for chart in charts:
+        wanted += [chart['y'], chart['color']] + chart['hover']
+    columns = [column for column in dict.fromkeys(wanted) if column in df.columns]
+    df = df[columns].astype(object).where(df[columns].notnull(), None)
+    type_dir = get_dashboard_dir(settings=settings).joinpath("data", group_name)
+    type_dir.mkdir(parents=True, exist_ok=True)
+    periods = df['submitted_date'].astype(str).str[:4]
+    written = []
+    for period, rows in df.groupby(periods, sort=True):
+        data = dict(controltype=group_name, period=period, columns=rows.to_dict(orient="list"))
+        if write_if_changed(type_dir.joinpath(f"{period}.js"), make_data_script(data)):
+            logger.debug(f"Wrote dashboard data for {group_name} {period}.")
+        else:
+            logger.debug(f"Dashboard data for {group_name} {period} unchanged.")
+        written.append(period)
+    # Periods that no longer have controls, eg. after archiving, are dropped, as are gzipped files of older runs.
+    for item in list(type_dir.glob("*.js")) + list(type_dir.glob("*.json.gz")):
+        if item.suffix != ".js" or item.stem not in written:
+            logger.debug(f"Removing stale dashboard data {item}")
+            item.unlink()
+    return written
+
+
+def write_dashboard_index(settings:dict) -> Path:
+    """
+    Writes the dashboard page with a catalog of the data files present.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: path to index.html
+    """
+    dashboard_dir = get_dashboard_dir(settings=settings)
+    data_dir = dashboard_dir.joinpath("data")
+    types = {}
+    if data_dir.exists():
+        for type_dir in sorted(item for item in data_dir.iterdir() if item.is_dir()):
+            periods = sorted(item.stem for item in type_dir.glob("*.js"))
+            if periods:
+                types[type_dir.name] = periods
+    catalog = dict(types=types, charts=get_dashboard_charts(settings=settings))
+    if get_html_setting(settings=settings, key="plotlyjs", default="cdn") == "local":
+        plotlyjs = f'<script src="../{get_plotlyjs_path(settings=settings).name}"></script>'
+    else:
+        plotlyjs = f'<script src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js"></script>'
+    dashboard_dir.mkdir(parents=True, exist_ok=True)
+    index_path = dashboard_dir.joinpath("index.html")
+    html = dashboard_template.replace("__PLOTLYJS__", plotlyjs).replace("__CATALOG__", json.dumps(catalog))
+    if write_if_changed(index_path, html.encode("utf-8")):
+        logger.info(f"Wrote dashboard to {index_path}")
+    return index_path
@@ -1,18 +1,24 @@
 import difflib
 import json
+import re
+from datetime import date, datetime
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, engine
+from sqlalchemy import create_engine, engine, func, text
 from models import *
 from pathlib import Path
 import logging
 from .misc import parse_date
+from .codec_functions import decode_results
 
 
 logger = logging.getLogger("controls.tools.db_functions")
 
+# Engines are reused per database path, so long running commands like watch don't pay for a new pool each call.
+engines = {}
+
 def make_engine(settings:dict={}):
     """
-    Create engine from db path in settings
+    Create engine from db path in settings, or reuse the one already made for it.
 
     Args:
         settings (dict): settings passed down from click. Defaults to {}.
@@ -23,8 +29,31 @@ def make_engine(settings:dict={}):
         logger.warning(f"Database path not found in settings! Using default path.")
         db_path = Path(__file__).parent.parent.parent.absolute().joinpath("controls.db").__str__()
     logger.debug(f"db_path={db_path}")
-    engine = create_engine(f"sqlite:///{db_path}")
-    return engine
+    if db_path not in engines:
+        # Wait on locks held by other processes (eg. queue workers) rather than failing straight away.
+        engines[db_path] = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": 30})
+    return engines[db_path]
+
+
+def make_archive_engine(settings:dict={}, must_exist:bool=True):
+    """
+    Create engine for the archive database if one is configured.
+
+    Args:
+        settings (dict): settings passed down from click. Defaults to {}.
+        must_exist (bool, optional): only return an engine if the archive file has been created. Defaults to True.
+
+    Returns:
+        engine: archive engine or None
+    """
+    try:
+        archive_path = settings['archive']['db_path']
+    except (KeyError, TypeError):
+        return None
+    if archive_path == None or (must_exist and not Path(archive_path).exists()):
+        return None
+    logger.debug(f"archive_path={archive_path}")
+    return create_engine(f"sqlite:///{archive_path}")
 
 def get_all_Control_Sample_names(settings:dict={}, engine:engine=None) -> list:
     """
@@ -68,6 +97,25 @@ def get_all_Control_Sample_names_if_mode_not_empty(mode:str, settings:dict={}, e
     return samples
 
 
+def get_all_archived_Control_Sample_names(settings:dict={}) -> list:
+    """
+    Grabs all control sample names from the archive db. Archived controls are never parsed again.
+
+    Args:
+        settings (dict): settings passed down from click. Defaults to {}.
+
+    Returns:
+        list: names list
+    """
+    archive_engine = make_archive_engine(settings=settings)
+    if archive_engine == None:
+        return []
+    session = Session(archive_engine)
+    samples = [row[0] for row in session.query(Control.name).all()]
+    session.close()
+    return samples
+
+
 def get_all_Control_Types_names(settings:dict={}, engine:engine=None) -> list:
     """
     Grabs all control type names from db.
@@ -137,13 +185,17 @@ def get_control_type_by_id(type_id:int, settings:dict={}, engine:engine=None) ->
         return None
     return ct
 
-def add_control_to_db(control:Control, mode:str, settings:dict={}, engine:engine=None):
+def add_control_to_db(control:Control, mode:str, settings:dict={}, engine:engine=None) -> tuple:
     """
-    Write function for control object.
+    Write function for control object. Only the control is written, run_post_write_hooks then brings the
+    summaries, anomaly statistics and profile store up to date with it.
 
     Args:
         control (Control): Control object to add to db.
         settings (dict): settings passed down from click. Defaults to {}.
+
+    Returns:
+        tuple: id of the control written and the stored value of the mode before the write.
     """    
     if engine == None:
         session = Session(make_engine(settings=settings))
@@ -153,12 +205,213 @@ def add_control_to_db(control:Control, mode:str, settings:dict={}, engine:engine
     check = session.query(Control).filter_by(name=control.name).first()
     if check:
         logger.warning(f"Object {check} already exists in database. Running update.")
+        old_value = getattr(check, mode)
         setattr(check, mode, getattr(control, mode))
+        local_object = check
     else:
+        old_value = None
         local_object = session.merge(control)
         session.add(local_object)
+    # Flush so a new control has its parent_id before its control type is stamped.
+    session.flush()
+    bump_control_type_stamp(session=session, controltype_id=local_object.parent_id)
+    session.commit()
+    control_id = local_object.id
+    session.close()
+    return control_id, old_value
+
+
+def bump_control_type_stamp(session:Session, controltype_id:int):
+    """
+    Counts a write to one of a control type's controls, in the transaction of the write.
+
+    Args:
+        session (Session): session the control is being written in.
+        controltype_id (int): id of the control's type.
+    """
+    if controltype_id == None:
+        return
+    bumped = session.query(ControlTypeStamp).filter_by(controltype_id=controltype_id)\
+        .update({ControlTypeStamp.version: ControlTypeStamp.version + 1}, synchronize_session=False)
+    if not bumped:
+        session.add(ControlTypeStamp(controltype_id=controltype_id, version=1))
+
+
+def get_summary_metric(mode:str) -> str:
+    """
+    Result column of a mode that is totalled in the summary table.
+
+    Args:
+        mode (str): mode used by the main parser.
+
+    Returns:
+        str: column name
+    """
+    if mode == "contains" or mode == "matches":
+        return f"{mode}_ratio"
+    return f"{mode}_count"
+
+
+def summarize_results(results:dict, mode:str, targets:list) -> dict:
+    """
+    Totals one control's results for a mode by target and genus.
+
+    Args:
+        results (dict): decoded results of the mode.
+        mode (str): mode used by the main parser.
+        targets (list): target genera of the controltype.
+
+    Returns:
+        dict: totals keyed by (target, genus)
+    """
+    metric = get_summary_metric(mode)
+    if targets == None:
+        targets = []
+    summary = {}
+    for genus, values in results.items():
+        try:
+            value = float(values[metric])
+        except (KeyError, TypeError, ValueError):
+            continue
+        # Skip NaN
+        if value != value:
+            continue
+        # Asterisks only mark dates taken from fastq files.
+        genus = str(genus).rstrip("*")
+        target = "Target" if genus in targets else "Off-target"
+        summary[(target, genus)] = summary.get((target, genus), 0.0) + value
+    return summary
+
+
+def update_control_summaries(session:Session, controltype_id:int, submitted_date:date, mode:str, results:dict, targets:list, sign:int=1):
+    """
+    Adds (or with sign=-1, removes) one control's results to the summary rows of its date.
+
+    Args:
+        session (Session): session the control is being written in.
+        controltype_id (int): id of the control's type.
+        submitted_date (date): control's submitted date.
+        mode (str): mode used by the main parser.
+        results (dict): decoded results of the mode.
+        targets (list): target genera of the controltype.
+        sign (int, optional): 1 to add, -1 to remove. Defaults to 1.
+    """
+    if submitted_date == None or controltype_id == None:
+        return
+    try:
+        submitted_date = submitted_date.date()
+    except AttributeError:
+        pass
+    summary = summarize_results(results=results, mode=mode, targets=targets)
+    if not summary:
+        return
+    existing = {(row.target, row.genus): row for row in session.query(ControlSummary)\
+        .filter_by(controltype_id=controltype_id, submitted_date=submitted_date, mode=mode)}
+    for (target, genus), value in summary.items():
+        try:
+            row = existing[(target, genus)]
+        except KeyError:
+            if sign < 0:
+                continue
+            row = ControlSummary(controltype_id=controltype_id, submitted_date=submitted_date, mode=mode, target=target,
+                genus=genus, metric=get_summary_metric(mode), total=0.0, samples=0)
+            session.add(row)
+        row.total += sign * value
+        row.samples += sign
+        if row.samples <= 0:
+            session.delete(row)
+
+
+def refresh_control_summaries(session:Session, control:Control, mode:str, old_value:str=None):
+    """
+    Swaps a control's previous results for its new ones in the summary table.
+
+    Args:
+        session (Session): session the control is being written in.
+        control (Control): control just written.
+        mode (str): mode that was written.
+        old_value (str, optional): stored value of the mode before the write. Defaults to None.
+    """
+    if control.controltype == None:
+        logger.warning(f"{control.name} has no control type, not summarizing.")
+        return
+    targets = control.controltype.targets
+    if old_value != None:
+        update_control_summaries(session=session, controltype_id=control.parent_id, submitted_date=control.submitted_date,
+            mode=mode, results=decode_results(old_value), targets=targets, sign=-1)
+    try:
+        new_results = decode_results(getattr(control, mode))
+    except TypeError:
+        return
+    update_control_summaries(session=session, controltype_id=control.parent_id, submitted_date=control.submitted_date,
+        mode=mode, results=new_results, targets=targets)
+
+
+def rebuild_control_summaries(settings:dict, engine:engine=None) -> int:
+    """
+    Recreates the summary table from every control, archived ones included.
+
+    Args:
+        settings (dict): settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of summary rows written.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    session = Session(engine)
+    type_ids = {ct.name: ct.id for ct in session.query(ControlType).all()}
+    totals = {}
+    for record in get_control_records_by_control_types(list(type_ids.keys()), settings=settings, engine=engine):
+        if record['submitted_date'] == None:
+            continue
+        submitted_date = datetime.strptime(record['submitted_date'], "%Y-%m-%d").date()
+        for mode in settings['modes']:
+            summary = summarize_results(results=record[mode], mode=mode, targets=record['controltype']['targets'])
+            for (target, genus), value in summary.items():
+                key = (type_ids[record['controltype']['name']], submitted_date, mode, target, genus)
+                total, samples = totals.get(key, (0.0, 0))
+                totals[key] = (total + value, samples + 1)
+    session.query(ControlSummary).delete()
+    session.bulk_insert_mappings(ControlSummary, [dict(controltype_id=key[0], submitted_date=key[1], mode=key[2], target=key[3],
+        genus=key[4], metric=get_summary_metric(key[2]), total=value[0], samples=value[1]) for key, value in totals.items()])
     session.commit()
     session.close()
+    logger.info(f"Rebuilt {len(totals)} summary rows.")
+    return len(totals)
+
+
+def get_control_summaries(ct_type:str, settings:dict={}, engine:engine=None, mode:str=None, since:date=None, until:date=None) -> list:
+    """
+    Returns the per-date summary rows of a control type.
+
+    Args:
+        ct_type (str): Name of the control type.
+        settings (dict, optional): Settings passed down from click. Defaults to {}.
+        mode (str, optional): only return this mode. Defaults to None.
+        since (date, optional): Earliest submitted date to include. Defaults to None.
+        until (date, optional): Latest submitted date to include. Defaults to None.
+
+    Returns:
+        list: dictionaries of submitted_date, mode, target, genus, metric, total and samples.
+    """
+    if engine == None:
+        session = Session(make_engine(settings=settings))
+    else:
+        session = Session(engine)
+    query = session.query(ControlSummary).join(ControlType, ControlSummary.controltype_id == ControlType.id)\
+        .filter(ControlType.name == ct_type)
+    if mode != None:
+        query = query.filter(ControlSummary.mode == mode)
+    if since != None:
+        query = query.filter(ControlSummary.submitted_date >= since)
+    if until != None:
+        query = query.filter(ControlSummary.submitted_date <= until)
+    summaries = [dict(submitted_date=parse_date(row.submitted_date), mode=row.mode, target=row.target, genus=row.genus,
+        metric=row.metric, total=row.total, samples=row.samples) for row in query.order_by(ControlSummary.submitted_date)]
+    session.close()
+    return summaries
 
 
 def get_control_by_name(name:str, settings:dict={}, engine:engine=None) -> Control:
@@ -198,7 +451,7 @@ def convert_control_to_dict(control:Control, settings:dict={}, engine:engine=Non
     control = control.__dict__
     for mode in settings['modes']:
         try:
-            control[mode] = json.loads(control[mode])
+            control[mode] = decode_results(control[mode])
         except TypeError as e:
             logger.error(f"No values in {control[mode]} for {control['name']}")
             control[mode] = {}
@@ -237,6 +490,7 @@ def check_samples_against_database(settings:dict, mode:str, engine:engine=None)
     """    
     # check if mode column is empty.
     db_samples = get_all_Control_Sample_names_if_mode_not_empty(mode=mode, settings=settings, engine=engine)
+    db_samples += get_all_archived_Control_Sample_names(settings=settings)
     logger.debug(f"Checking against: {db_samples}")
     if 'test' in settings:
         samples_of_interest = [sample for sample in ['test1', 'test2', 'test3', 'test4', 'test5', 'test6'] if sample not in db_samples]
@@ -267,6 +521,198 @@ def get_all_samples_by_control_type(ct_type:str, settings:dict={}, engine:engine
     return thing.instances
 
 
+def get_control_records_by_control_types(ct_types:list, settings:dict={}, engine:engine=None, batch_size:int=1000, since:date=None, until:date=None):
+    """
+    Streams every control of the given control types as plain dictionaries using a single query.
+    The control type is joined in the query rather than fetched per control.
+    The archive database is only read if the requested window reaches back into it.
+
+    Args:
+        ct_types (list): Names of the control types.
+        settings (dict, optional): Settings passed down from click. Defaults to {}.
+        batch_size (int, optional): Rows fetched from the database at a time. Defaults to 1000.
+        since (date, optional): Earliest submitted date to include. Defaults to None (all history).
+        until (date, optional): Latest submitted date to include. Defaults to None.
+
+    Yields:
+        dict: name, submitted_date, controltype (name and targets) and decoded results for each mode.
+    """
+    archive_engine = make_archive_engine(settings=settings)
+    if archive_engine != None:
+        boundary = get_archive_boundary(archive_engine=archive_engine)
+        if boundary != None and (since == None or since <= boundary):
+            logger.debug(f"Window starting {since} reaches the archive (up to {boundary}), reading it first.")
+            yield from get_control_records_by_control_types(ct_types, settings={**settings, 'archive': None}, engine=archive_engine, batch_size=batch_size, since=since, until=until)
+    if engine == None:
+        session = Session(make_engine(settings=settings))
+    else:
+        session = Session(engine)
+    modes = list(settings['modes'].keys())
+    query = session.query(ControlType.name, ControlType.targets, Control.name, Control.submitted_date, *[getattr(Control, mode) for mode in modes])\
+        .select_from(Control).join(ControlType, Control.parent_id == ControlType.id)\
+        .filter(ControlType.name.in_(ct_types))
+    if since != None:
+        query = query.filter(func.date(Control.submitted_date) >= since.isoformat())
+    if until != None:
+        # Dates are stored as timestamps, so include the whole of the final day.
+        query = query.filter(func.date(Control.submitted_date) <= until.isoformat())
+    query = query.order_by(Control.id).yield_per(batch_size)
+    try:
+        for row in query:
+            record = dict(name=row[2], submitted_date=parse_date(row[3]), controltype=dict(name=row[0], targets=row[1]))
+            for mode, value in zip(modes, row[4:]):
+                try:
+                    record[mode] = decode_results(value)
+                except TypeError as e:
+                    logger.error(f"No values in {value} for {record['name']}")
+                    record[mode] = {}
+            yield record
+    finally:
+        session.close()
+
+
+def get_control_records_by_control_type(ct_type:str, settings:dict={}, engine:engine=None, batch_size:int=1000, since:date=None, until:date=None) -> list:
+    """
+    Returns all controls of a control type as plain dictionaries.
+
+    Args:
+        ct_type (str): Name of the control type.
+        settings (dict, optional): Settings passed down from click. Defaults to {}.
+        batch_size (int, optional): Rows fetched from the database at a time. Defaults to 1000.
+        since (date, optional): Earliest submitted date to include. Defaults to None (all history).
+        until (date, optional): Latest submitted date to include. Defaults to None.
+
+    Returns:
+        list: control dictionaries.
+    """
+    return list(get_control_records_by_control_types([ct_type], settings=settings, engine=engine, batch_size=batch_size, since=since, until=until))
+
+
+def get_archive_boundary(archive_engine:engine) -> date:
+    """
+    Latest submitted date held in the archive.
+
+    Args:
+        archive_engine (engine): engine of the archive database.
+
+    Returns:
+        date: latest archived date, None if the archive is empty.
+    """
+    session = Session(archive_engine)
+    latest = session.query(func.max(Control.submitted_date)).scalar()
+    session.close()
+    if latest == None:
+        return None
+    try:
+        return latest.date()
+    except AttributeError:
+        return latest
+
+
+def archive_controls(settings:dict, cutoff:date, engine:engine=None) -> int:
+    """
+    Moves controls submitted before the cutoff into the archive database, dropping their anomaly scores.
+    The archive is attached to the live database so the move happens in one transaction.
+
+    Args:
+        settings (dict): settings passed down from click.
+        cutoff (date): controls submitted before this date are archived.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of controls archived.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    archive_path = Path(settings['archive']['db_path']).absolute().__str__()
+    tables = [ControlType.__tablename__, Control.__tablename__]
+    with engine.connect() as connection:
+        connection.execute(text("ATTACH DATABASE :path AS archive"), {"path": archive_path})
+        try:
+            # Copy the live schema over verbatim so both files stay interchangeable.
+            existing = [row[0] for row in connection.execute(text("SELECT name FROM archive.sqlite_master WHERE type='table'"))]
+            for table in tables:
+                if table in existing:
+                    continue
+                logger.debug(f"Creating {table} in archive.")
+                for (kind, sql) in connection.execute(text("SELECT type, sql FROM main.sqlite_master WHERE tbl_name=:table AND sql IS NOT NULL ORDER BY type DESC"), {"table": table}).fetchall():
+                    if kind == "table":
+                        sql = re.sub(fr'^CREATE TABLE\s+"?{table}"?', f'CREATE TABLE archive."{table}"', sql)
+                    else:
+                        sql = re.sub(r'^(CREATE (?:UNIQUE )?INDEX\s+)"?(\w+)"?', r'\1archive."\2"', sql)
+                    connection.execute(text(sql))
+            columns = {}
+            for table in tables:
+                columns[table] = ", ".join([f'"{row[1]}"' for row in connection.execute(text(f'PRAGMA main.table_info("{table}")'))])
+            with connection.begin():
+                connection.execute(text(f'INSERT OR REPLACE INTO archive."{tables[0]}" ({columns[tables[0]]}) SELECT {columns[tables[0]]} FROM main."{tables[0]}"'))
+                result = connection.execute(text(f'INSERT INTO archive."{tables[1]}" ({columns[tables[1]]}) SELECT {columns[tables[1]]} FROM main."{tables[1]}" WHERE submitted_date < :cutoff'), {"cutoff": cutoff.isoformat()})
+                moved = result.rowcount
+                # Only live controls are scored, so the scores of the moved ones go with them.
+                connection.execute(text(f'DELETE FROM main."{ControlScore.__tablename__}" WHERE control_id IN '
+                    f'(SELECT id FROM main."{tables[1]}" WHERE submitted_date < :cutoff)'), {"cutoff": cutoff.isoformat()})
+                connection.execute(text(f'DELETE FROM main."{tables[1]}" WHERE submitted_date < :cutoff'), {"cutoff": cutoff.isoformat()})
+        finally:
+            connection.execute(text("DETACH DATABASE archive"))
+    logger.info(f"Archived {moved} controls submitted before {cutoff} to {archive_path}")
+    return moved
+
+
+def get_control_type_watermark(ct_type:str, settings:dict={}, engine:engine=None, since:date=None, until:date=None) -> dict:
+    """
+    Summarizes the current content of a control type so reports can tell if it changed, without reading its results.
+    New and archived controls show in the count and latest id and date of the window, archived ones included if the
+    window reaches back into the archive. Re-parses that change results in place show in the control type's
+    write stamp, bumped by add_control_to_db. Compacting rewrites results without writing controls, so it
+    leaves the watermark as it was.
+
+    Args:
+        ct_type (str): Name of the control type.
+        settings (dict, optional): Settings passed down from click. Defaults to {}.
+        since (date, optional): Earliest submitted date to include. Defaults to None (all history).
+        until (date, optional): Latest submitted date to include. Defaults to None.
+
+    Returns:
+        dict: max control id, last submitted date and row count of the window and the control type's write stamp.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    engines = [engine]
+    archive_engine = make_archive_engine(settings=settings)
+    if archive_engine != None:
+        boundary = get_archive_boundary(archive_engine=archive_engine)
+        if boundary != None and (since == None or since <= boundary):
+            engines.append(archive_engine)
+    max_id = None
+    last_date = None
+    count = 0
+    for item in engines:
+        session = Session(item)
+        query = session.query(func.count(Control.id), func.max(Control.id), func.max(Control.submitted_date))\
+            .join(ControlType, Control.parent_id == ControlType.id).filter(ControlType.name == ct_type)
+        if since != None:
+            query = query.filter(func.date(Control.submitted_date) >= since.isoformat())
+        if until != None:
+            query = query.filter(func.date(Control.submitted_date) <= until.isoformat())
+        rows, top_id, latest = query.one()
+        session.close()
+        count += rows
+        if top_id != None and (max_id == None or top_id > max_id):
+            max_id = top_id
+        if latest != None and (last_date == None or latest > last_date):
+            last_date = latest
+    session = Session(engine)
+    version = session.query(ControlTypeStamp.version).join(ControlType, ControlTypeStamp.controltype_id == ControlType.id)\
+        .filter(ControlType.name == ct_type).scalar()
+    session.close()
+    return dict(
+        max_id=max_id,
+        last_update=parse_date(last_date) if last_date != None else None,
+        count=count,
+        version=version if version != None else 0
+    )
+
+
 def create_control_types(settings:dict, engine:engine=None) -> None:
     """
     Creates control types based on config settings
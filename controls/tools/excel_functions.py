@@ -3,14 +3,16 @@ from pandas import DataFrame
 import logging
 from datetime import date
 from pathlib import Path
-from collections.abc import MutableMapping
-from numpy import array as npa
+import numpy as np
+import xlsxwriter
 from io import StringIO
-import re
+from .misc import get_window_suffix
 
 
 logger = logging.getLogger("controls.tools.excel_functions")
 
+tabular_formats = ["xlsx", "csv", "parquet", "feather"]
+
 
 
 def read_tsv(filein: str) -> str:
@@ -98,112 +100,168 @@ def get_date_from_access(sample_name:str, tblControls_path:str) -> date:
         return None
 
 
-def construct_df_from_json(settings:dict, group_name:str, group_in:dict, output_dir:str) -> dict:
+def construct_df_from_json(settings:dict, group_name:str, group_in:list, output_dir:str) -> dict:
     """
-    generates a flat list from all of the keys in each sample's contains or matches section
+    Builds one dataframe from all samples of a control type and writes it to xlsx.
 
     Args:
         settings (dict): settings passed down from click
         group_name (str): string denoting control type
-        group_in (dict): dictionary to be flattened
+        group_in (list): control dictionaries of the control type
         output_dir (str): Where we're storing the dictionary as an xlsx file. 
 
     Returns:
-        dict: _description_
+        dict: dataframe keyed by control type
     """    
-    # 
-    # logger.debug(f"Group in: {group_in}")
-    targets1 = group_in[0]['controltype']['targets']
+    try:
+        targets1 = group_in[0]['controltype']['targets']
+    except IndexError:
+        logger.warning(f"No controls found for {group_name}.")
+        targets1 = settings['control_types'][group_name]['targets']
+    if targets1 == None:
+        targets1 = []
     targets2 = [f"{target}*" for target in targets1]
     targets = [val for pair in zip(targets1, targets2) for val in pair]
-    for sample in group_in:
-        # All should already have the same controltype
-        try:
-            del sample['controltype']
-        except KeyError:
-            pass
-    # Flatten dictionary.
-    group_in = [flatten_dict(sample) for sample in group_in]
-    # logger.debug(f"Flattened dictionary: {group_in}")
     sorts = ['submitted_date', "target", "genus"]
     sorts[-1:-1] = [settings['modes'][mode][0] for mode in settings['modes']]
-    
     # Set descending for any columns that have "{mode}" in the header.
     ascending = [False if item.split("_")[0] in settings['modes'] or item == "target" else True for item in sorts]
     # logger.debug(f"Ascending: {list(zip(sorts, ascending))}")
-    # create and merge dataframes.
-    df = pd.concat(create_df_from_flattened_dict(settings=settings, flatteneds=group_in, targets=targets)) \
+    # Sort before blanking missing values so numeric columns still sort as numbers.
+    df = build_df_from_records(settings=settings, records=group_in, targets=targets) \
         .sort_values(by=sorts, ascending=ascending) \
-        .reset_index().drop("index",1)
-    # df = df.dropna()
+        .reset_index(drop=True).fillna("")
+    # Same rerun rule as the charts so both outputs show the same samples.
+    df = drop_reruns_from_df(settings=settings, df=df).reset_index(drop=True)
     if not "test" in settings:
-        logger.debug(f"Writing to: {Path(output_dir).joinpath(group_name)}.xlsx")
-        df.to_excel(f"{Path(output_dir).joinpath(group_name)}.xlsx", engine="openpyxl")
+        write_tabular_outputs(settings=settings, df=df, group_name=group_name, output_dir=output_dir)
     return {group_name: df}
 
 
-def create_df_from_flattened_dict(settings:dict, flatteneds:list, targets:list) -> list:
+def get_report_formats(settings:dict) -> list:
     """
-    Generate list of dataframes from a list of dictionaries containing all samples of a controltype. 
+    Tabular formats the report should be written in.
 
     Args:
-        flatteneds (list): sample dictionaries
-        targets (list): the targets of the parent controltype
+        settings (dict): settings passed down from click
 
     Returns:
-        list: 
-    """    
-    dfs = []
-    for item in flatteneds:
-        df = DataFrame()
-        
-        logger.debug(f"Item we're trying to DFify: {item['submitted_date']}")
-        my_date = item.pop("submitted_date")
-        my_name = item.pop("name")
-        # logger.debug(item)
-        df['genus'] = [genus.replace("contains.", "").replace(".contains_hashes", "") for genus in item if ".contains_hashes" in genus]
-        df['submitted_date'] = my_date
-        df['name'] = my_name
-        df['target'] = df['genus'].apply(lambda x: "Target" if x in targets else "Off-target")    
-        columns = ['name', 'submitted_date', 'genus', 'target']
-        for mode in settings['modes']:
-            for col in settings['modes'][mode]:
-                df[col] = pd.Series(npa([item[genus] for genus in item if col in genus]))
-                # df[f'{mode}_hashes'] = pd.Series(npa([item[genus] for genus in item if f"{mode}_hashes" in genus]))
-        columns[-1:-1] = [item for sublist in [settings['modes'][mode] for mode in settings['modes']] for item in sublist]
-        df = df[columns].fillna("")
-        df.drop(df[(df.genus == "") | (df.genus == "NaN")].index, inplace=True)
-        dfs.append(df)
-    return dfs
+        list: formats, defaults to xlsx only.
+    """
+    if 'formats' in settings and settings['formats']:
+        return list(settings['formats'])
+    return ["xlsx"]
+
+
+def write_tabular_outputs(settings:dict, df:DataFrame, group_name:str, output_dir:str):
+    """
+    Writes a control type's dataframe in each requested tabular format.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (DataFrame): dataframe of the control type
+        group_name (str): string denoting control type
+        output_dir (str): folder the files are written to.
+    """
+    for file_format in get_report_formats(settings=settings):
+        out_path = Path(output_dir).joinpath(f"{group_name}{get_window_suffix(settings)}.{file_format}")
+        logger.debug(f"Writing to: {out_path}")
+        if file_format == "xlsx":
+            max_rows = settings['xlsx_max_rows'] if 'xlsx_max_rows' in settings else None
+            write_xlsx_streaming(df=df, out_path=out_path, max_rows=max_rows)
+        elif file_format == "csv":
+            df.to_csv(out_path, index=False)
+        elif file_format in ["parquet", "feather"]:
+            # Blanks were only added for the spreadsheet, columnar formats need real types.
+            typed = df.replace({"": np.nan}).infer_objects()
+            try:
+                if file_format == "parquet":
+                    typed.to_parquet(out_path, index=False)
+                else:
+                    typed.to_feather(out_path)
+            except ImportError as e:
+                logger.error(f"Couldn't write {out_path}, pyarrow is required for {file_format}: {e}")
+        else:
+            logger.error(f"Unknown output format {file_format}, skipping.")
 
 
-def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str ='.') -> MutableMapping:
+def write_xlsx_streaming(df:DataFrame, out_path:Path, max_rows:int=None):
+    """
+    Writes dataframe to xlsx row by row in constant memory, continuing on a new sheet past max_rows.
+
+    Args:
+        df (DataFrame): dataframe to be written
+        out_path (Path): xlsx file path
+        max_rows (int, optional): data rows per sheet. Defaults to None (Excel's limit).
     """
-    Flatten a dictionary to a single level, merging keys.
+    if max_rows == None or max_rows < 1:
+        # Excel's row limit, less the header.
+        max_rows = 1048575
+    # Index written in the first column, as to_excel did.
+    header = [""] + list(df.columns)
+    workbook = xlsxwriter.Workbook(out_path.__str__(), {'constant_memory': True, 'nan_inf_to_errors': True})
+    worksheet = None
+    for ii, row in enumerate(df.itertuples(index=True, name=None)):
+        if ii % max_rows == 0:
+            worksheet = workbook.add_worksheet(f"Sheet{ii // max_rows + 1}")
+            worksheet.write_row(0, 0, header)
+        worksheet.write_row(ii % max_rows + 1, 0, row)
+    if worksheet == None:
+        worksheet = workbook.add_worksheet("Sheet1")
+        worksheet.write_row(0, 0, header)
+    workbook.close()
+
+
+def build_df_from_records(settings:dict, records:list, targets:list) -> DataFrame:
+    """
+    Generates a single dataframe with one row per sample and genus from control dictionaries.
+    Each sample's results are walked once, filling column lists that become the dataframe.
 
     Args:
-        d (MutableMapping): input dictionary
-        parent_key (str, optional): _description_. Defaults to ''.
-        sep (str, optional): character to seperate keys when merging. Defaults to '.'.
+        settings (dict): settings passed down from click
+        records (list): control dictionaries with decoded results for each mode
+        targets (list): the targets of the parent controltype
 
     Returns:
-        MutableMapping: output dictionary.
+        DataFrame: name, submitted_date, genus, mode columns and target.
     """    
-    items = []
-    for k, v in d.items():
-        # logger.debug(f"Attempting flatten with {k} as key and {v} as value.")
-        try:
-            new_key = parent_key + sep + k if parent_key else k
-        except TypeError as e:
-            logger.error("Got None as key, skipping...")
-            continue
-        # logger.debug(f"Flattening dict using new key: {new_key}")
-        if isinstance(v, MutableMapping):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    # logger.debug(f"Here is the list of flattened dict: {items}")
-    return dict(items)
+    mode_columns = [col for mode in settings['modes'] for col in settings['modes'][mode]]
+    names = []
+    dates = []
+    genera = []
+    values = {col: [] for col in mode_columns}
+    for record in records:
+        # Genera already given a row for this sample, with the row's position.
+        rows = {}
+        for mode in settings['modes']:
+            try:
+                results = record[mode]
+            except KeyError:
+                continue
+            if not results:
+                continue
+            for genus, entry in results.items():
+                if genus == None or genus == "" or genus == "NaN":
+                    continue
+                try:
+                    position = rows[genus]
+                except KeyError:
+                    position = rows[genus] = len(genera)
+                    names.append(record['name'])
+                    dates.append(record['submitted_date'])
+                    genera.append(genus)
+                    for col in mode_columns:
+                        values[col].append(np.nan)
+                for col in settings['modes'][mode]:
+                    try:
+                        values[col][position] = entry[col]
+                    except (KeyError, TypeError):
+                        pass
+    df = DataFrame({'name': names, 'submitted_date': dates, 'genus': genera, **values})
+    df['target'] = np.where(df['genus'].isin(targets), "Target", "Off-target")
+    columns = ['name', 'submitted_date', 'genus', 'target']
+    columns[-1:-1] = mode_columns
+    return df[columns]
 
 
 def get_unique_values_in_df_column(df: DataFrame, column_name: str) -> list:
@@ -223,6 +281,9 @@ def get_unique_values_in_df_column(df: DataFrame, column_name: str) -> list:
 def drop_reruns_from_df(settings:dict, df: DataFrame) -> DataFrame:
     """
     Removes semi-duplicates from dataframe after finding sequencing repeats.
+    Every run of a sample shares a base name (the name with the rerun regex removed) and only
+    the latest run of each base name is kept. Reruns beat the original, later reruns beat earlier ones, going by
+    the number in the rerun suffix (so -R10 beats -R2), then by name.
 
     Args:
         settings (dict): settings passed down from click
@@ -231,16 +292,18 @@ def drop_reruns_from_df(settings:dict, df: DataFrame) -> DataFrame:
     Returns:
         DataFrame: dataframe with originals removed in favour of repeats.
     """    
-    sample_names = get_unique_values_in_df_column(df, column_name="name")
-    if 'rerun_regex' in settings:
-        logger.debug(f"Compiling regex from: {settings['rerun_regex']}")
-        rerun_regex = re.compile(fr"{settings['rerun_regex']}")
-        for sample in sample_names:
-            logger.debug(f'Running search on {sample}')
-            if rerun_regex.search(sample):
-                logger.debug(f'Match on {sample}')
-                first_run = re.sub(rerun_regex, "", sample)
-                logger.debug(f"First run: {first_run}")
-                df = df.drop(df[df.name == first_run].index)
+    if not 'rerun_regex' in settings or settings['rerun_regex'] == None or df.empty:
         return df
-
+    logger.debug(f"Resolving reruns with regex: {settings['rerun_regex']}")
+    names = pd.Series(df['name'].unique())
+    bases = names.str.replace(settings['rerun_regex'], "", regex=True)
+    # Number in the text the regex matched, a rerun without one counting as the first. The regex is wrapped in a
+    # group of its own so groups inside it (eg. '(-R)\d') don't cut the match short.
+    matched = names.str.extract(f"({settings['rerun_regex']})", expand=True)[0]
+    number = matched.str.extract(r"(\d+)", expand=False)
+    runs = DataFrame({'name': names, 'base': bases, 'rerun': bases != names,
+        'number': pd.to_numeric(number).fillna(1)}) \
+        .sort_values(by=['base', 'rerun', 'number', 'name'])
+    latest = runs.drop_duplicates(subset='base', keep='last')['name']
+    logger.debug(f"Dropping superseded runs: {sorted(set(names) - set(latest))}")
+    return df[df['name'].isin(latest)]
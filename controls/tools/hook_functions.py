@@ -0,0 +1,94 @@
+import logging
+from sqlalchemy.orm import Session
+from sqlalchemy import engine
+from models import Control
+from .db_functions import make_engine, refresh_control_summaries
+from .anomaly_functions import update_control_statistics, mark_control_statistics_stale
+from .profile_functions import add_control_profile, mark_profile_store_stale
+from .codec_functions import decode_results
+from .misc import parse_date
+
+
+logger = logging.getLogger("controls.tools.hook_functions")
+
+
+def run_post_write_hooks(settings:dict, control_id:int, mode:str, old_value:str=None, engine:engine=None):
+    """
+    Brings the summaries, anomaly statistics and profile store up to date with a control add_control_to_db
+    has just written. Each runs in its own transaction, so one failing neither undoes the write nor stops the
+    others. A failure is logged and, where there's a marker for it, marked for its rebuild command.
+
+    Args:
+        settings (dict): settings passed down from click.
+        control_id (int): id of the control written.
+        mode (str): mode that was written.
+        old_value (str, optional): stored value of the mode before the write. Defaults to None.
+        engine (engine, optional): engine used. Defaults to None.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    refresh_summaries_hook(settings=settings, control_id=control_id, mode=mode, old_value=old_value, engine=engine)
+    update_statistics_hook(settings=settings, control_id=control_id, mode=mode, engine=engine)
+    add_profile_hook(settings=settings, control_id=control_id, mode=mode, engine=engine)
+
+
+def refresh_summaries_hook(settings:dict, control_id:int, mode:str, old_value:str, engine:engine):
+    """
+    Swaps the control's previous results for its new ones in the summary table.
+    """
+    session = Session(engine)
+    try:
+        control = session.query(Control).filter_by(id=control_id).first()
+        refresh_control_summaries(session=session, control=control, mode=mode, old_value=old_value)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Couldn't update the summaries for control {control_id} {mode}: {e}. Run rebuild-summaries.")
+    finally:
+        session.close()
+
+
+def update_statistics_hook(settings:dict, control_id:int, mode:str, engine:engine):
+    """
+    Scores the control and folds it into its control type's statistics, marking them stale if that fails.
+    """
+    session = Session(engine)
+    try:
+        control = session.query(Control).filter_by(id=control_id).first()
+        update_control_statistics(session=session, control=control, mode=mode, settings=settings)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Couldn't score control {control_id} {mode}: {e}. Its statistics will be rebuilt before alerts are listed.")
+        try:
+            control = session.query(Control).filter_by(id=control_id).first()
+            if control != None and control.parent_id != None:
+                mark_control_statistics_stale(session=session, controltype_id=control.parent_id, mode=mode)
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Couldn't mark the statistics of control {control_id} {mode} stale: {e}. Run rebuild-anomalies.")
+    finally:
+        session.close()
+
+
+def add_profile_hook(settings:dict, control_id:int, mode:str, engine:engine):
+    """
+    Appends the control's results to the profile store, marking the store stale if that fails.
+    """
+    session = Session(engine)
+    try:
+        control = session.query(Control).filter_by(id=control_id).first()
+        if control.controltype == None:
+            return
+        try:
+            results = decode_results(getattr(control, mode))
+        except TypeError:
+            results = {}
+        add_control_profile(settings=settings, name=control.name, controltype=control.controltype.name,
+            submitted_date=parse_date(control.submitted_date), mode=mode, results=results)
+    except Exception as e:
+        logger.error(f"Couldn't add control {control_id} {mode} to the profile store: {e}")
+        mark_profile_store_stale(settings=settings, reason=f"control {control_id} {mode} not added: {e}")
+    finally:
+        session.close()
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger("controls.tools.lease_functions")
+
+
+def read_lease(path:Path) -> dict:
+    """
+    Reads a lease file.
+
+    Args:
+        path (Path): lease file
+
+    Returns:
+        dict: node, pid, token and expires of the lease, None if it's missing or unreadable.
+    """
+    try:
+        with open(path.__str__(), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_lease_file(path:Path, lease:dict, exclusive:bool=False) -> bool:
+    """
+    Writes a lease file, either creating it exclusively or atomically replacing it.
+
+    Args:
+        path (Path): lease file
+        lease (dict): lease contents
+        exclusive (bool, optional): fail if the file already exists. Defaults to False.
+
+    Returns:
+        bool: False if exclusive and the file already existed.
+    """
+    data = json.dumps(lease).encode("utf-8")
+    if exclusive:
+        try:
+            fd = os.open(path.__str__(), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o664)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
+    temp_path = path.with_name(f".tmp{path.name}.{uuid.uuid4().hex}")
+    with open(temp_path.__str__(), "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path.__str__(), path.__str__())
+    return True
+
+
+def acquire_lease(lease_dir:Path, key:str, node:str, ttl:float) -> dict:
+    """
+    Tries to take the lease on a key. An expired lease, left by a crashed node, is moved aside
+    with an atomic rename first, so only one node can reclaim it.
+
+    Args:
+        lease_dir (Path): shared folder holding the lease files.
+        key (str): what is being leased, eg. 'sample__mode'.
+        node (str): name of this node.
+        ttl (float): seconds the lease lasts without a heartbeat.
+
+    Returns:
+        dict: the lease (with its path) if taken, None if someone else holds it.
+    """
+    path = lease_dir.joinpath(f"{key}.lease")
+    lease = dict(key=key, node=node, host=socket.gethostname(), pid=os.getpid(), token=uuid.uuid4().hex, expires=time.time() + ttl)
+    if write_lease_file(path, lease, exclusive=True):
+        return {**lease, 'path': path.__str__()}
+    current = read_lease(path)
+    if current != None and current['expires'] > time.time():
+        return None
+    if current == None:
+        # Either it was released a moment ago or its holder is still writing it, try again next pass.
+        return None
+    stale_path = path.with_name(f"{path.name}.stale.{lease['token']}")
+    try:
+        os.rename(path.__str__(), stale_path.__str__())
+    except FileNotFoundError:
+        # Another node got there first.
+        return None
+    moved = read_lease(stale_path)
+    if moved == None or moved['token'] != current['token']:
+        # The lease was renewed or retaken between reading and renaming, put it back.
+        try:
+            os.link(stale_path.__str__(), path.__str__())
+        except FileExistsError:
+            pass
+        os.unlink(stale_path.__str__())
+        return None
+    os.unlink(stale_path.__str__())
+    logger.warning(f"Reclaimed expired lease {key} from node {current['node']}.")
+    if write_lease_file(path, lease, exclusive=True):
+        return {**lease, 'path': path.__str__()}
+    return None
+
+
+def renew_lease(lease:dict, ttl:float) -> bool:
+    """
+    Pushes back the expiry of a lease still held by this node.
+
+    Args:
+        lease (dict): lease as returned by acquire_lease
+        ttl (float): seconds the lease lasts from now.
+
+    Returns:
+        bool: False if the lease was lost to another node.
+    """
+    path = Path(lease['path'])
+    # Once expired the lease may be reclaimed at any moment, so writing it again could overwrite the new holder's.
+    if lease['expires'] <= time.time():
+        return False
+    current = read_lease(path)
+    if current == None or current['token'] != lease['token']:
+        return False
+    lease['expires'] = time.time() + ttl
+    write_lease_file(path, {key: value for key, value in lease.items() if key != 'path'})
+    return True
+
+
+def release_lease(lease:dict):
+    """
+    Gives up a lease if this node still holds it.
+
+    Args:
+        lease (dict): lease as returned by acquire_lease
+    """
+    path = Path(lease['path'])
+    current = read_lease(path)
+    if current != None and current['token'] == lease['token']:
+        try:
+            os.unlink(path.__str__())
+        except FileNotFoundError:
+            pass
+
+
+class LeaseKeeper(object):
+    """
+    Background thread renewing every lease this node holds. Leases it fails to renew are marked lost, which
+    the work done under them should check with holds before recording its result.
+    """
+    def __init__(self, ttl:float, heartbeat:float):
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.leases = {}
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lease-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            for lease in self.leases.values():
+                release_lease(lease)
+            self.leases = {}
+
+    def add(self, lease:dict):
+        with self.lock:
+            self.leases[lease['key']] = lease
+
+    def remove(self, lease:dict):
+        with self.lock:
+            self.leases.pop(lease['key'], None)
+            self.lost.discard(lease['token'])
+        release_lease(lease)
+
+    def holds(self, lease:dict) -> bool:
+        """
+        Checks a lease hasn't been lost, and hasn't expired in case the heartbeat fell behind.
+
+        Args:
+            lease (dict): lease as returned by acquire_lease
+
+        Returns:
+            bool: True if this node still holds the lease.
+        """
+        with self.lock:
+            return lease['token'] not in self.lost and lease['expires'] > time.time()
+
+    def run(self):
+        while not self.stopped.wait(self.heartbeat):
+            with self.lock:
+                for key, lease in list(self.leases.items()):
+                    try:
+                        renewed = renew_lease(lease, ttl=self.ttl)
+                    except OSError as e:
+                        logger.error(f"Couldn't renew lease {key}: {e}")
+                        continue
+                    if not renewed:
+                        logger.error(f"Lost lease {key} to another node.")
+                        self.lost.add(lease['token'])
+                        del self.leases[key]
+
+
+class StoreLock(object):
+    """
+    Exclusive lock on a store folder (profiles, mash sketches) while it is written to, or read from while
+    another process could be changing it.
+    """
+    def __init__(self, store:Path):
+        self.path = store.joinpath(".lock")
+
+    def __enter__(self):
+        self.handle = open(self.path.__str__(), "w")
+        if fcntl != None:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl != None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
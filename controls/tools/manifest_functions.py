@@ -0,0 +1,188 @@
+import json
+import hashlib
+import logging
+from pathlib import Path
+from datetime import datetime
+from .excel_functions import get_report_formats
+from .misc import get_window_suffix
+from .dashboard_functions import use_dashboard, get_dashboard_dir, dashboard_layout
+
+
+logger = logging.getLogger("controls.tools.manifest_functions")
+
+
+def get_manifest_path(settings:dict) -> Path:
+    """
+    Location of the report manifest in the output folder.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: path to the manifest file.
+    """
+    return Path(settings['folder']['output']).joinpath("__manifest.json")
+
+
+def read_report_manifest(settings:dict) -> dict:
+    """
+    Reads the manifest written by the previous report run.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        dict: manifest contents, empty if none exists or it can't be read.
+    """
+    manifest_path = get_manifest_path(settings=settings)
+    if not manifest_path.exists():
+        logger.debug(f"No manifest found at {manifest_path}.")
+        return {}
+    try:
+        with open(manifest_path.__str__(), "r") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Couldn't read manifest at {manifest_path}: {e}. Rebuilding everything.")
+        return {}
+
+
+def write_report_manifest(settings:dict, manifest:dict):
+    """
+    Writes the manifest to the output folder.
+
+    Args:
+        settings (dict): settings passed down from click
+        manifest (dict): manifest contents.
+    """
+    manifest_path = get_manifest_path(settings=settings)
+    logger.debug(f"Writing report manifest to {manifest_path}")
+    # Write to a temp file first so an interrupted run can't leave half a manifest behind.
+    temp_path = manifest_path.with_suffix(".tmp")
+    with open(temp_path.__str__(), "w") as f:
+        json.dump(manifest, f, indent=4)
+    temp_path.replace(manifest_path)
+
+
+def make_settings_fingerprint(settings:dict) -> str:
+    """
+    Hashes the settings that change report content so config edits invalidate old outputs.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        str: hex digest of relevant settings.
+    """
+    relevant = {
+        "modes": settings['modes'],
+        "control_types": {item: {key: value for key, value in settings['control_types'][item].items() if key != 'regex'} for item in settings['control_types']},
+        "rerun_regex": settings['rerun_regex'] if 'rerun_regex' in settings else None,
+        "xlsx_max_rows": settings['xlsx_max_rows'] if 'xlsx_max_rows' in settings else None,
+        "html": settings['html'] if 'html' in settings else None,
+        "dashboard": dashboard_layout if use_dashboard(settings=settings) else False
+    }
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_output_kinds(settings:dict) -> list:
+    """
+    Kinds of output a report run produces for each control type: tables, plus html or dashboard charts unless
+    the run is text only.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        list: names of the output kinds.
+    """
+    kinds = ["tables"]
+    if settings['text_only']:
+        pass
+    elif use_dashboard(settings=settings):
+        kinds.append("dashboard")
+    else:
+        kinds.append("html")
+    return kinds
+
+
+def get_expected_outputs(settings:dict, group_name:str) -> list:
+    """
+    Output files a report run is expected to produce for a control type.
+
+    Args:
+        settings (dict): settings passed down from click
+        group_name (str): controltype
+
+    Returns:
+        list: paths of expected output files.
+    """
+    output_dir = Path(settings['folder']['output'])
+    stem = f"{group_name}{get_window_suffix(settings)}"
+    kinds = get_output_kinds(settings=settings)
+    outputs = [output_dir.joinpath(f"{stem}.{file_format}") for file_format in get_report_formats(settings=settings)]
+    if "dashboard" in kinds:
+        outputs.append(get_dashboard_dir(settings=settings).joinpath("data", group_name))
+        outputs.append(get_dashboard_dir(settings=settings).joinpath("index.html"))
+    if "html" in kinds:
+        outputs.append(output_dir.joinpath(f"{stem}.html"))
+    return outputs
+
+
+def report_is_current(settings:dict, manifest:dict, group_name:str, watermark:dict) -> bool:
+    """
+    Checks if the outputs of a control type are up to date with the database.
+
+    Args:
+        settings (dict): settings passed down from click
+        manifest (dict): manifest from the previous run
+        group_name (str): controltype
+        watermark (dict): current content watermark of the controltype
+
+    Returns:
+        bool: True if nothing needs to be regenerated.
+    """
+    if manifest.get("settings") != make_settings_fingerprint(settings=settings):
+        logger.debug(f"Settings changed since last report, {group_name} is stale.")
+        return False
+    try:
+        previous = manifest['types'][f"{group_name}{get_window_suffix(settings)}"]
+    except KeyError:
+        logger.debug(f"{group_name} not in manifest.")
+        return False
+    if previous['watermark'] != watermark:
+        logger.debug(f"Watermark for {group_name} changed from {previous['watermark']} to {watermark}.")
+        return False
+    # Kinds the last regeneration skipped (eg. charts on a --text-only run) are as old as the files left behind.
+    skipped = [kind for kind in get_output_kinds(settings=settings) if kind not in previous.get('outputs', [])]
+    if skipped:
+        logger.debug(f"{group_name} was last generated without {skipped}.")
+        return False
+    missing = [item for item in get_expected_outputs(settings=settings, group_name=group_name) if not item.exists()]
+    if missing:
+        logger.debug(f"Outputs missing for {group_name}: {missing}")
+        return False
+    return True
+
+
+def update_report_manifest(settings:dict, manifest:dict, watermarks:dict) -> dict:
+    """
+    Records the watermarks and output kinds of freshly generated control types in the manifest.
+
+    Args:
+        settings (dict): settings passed down from click
+        manifest (dict): manifest from the previous run
+        watermarks (dict): watermarks of the regenerated control types, keyed by name.
+
+    Returns:
+        dict: updated manifest
+    """
+    fingerprint = make_settings_fingerprint(settings=settings)
+    if manifest.get("settings") != fingerprint:
+        # Entries made under old settings are no longer valid.
+        manifest = {"settings": fingerprint, "types": {}}
+    manifest.setdefault("types", {})
+    for group_name, watermark in watermarks.items():
+        manifest['types'][f"{group_name}{get_window_suffix(settings)}"] = dict(watermark=watermark,
+            outputs=get_output_kinds(settings=settings), generated=datetime.now().isoformat())
+    return manifest
+
@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import pandas as pd
+from io import StringIO
+from pathlib import Path
+from .subprocesses import run_mash_sketch, run_mash_dist, run_mash_paste
+from .subsample_functions import SubsampledInput, open_fastq, find_fastq_pair, get_subsample_config, write_subsample_sidecar
+from .lease_functions import StoreLock
+
+try:
+    from refseq_masher.const import MASH_REFSEQ_MSH, MASH_DIST_ORDERED_COLUMNS
+    from refseq_masher.mash.parser import parse_refseq_info
+    from refseq_masher.taxonomy import merge_ncbi_taxonomy_info
+    from refseq_masher.utils import order_output_columns
+except ImportError:
+    MASH_REFSEQ_MSH = None
+    merge_ncbi_taxonomy_info = None
+
+logger = logging.getLogger("controls.tools.mash_functions")
+
+# Bytes hashed from each end of an input file for its digest, so large fastqs aren't read in full.
+digest_block = 1 << 20
+
+
+def get_mash_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the mash section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['mash'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def get_sketch_dir(settings:dict) -> Path:
+    """
+    Location of the sketch store, mash sketch_dir or a folder beside the database.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: sketch store folder.
+    """
+    sketch_dir = get_mash_setting(settings, "sketch_dir")
+    if sketch_dir != None:
+        return Path(sketch_dir)
+    if 'db_path' in settings:
+        db_path = Path(settings['db_path'])
+    else:
+        db_path = Path(__file__).parent.parent.parent.absolute().joinpath("controls.db")
+    return db_path.parent.joinpath(f"{db_path.stem}_sketches")
+
+
+def get_reference_sketch(settings:dict) -> str:
+    """
+    RefSeq sketch to match samples against, mash reference_sketch or the one shipped with refseq_masher.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        str: path of the sketch, None if there isn't one.
+    """
+    reference = get_mash_setting(settings, "reference_sketch", MASH_REFSEQ_MSH)
+    if reference == None or not Path(reference).exists():
+        return None
+    return Path(reference).__str__()
+
+
+def get_sketch_params(settings:dict, mode:str) -> dict:
+    """
+    Parameters a sketch is made with. Sketches are only reused if all of them match.
+    The defaults are the ones refseq_masher matches sketches reads with, matching its RefSeq sketch (k=16, s=400).
+
+    Args:
+        settings (dict): settings passed down from click
+        mode (str): mode the sketch is for, which sets the subsampling.
+
+    Returns:
+        dict: kmer, sketch_size, min_copies and subsample.
+    """
+    subsample = get_subsample_config(settings, mode)
+    if subsample != None:
+        subsample = {key: value for key, value in subsample.items() if key != "temp_dir"}
+    return dict(kmer=int(get_mash_setting(settings, "kmer", 16)), sketch_size=int(get_mash_setting(settings, "sketch_size", 400)),
+        min_copies=int(get_mash_setting(settings, "min_copies", 8)), subsample=subsample)
+
+
+def digest_inputs(pair:tuple, params:dict) -> str:
+    """
+    Key of a sketch: the names, sizes, modification times and first and last MiB of the input files, and the
+    sketch parameters. Files rewritten in place get a new modification time, so a change in the middle of a file
+    isn't missed without reading it all.
+
+    Args:
+        pair (tuple): input fastq files
+        params (dict): as returned by get_sketch_params
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for item in pair:
+        item = Path(item)
+        stat = item.stat()
+        size = stat.st_size
+        digest.update(f"{item.name}\t{size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+        with open(item.__str__(), "rb") as f:
+            digest.update(f.read(digest_block))
+            if size > 2 * digest_block:
+                f.seek(-digest_block, os.SEEK_END)
+                digest.update(f.read(digest_block))
+    return digest.hexdigest()
+
+
+def read_sketch_index(store:Path) -> dict:
+    """
+    Reads the index of the sketch store.
+
+    Args:
+        store (Path): sketch store folder
+
+    Returns:
+        dict: sample, params, bytes, created, last_used and subsample of each sketch, keyed by digest.
+    """
+    index_path = store.joinpath("index.json")
+    if not index_path.exists():
+        return {}
+    with open(index_path.__str__(), "r") as f:
+        return json.load(f)
+
+
+def write_sketch_index(store:Path, index:dict):
+    """
+    Replaces the index of the sketch store.
+
+    Args:
+        store (Path): sketch store folder
+        index (dict): as returned by read_sketch_index
+    """
+    temp_path = store.joinpath(".tmpindex.json")
+    with open(temp_path.__str__(), "w") as f:
+        json.dump(index, f)
+    temp_path.replace(store.joinpath("index.json"))
+
+
+def evict_sketches(store:Path, index:dict, max_bytes:int, keep:str=None):
+    """
+    Removes the least recently used sketches until the store fits its size cap.
+
+    Args:
+        store (Path): sketch store folder
+        index (dict): as returned by read_sketch_index, updated in place.
+        max_bytes (int): size cap of the store
+        keep (str, optional): digest never evicted, eg. the sketch just made. Defaults to None.
+    """
+    total = sum(entry['bytes'] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]['last_used']):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        logger.debug(f"Evicting sketch of {index[key]['sample']} from the sketch store.")
+        sketch_path = store.joinpath(f"{key}.msh")
+        if sketch_path.exists():
+            sketch_path.unlink()
+        total -= index.pop(key)['bytes']
+
+
+def read_fastq_blocks(pair:tuple):
+    """
+    Decompressed bytes of a read pair, one file after the other.
+
+    Args:
+        pair (tuple): fastq files, plain or gzipped.
+
+    Yields:
+        bytes: blocks of fastq
+    """
+    for item in pair:
+        with open_fastq(Path(item)) as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                yield block
+
+
+def get_sample_sketch(settings:dict, folder:str, mode:str, copy_dir:Path, tsv_file:Path=None) -> Path:
+    """
+    Gets a sample's sketch from the store, making it first if the store doesn't have one for these inputs and parameters.
+    The sketch is copied out while the store is locked, as another process may evict it from the store at any time after.
+    A stored sketch's subsampling is written to the results sidecar as if the subsample had just been drawn, marked
+    as reused so the run isn't taken as a full analysis of the input by the cost model.
+
+    Args:
+        settings (dict): settings passed down from click
+        folder (str): sample folder
+        mode (str): mode the sketch is for
+        copy_dir (Path): folder the sketch is copied into.
+        tsv_file (Path, optional): results tsv the subsampling is recorded beside. Defaults to None.
+
+    Returns:
+        Path: copy of the sketch, None if it couldn't be made.
+    """
+    folder = Path(folder)
+    pair = find_fastq_pair(folder)
+    if pair == None:
+        logger.warning(f"No single read pair in {folder}, can't sketch it.")
+        return None
+    store = get_sketch_dir(settings)
+    store.mkdir(parents=True, exist_ok=True)
+    params = get_sketch_params(settings, mode)
+    key = digest_inputs(pair, params)
+    sketch_path = store.joinpath(f"{key}.msh")
+    copy_path = Path(copy_dir).joinpath(f"{key}.msh")
+    with StoreLock(store):
+        index = read_sketch_index(store)
+        if key in index and sketch_path.exists():
+            index[key]['last_used'] = time.time()
+            write_sketch_index(store, index)
+            entry = index[key]
+            shutil.copyfile(sketch_path.__str__(), copy_path.__str__())
+        else:
+            entry = None
+    if entry != None:
+        logger.debug(f"Reusing sketch of {folder.name} from the sketch store.")
+        if tsv_file != None:
+            subsample = entry['subsample'] if entry['subsample'] != None else dict(subsampled=False)
+            write_subsample_sidecar(tsv_file, {**subsample, 'sketch_reused': True})
+        return copy_path
+    # Sketched outside the lock, so other samples can be sketched meanwhile.
+    prefix = store.joinpath(f".tmp{key}.{os.getpid()}")
+    with SubsampledInput(settings=settings, folder=folder, mode=mode, tsv_file=tsv_file) as subsampled:
+        reads = subsampled.info['files'] if subsampled.temp_dir != None else pair
+        made = run_mash_sketch(get_mash_setting(settings, "bin", "mash"), read_fastq_blocks(reads), sample=folder.name,
+            prefix=prefix.__str__(), kmer=params['kmer'], sketch_size=params['sketch_size'], min_copies=params['min_copies'])
+        info = subsampled.info
+    temp_path = Path(f"{prefix}.msh")
+    if not made or not temp_path.exists():
+        return None
+    max_bytes = int(float(get_mash_setting(settings, "max_gb", 10)) * 1e9)
+    with StoreLock(store):
+        index = read_sketch_index(store)
+        temp_path.replace(sketch_path)
+        now = time.time()
+        index[key] = dict(sample=folder.name, params=params, bytes=sketch_path.stat().st_size, created=now, last_used=now,
+            subsample={item: value for item, value in info.items() if item != "files"} if info != None else None)
+        evict_sketches(store, index, max_bytes=max_bytes, keep=key)
+        write_sketch_index(store, index)
+        shutil.copyfile(sketch_path.__str__(), copy_path.__str__())
+    return copy_path
+
+
+def format_matches(dist_text:str, sample_name:str, top_n:int=5) -> pd.DataFrame:
+    """
+    Turns mash dist output against the RefSeq sketch into the table refseq_masher matches writes, closest first,
+    with the taxonomy from refseq_masher's NCBI metadata.
+
+    Args:
+        dist_text (str): output of mash dist
+        sample_name (str): name put in the sample column
+        top_n (int, optional): rows kept, 0 for all. Defaults to 5, as refseq_masher matches.
+
+    Returns:
+        DataFrame: matches table, None without refseq_masher's metadata.
+    """
+    if merge_ncbi_taxonomy_info == None:
+        logger.error("refseq_masher is needed for the taxonomy of mash matches.")
+        return None
+    df = pd.read_csv(StringIO(dist_text), sep="\t", header=None, names=["match_id", "query_id", "distance", "pvalue", "matching"])
+    df = df[["match_id", "distance", "pvalue", "matching"]].sort_values(by="distance")
+    df = pd.merge(pd.DataFrame([parse_refseq_info(match_id=match_id) for match_id in df.match_id]), df, on="match_id")
+    df['sample'] = sample_name
+    if top_n > 0:
+        df = df.head(top_n)
+    return order_output_columns(merge_ncbi_taxonomy_info(df), MASH_DIST_ORDERED_COLUMNS)
+
+
+def use_sketch_store(settings:dict) -> bool:
+    """
+    Checks the sketch store is turned on and mash is installed.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        bool: True if the store can be used.
+    """
+    if not get_mash_setting(settings, "sketch_store", False):
+        return False
+    if shutil.which(get_mash_setting(settings, "bin", "mash")) == None:
+        logger.warning("mash isn't on the PATH, not using the sketch store.")
+        return False
+    return True
+
+
+def run_mash_matches(settings:dict, folder:str, tsv_file:Path=None) -> pd.DataFrame:
+    """
+    Matches a sample against RefSeq with its stored sketch, in place of refseq_masher matches.
+    Reruns of a sample only pay for mash dist.
+
+    Args:
+        settings (dict): settings passed down from click
+        folder (str): sample folder
+        tsv_file (Path, optional): results tsv the subsampling is recorded beside. Defaults to None.
+
+    Returns:
+        DataFrame: matches table, None if the store can't be used, so refseq_masher is run instead.
+    """
+    if not use_sketch_store(settings):
+        return None
+    reference = get_reference_sketch(settings)
+    if reference == None:
+        logger.warning("No RefSeq reference sketch found, set mash reference_sketch in config.yml.")
+        return None
+    temp_dir = tempfile.mkdtemp(prefix="controls_matches_")
+    try:
+        sketch_path = get_sample_sketch(settings, folder=folder, mode="matches", copy_dir=Path(temp_dir), tsv_file=tsv_file)
+        if sketch_path == None:
+            return None
+        dist_text = run_mash_dist(get_mash_setting(settings, "bin", "mash"), reference, [sketch_path.__str__()],
+            threads=int(get_mash_setting(settings, "threads", 1)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if dist_text == None:
+        return None
+    return format_matches(dist_text, sample_name=Path(folder).name, top_n=int(get_mash_setting(settings, "top_n", 5)))
+
+
+def get_sample_distances(settings:dict, folders:list) -> list:
+    """
+    Mash distances between samples, from their stored sketches, sketching any that aren't stored yet.
+
+    Args:
+        settings (dict): settings passed down from click
+        folders (list): sample folders
+
+    Returns:
+        list: dicts of sample, other, distance, pvalue and shared for each pair of samples.
+    """
+    if not use_sketch_store(settings):
+        return []
+    mash_bin = get_mash_setting(settings, "bin", "mash")
+    temp_dir = tempfile.mkdtemp(prefix="controls_distances_")
+    try:
+        sketches = []
+        for folder in folders:
+            sketch_path = get_sample_sketch(settings, folder=folder, mode="matches", copy_dir=Path(temp_dir))
+            if sketch_path == None:
+                logger.error(f"Couldn't sketch {Path(folder).name}, leaving it out.")
+                continue
+            sketches.append(sketch_path.__str__())
+        if len(sketches) < 2:
+            return []
+        combined = Path(temp_dir).joinpath("combined")
+        if not run_mash_paste(mash_bin, combined.__str__(), sketches):
+            return []
+        dist_text = run_mash_dist(mash_bin, f"{combined}.msh", [f"{combined}.msh"], threads=int(get_mash_setting(settings, "threads", 1)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if dist_text == None:
+        return []
+    distances = []
+    for line in dist_text.splitlines():
+        fields = line.split("\t")
+        if len(fields) < 5 or fields[0] >= fields[1]:
+            continue
+        distances.append(dict(sample=fields[0], other=fields[1], distance=float(fields[2]), pvalue=float(fields[3]), shared=fields[4]))
+    return sorted(distances, key=lambda item: item['distance'])
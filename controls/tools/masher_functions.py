@@ -0,0 +1,343 @@
+import os
+import atexit
+import signal
+import logging
+import tempfile
+import multiprocessing
+import pandas as pd
+from pathlib import Path
+from time import perf_counter
+from .subprocesses import run_refseq_masher, run_refseq_masher_batch
+from .excel_functions import read_tsv_string
+from .misc import write_output
+from .schedule_functions import get_input_bytes, record_analysis_run
+from .subsample_functions import get_subsample_config
+from .mash_functions import use_sketch_store
+
+logger = logging.getLogger("controls.tools.masher_functions")
+
+# One worker per process that uses it, started on first use.
+workers = {}
+
+
+def get_masher_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the refseq_masher section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['refseq_masher'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def masher_worker_loop(connection, parent_connection):
+    """
+    Runs refseq_masher modes sent down the connection until it's closed, calling the functions its contains and
+    matches commands are made of with their defaults, so tables come back as DataFrames without an output file.
+    refseq_masher is imported once, and with it the NCBI taxonomy table its taxonomy module reads on import, which
+    every command would otherwise read again.
+    Each request is (mode, inputs, parallelism); the reply is ("ok", DataFrame), empty if nothing was found,
+    or ("error", message).
+
+    Args:
+        connection (Connection): worker end of the pipe.
+        parent_connection (Connection): other end, inherited through the fork and closed so the worker sees EOF.
+    """
+    parent_connection.close()
+    # Forked from workers and cluster nodes that catch SIGTERM to stop gracefully, which would keep terminate() from stopping it.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        import refseq_masher.mash.dist as mash_dist
+        import refseq_masher.mash.screen as mash_screen
+        from refseq_masher.const import MASH_DIST_ORDERED_COLUMNS, MASH_SCREEN_ORDERED_COLUMNS
+        from refseq_masher.taxonomy import merge_ncbi_taxonomy_info
+        from refseq_masher.utils import collect_inputs, order_output_columns
+    except ImportError as e:
+        connection.send(("error", f"Couldn't import refseq_masher: {e}"))
+        return
+    connection.send(("ready", None))
+    while True:
+        try:
+            mode, inputs, parallelism = connection.recv()
+        except EOFError:
+            break
+        try:
+            contigs, reads = collect_inputs([str(item) for item in inputs])
+            tables = []
+            if mode == "contains":
+                for paths, sample_name in contigs + reads:
+                    table = mash_screen.vs_refseq(inputs=paths, sample_name=sample_name, parallelism=parallelism)
+                    if table is not None:
+                        tables.append(table)
+                columns = MASH_SCREEN_ORDERED_COLUMNS
+            else:
+                # refseq_masher matches keeps the top 5 of each sample.
+                for path, sample_name in contigs:
+                    tables.append(mash_dist.fasta_vs_refseq(path, sample_name=sample_name, tmp_dir=tempfile.gettempdir()).head(5))
+                for paths, sample_name in reads:
+                    tables.append(mash_dist.fastq_vs_refseq(paths, sample_name=sample_name, tmp_dir=tempfile.gettempdir()).head(5))
+                columns = MASH_DIST_ORDERED_COLUMNS
+            if tables:
+                table = order_output_columns(merge_ncbi_taxonomy_info(pd.concat(tables)), columns)
+            else:
+                table = pd.DataFrame()
+            connection.send(("ok", table))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class MasherWorker(object):
+    """
+    Long lived process running refseq_masher as a library.
+    """
+    def __init__(self):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=masher_worker_loop, args=(worker_connection, self.connection), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        status, message = self.receive()
+        if status != "ready":
+            self.close()
+            raise RuntimeError(message)
+
+    def receive(self, timeout:float=None):
+        waited = 0.0
+        while not self.connection.poll(1):
+            waited += 1
+            if not self.process.is_alive():
+                raise RuntimeError("The refseq_masher worker died.")
+            if timeout != None and waited >= timeout:
+                self.close()
+                raise RuntimeError(f"The refseq_masher worker took more than {timeout}s.")
+        return self.connection.recv()
+
+    def run(self, mode:str, inputs:list, parallelism:int=1, timeout:float=None):
+        """
+        Runs one refseq_masher mode.
+
+        Args:
+            mode (str): 'contains' or 'matches'
+            inputs (list): folders or files to run on.
+            parallelism (int, optional): mash screen threads, for contains. Defaults to 1.
+            timeout (float, optional): seconds to wait before giving up on the worker. Defaults to None (no limit).
+
+        Returns:
+            DataFrame: the output table.
+        """
+        self.connection.send((mode, list(inputs), parallelism))
+        status, result = self.receive(timeout=timeout)
+        if status != "ok":
+            raise RuntimeError(result)
+        return result
+
+    def close(self):
+        self.connection.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def get_masher_worker() -> MasherWorker:
+    """
+    The refseq_masher worker of this process, started or restarted as needed.
+
+    Returns:
+        MasherWorker: worker
+    """
+    worker = workers.get(os.getpid(), None)
+    if worker == None or not worker.process.is_alive():
+        worker = MasherWorker()
+        workers[os.getpid()] = worker
+    return worker
+
+
+@atexit.register
+def close_masher_workers():
+    worker = workers.pop(os.getpid(), None)
+    if worker != None:
+        worker.close()
+
+
+def run_refseq_masher_inprocess(settings:dict, inputs:list, mode:str, parallelism:int=1):
+    """
+    Runs refseq_masher through the worker process.
+
+    Args:
+        settings (dict): settings passed down from click
+        inputs (list): folders or files to run on.
+        mode (str): 'contains' or 'matches'
+        parallelism (int, optional): mash screen threads, for contains. Defaults to 1.
+
+    Returns:
+        DataFrame: refseq_masher output table, None on error.
+    """
+    timeout = get_masher_setting(settings, "timeout", None)
+    try:
+        return get_masher_worker().run(mode, inputs=[str(item) for item in inputs], parallelism=parallelism,
+            timeout=float(timeout) if timeout != None else None)
+    except (RuntimeError, OSError, EOFError) as e:
+        logger.error(f"There was a problem running refseq_masher in process on {', '.join(str(item) for item in inputs)}: {e}")
+        return None
+
+
+def run_refseq_masher_backend(settings:dict, folder:str, mode:str):
+    """
+    Runs refseq_masher on a folder with the configured backend. The in process backend falls back to the
+    refseq_masher command if it fails.
+
+    Args:
+        settings (dict): settings passed down from click
+        folder (str): folder to run refseq masher on
+        mode (str): 'contains' or 'matches'
+
+    Returns:
+        DataFrame: refseq_masher output table, None on error.
+    """
+    if get_masher_setting(settings, "backend", "subprocess") == "inprocess":
+        table = run_refseq_masher_inprocess(settings, inputs=[folder], mode=mode)
+        if table is not None:
+            return table
+        logger.warning(f"Running the refseq_masher command for {folder} instead.")
+    out = run_refseq_masher(settings=settings, folder=folder, mode=mode)
+    if out == None:
+        return None
+    return read_tsv_string(out)
+
+
+def run_refseq_masher_chunk(settings:dict, folders:list, mode:str):
+    """
+    Runs refseq_masher once on several sample folders with the configured backend, and parallelism for contains.
+
+    Args:
+        settings (dict): settings passed down from click
+        folders (list): folders to run refseq masher on
+        mode (str): 'contains' or 'matches'
+
+    Returns:
+        DataFrame: combined output with a sample column, None on error.
+    """
+    parallelism = int(get_masher_setting(settings, "parallelism", 1))
+    if get_masher_setting(settings, "backend", "subprocess") == "inprocess":
+        table = run_refseq_masher_inprocess(settings, inputs=folders, mode=mode, parallelism=parallelism)
+        if table is not None:
+            return table
+    out = run_refseq_masher_batch(settings=settings, folders=folders, mode=mode, parallelism=parallelism)
+    if out == None:
+        return None
+    return read_tsv_string(out)
+
+
+def match_sample_label(label:str, folders:list) -> str:
+    """
+    Finds the folder a refseq_masher sample label came from: the folder of that name, or else the one folder
+    holding fastq files named after the label.
+
+    Args:
+        label (str): value of the sample column
+        folders (list): folders of the chunk
+
+    Returns:
+        str: folder, None if no single folder matches.
+    """
+    label = str(label)
+    for folder in folders:
+        if Path(folder).name == label:
+            return folder
+    found = [folder for folder in folders if any(item.name.startswith(label) for item in Path(folder).glob("*.fastq*"))]
+    if len(found) == 1:
+        return found[0]
+    return None
+
+
+def split_masher_table(table, folders:list) -> dict:
+    """
+    Splits a combined refseq_masher table into each folder's rows.
+
+    Args:
+        table (DataFrame): combined output with a sample column
+        folders (list): folders of the chunk
+
+    Returns:
+        dict: DataFrame keyed by folder. Folders without rows are left out if any label couldn't be matched,
+        as their rows may be under it; otherwise they get an empty table.
+    """
+    if len(table.columns) == 0:
+        raise ValueError("refseq_masher output was empty.")
+    if "sample" not in table.columns:
+        raise ValueError("refseq_masher output has no sample column.")
+    split = {}
+    unmatched = []
+    for label, rows in table.groupby("sample", sort=False):
+        folder = match_sample_label(label, folders)
+        if folder == None:
+            unmatched.append(label)
+            continue
+        split[folder] = rows if folder not in split else pd.concat([split[folder], rows])
+    if unmatched:
+        logger.warning(f"Couldn't tell which folder refseq_masher samples {unmatched} came from.")
+    else:
+        for folder in folders:
+            if folder not in split:
+                split[folder] = table.iloc[0:0]
+    return split
+
+
+def run_refseq_masher_batches(settings:dict, folders:list, mode:str, engine=None) -> int:
+    """
+    Runs refseq_masher on pending folders in chunks of refseq_masher batch_size, writing each folder's
+    {sample}_{mode}.tsv, which the per folder parse then reads instead of running refseq_masher again.
+    Folders of a failed chunk, or that can't be told apart in its output, are left to be run one by one.
+    Modes that are subsampled or use the sketch store are left to the per folder parse too.
+
+    Args:
+        settings (dict): settings passed down from click.
+        folders (list): pending sample folders, in the order they should be run.
+        mode (str): 'contains' or 'matches'
+        engine (engine, optional): engine run times are recorded with. Defaults to None.
+
+    Returns:
+        int: number of folders written.
+    """
+    batch_size = int(get_masher_setting(settings, "batch_size", 0))
+    if batch_size < 2 or mode not in ["contains", "matches"]:
+        return 0
+    if get_subsample_config(settings, mode) != None or (mode == "matches" and use_sketch_store(settings)):
+        return 0
+    pending = [folder for folder in folders if not Path(folder).joinpath(f"{Path(folder).name}_{mode}.tsv").exists()
+        and not Path(folder).joinpath(f"{mode}.tsv").exists()]
+    written = 0
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        logger.info(f"Running refseq_masher {mode} on {len(chunk)} folders at once.")
+        started = perf_counter()
+        table = run_refseq_masher_chunk(settings, folders=chunk, mode=mode)
+        seconds = perf_counter() - started
+        if table is None:
+            logger.error(f"The refseq_masher {mode} chunk failed, running its folders one by one.")
+            continue
+        try:
+            split = split_masher_table(table, chunk)
+        except ValueError as e:
+            logger.error(f"{e} Running the chunk's folders one by one.")
+            continue
+        sizes = {folder: get_input_bytes(folder) for folder in chunk}
+        total = sum(sizes.values())
+        for folder, rows in split.items():
+            write_output(Path(folder).joinpath(f"{Path(folder).name}_{mode}.tsv"), rows.to_csv(sep="\t", index=False))
+            # The chunk's run time is shared out by input size, so the cost model still learns per sample.
+            share = sizes[folder] / total if total > 0 else 1 / len(chunk)
+            record_analysis_run(settings=settings, sample=Path(folder).name, mode=mode, input_bytes=sizes[folder],
+                seconds=seconds * share, engine=engine)
+            written += 1
+    return written
@@ -212,6 +212,23 @@ def parse_date(in_date:date) -> str:
     except AttributeError as e:
         return None
 
+def get_window_suffix(settings:dict) -> str:
+    """
+    Suffix added to report file names when the report is limited to a date window.
+
+    Args:
+        settings (dict): Settings passed down from click.
+
+    Returns:
+        str: '_{since}_to_{until}', empty if no window was asked for.
+    """
+    since = settings['since'] if 'since' in settings else None
+    until = settings['until'] if 'until' in settings else None
+    if since == None and until == None:
+        return ""
+    return f"_{parse_date(since) or 'start'}_to_{parse_date(until) or 'latest'}"
+
+
 def divide_chunks(input_list:list, chunk_count:int):
     """
     Divides a list into {chunk_count} equal parts
@@ -0,0 +1,149 @@
+import json
+import gzip
+import logging
+from pathlib import Path
+from pandas import DataFrame
+from .misc import get_window_suffix
+
+
+logger = logging.getLogger("controls.tools.output_functions")
+
+
+def use_legacy_full_output(settings:dict) -> bool:
+    """
+    Whether the old nested __fulloutput.json layout was asked for.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        bool: True for the nested layout.
+    """
+    return 'legacy_json' in settings and settings['legacy_json']
+
+
+def get_full_output_path(settings:dict) -> Path:
+    """
+    Location of the combined output of all control types.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: __fulloutput.json for the legacy layout, otherwise __fulloutput.ndjson(.gz)
+    """
+    output_dir = Path(settings['folder']['output'])
+    stem = f"__fulloutput{get_window_suffix(settings)}"
+    if use_legacy_full_output(settings=settings):
+        return output_dir.joinpath(f"{stem}.json")
+    if 'gzip' in settings and settings['gzip']:
+        return output_dir.joinpath(f"{stem}.ndjson.gz")
+    return output_dir.joinpath(f"{stem}.ndjson")
+
+
+def open_full_output(path:Path, mode:str="r", compressed:bool=None):
+    """
+    Opens the full output, transparently handling gzip.
+
+    Args:
+        path (Path): file to open
+        mode (str, optional): 'r' or 'w'. Defaults to "r".
+        compressed (bool, optional): whether the file is gzipped. Defaults to None (if its name ends in .gz).
+
+    Returns:
+        file object in text mode.
+    """
+    if compressed == None:
+        compressed = path.name.endswith(".gz")
+    if compressed:
+        return gzip.open(path.__str__(), f"{mode}t", encoding="utf-8")
+    return open(path.__str__(), mode, encoding="utf-8")
+
+
+def read_previous_full_output(settings:dict) -> dict:
+    """
+    Reads the records of each control type from the last legacy __fulloutput.json so unchanged types can be carried over.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        dict: records keyed by controltype, empty if no previous output exists.
+    """
+    full_output = get_full_output_path(settings=settings)
+    if not full_output.exists():
+        return {}
+    try:
+        with open(full_output.__str__(), "r") as f:
+            previous = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Couldn't read previous full output: {e}")
+        return {}
+    return {key: item[key] for item in previous for key in item}
+
+
+def write_legacy_full_output(settings:dict, ct_types:list, frames:dict, previous_output:dict):
+    """
+    Writes __fulloutput.json as a nested list of {controltype: [records]}.
+
+    Args:
+        settings (dict): settings passed down from click
+        ct_types (list): all control types, in output order
+        frames (dict): dataframes of regenerated control types
+        previous_output (dict): records of control types not regenerated, from the last run
+    """
+    fresh = {key: json.loads(frames[key].to_json(orient="records")) for key in frames}
+    # Types left out of this run (e.g. by --type) keep their previous records.
+    ct_types = ct_types + [key for key in previous_output if key not in ct_types]
+    with open(get_full_output_path(settings=settings).__str__(), "w") as f:
+        json.dump([{ct_type: fresh[ct_type] if ct_type in fresh else previous_output[ct_type]} for ct_type in ct_types if ct_type in fresh or ct_type in previous_output], f, indent=4)
+
+
+def get_controltype_prefix(ct_type:str) -> str:
+    """
+    Start of every full output line of a control type, serialized as write_full_output does, so carried over lines
+    can be picked out without parsing them.
+
+    Args:
+        ct_type (str): controltype
+
+    Returns:
+        str: the line's opening brace and controltype field, up to the closing quote of its value.
+    """
+    return DataFrame({'controltype': [ct_type]}).to_json(orient="records", lines=True).strip()[:-1]
+
+
+def write_full_output(settings:dict, ct_types:list, frames:dict, chunk_size:int=10000):
+    """
+    Streams the full output as newline delimited JSON, one record per genus row tagged with its controltype.
+    Rows of every control type that wasn't regenerated are copied across from the previous file. The controltype
+    is the first field of each row, so rows are told apart by how the line starts rather than by parsing it.
+
+    Args:
+        settings (dict): settings passed down from click
+        ct_types (list): all control types
+        frames (dict): dataframes of regenerated control types
+        chunk_size (int, optional): rows serialized at a time. Defaults to 10000.
+    """
+    out_path = get_full_output_path(settings=settings)
+    # Written beside the old file and swapped in at the end, since carried rows are read from it.
+    temp_path = out_path.with_name(f".{out_path.name}.tmp")
+    logger.debug(f"Writing full output to {out_path}, regenerated: {list(frames.keys())}")
+    # The temp name doesn't end in .gz, so compress it as the file it replaces.
+    with open_full_output(temp_path, "w", compressed=out_path.name.endswith(".gz")) as f:
+        for ct_type in ct_types:
+            if ct_type not in frames:
+                continue
+            df = frames[ct_type]
+            for start in range(0, len(df), chunk_size):
+                chunk = df.iloc[start:start + chunk_size]
+                chunk = DataFrame({'controltype': ct_type}, index=chunk.index).join(chunk)
+                f.write(chunk.to_json(orient="records", lines=True).rstrip("\n"))
+                f.write("\n")
+        if out_path.exists():
+            regenerated = tuple(get_controltype_prefix(ct_type) for ct_type in frames)
+            with open_full_output(out_path, "r") as previous:
+                for line in previous:
+                    if not line.startswith(regenerated):
+                        f.write(line)
+    temp_path.replace(out_path)
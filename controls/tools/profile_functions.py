@@ -0,0 +1,319 @@
+import json
+import logging
+import numpy as np
+from pathlib import Path
+from .db_functions import make_engine, summarize_results, get_all_Control_Types_names, get_control_records_by_control_types
+from .lease_functions import StoreLock
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+
+logger = logging.getLogger("controls.tools.profile_functions")
+
+# Each append writes one control's vector for one mode. 'batch' is the file offset the append started at,
+# so when a mode is re-parsed only its latest batch is used. Columns index vocab.json, rows controls.tsv.
+triplet_dtype = np.dtype([("row", "<i4"), ("col", "<i4"), ("value", "<f4"), ("batch", "<i8")])
+
+
+def get_profile_store_path(settings:dict) -> Path:
+    """
+    Location of the profile store, similarity store_path or a folder beside the database.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: profile store folder.
+    """
+    try:
+        store_path = settings['similarity']['store_path']
+    except (KeyError, TypeError):
+        store_path = None
+    if store_path != None:
+        return Path(store_path)
+    if 'db_path' in settings:
+        db_path = Path(settings['db_path'])
+    else:
+        db_path = Path(__file__).parent.parent.parent.absolute().joinpath("controls.db")
+    return db_path.parent.joinpath(f"{db_path.stem}_profiles")
+
+
+def mark_profile_store_stale(settings:dict, reason:str):
+    """
+    Leaves a marker in the profile store saying it no longer matches the database, for rebuild-profiles to find.
+
+    Args:
+        settings (dict): settings passed down from click
+        reason (str): what went out of step, kept in the marker.
+    """
+    store = get_profile_store_path(settings=settings)
+    try:
+        store.mkdir(parents=True, exist_ok=True)
+        with open(store.joinpath("stale").__str__(), "a") as f:
+            f.write(f"{reason}\n")
+    except OSError as e:
+        logger.error(f"Couldn't mark the profile store at {store} stale ({reason}): {e}. Run rebuild-profiles.")
+
+
+def get_profile_store_stale(settings:dict) -> list:
+    """
+    Reasons the profile store was marked stale since it was last rebuilt.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        list: reasons, empty if the store is up to date.
+    """
+    try:
+        with open(get_profile_store_path(settings=settings).joinpath("stale").__str__(), "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def read_profile_vocab(store:Path) -> list:
+    """
+    Reads the shared vocabulary of 'mode:genus' features.
+
+    Args:
+        store (Path): profile store folder
+
+    Returns:
+        list: features, the position of each is its column.
+    """
+    vocab_path = store.joinpath("vocab.json")
+    if not vocab_path.exists():
+        return []
+    with open(vocab_path.__str__(), "r") as f:
+        return json.load(f)
+
+
+def read_profile_index(store:Path) -> list:
+    """
+    Reads the controls index of the profile store.
+
+    Args:
+        store (Path): profile store folder
+
+    Returns:
+        list: [name, controltype, submitted_date] of each control, the position of each is its row.
+    """
+    index_path = store.joinpath("controls.tsv")
+    if not index_path.exists():
+        return []
+    with open(index_path.__str__(), "r") as f:
+        return [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+
+def make_profile_vector(results:dict, mode:str) -> dict:
+    """
+    Turns one control's results for a mode into per genus values scaled to unit length,
+    so every mode weighs the same in the combined profile.
+    Refseq modes use the genus ratio, kraken modes the genus fraction of reads.
+
+    Args:
+        results (dict): decoded results of the mode.
+        mode (str): mode used by the main parser.
+
+    Returns:
+        dict: values keyed by 'mode:genus'.
+    """
+    summary = summarize_results(results=results, mode=mode, targets=[])
+    values = {f"{mode}:{genus}": value for (target, genus), value in summary.items() if value > 0}
+    norm = np.sqrt(sum(value ** 2 for value in values.values()))
+    if norm == 0:
+        return {}
+    return {feature: value / norm for feature, value in values.items()}
+
+
+def append_profiles(store:Path, profiles:list):
+    """
+    Appends control profiles to the store, growing the vocabulary and controls index as needed.
+
+    Args:
+        store (Path): profile store folder
+        profiles (list): dicts of name, controltype, submitted_date, mode and results.
+    """
+    store.mkdir(parents=True, exist_ok=True)
+    with StoreLock(store):
+        vocab = read_profile_vocab(store)
+        columns = {feature: ii for ii, feature in enumerate(vocab)}
+        rows = {entry[0]: ii for ii, entry in enumerate(read_profile_index(store))}
+        new_rows = []
+        triplets = []
+        triplet_path = store.joinpath("triplets.bin")
+        offset = triplet_path.stat().st_size // triplet_dtype.itemsize if triplet_path.exists() else 0
+        for profile in profiles:
+            vector = make_profile_vector(results=profile['results'], mode=profile['mode'])
+            if profile['name'] not in rows:
+                rows[profile['name']] = len(rows)
+                new_rows.append(f"{profile['name']}\t{profile['controltype']}\t{profile['submitted_date']}\n")
+            # '{mode}:' holds a zero marker, so a re-parse without results still replaces the mode's previous vector.
+            for feature in [f"{profile['mode']}:"] + list(vector):
+                if feature not in columns:
+                    columns[feature] = len(vocab)
+                    vocab.append(feature)
+            batch = offset + len(triplets)
+            triplets.append((rows[profile['name']], columns[f"{profile['mode']}:"], 0.0, batch))
+            for feature, value in vector.items():
+                triplets.append((rows[profile['name']], columns[feature], value, batch))
+        # Vocabulary first: triplets must never point at a column the vocabulary doesn't have yet.
+        temp_path = store.joinpath(".tmpvocab.json")
+        with open(temp_path.__str__(), "w") as f:
+            json.dump(vocab, f)
+        temp_path.replace(store.joinpath("vocab.json"))
+        with open(store.joinpath("controls.tsv").__str__(), "a") as f:
+            f.writelines(new_rows)
+        with open(triplet_path.__str__(), "ab") as f:
+            f.write(np.array(triplets, dtype=triplet_dtype).tobytes())
+
+
+def add_control_profile(settings:dict, name:str, controltype:str, submitted_date:str, mode:str, results:dict):
+    """
+    Appends one freshly parsed control's results for a mode to the profile store.
+    Problems with the store are logged and the store marked stale rather than raised, so they never stop a parse.
+
+    Args:
+        settings (dict): settings passed down from click
+        name (str): control name
+        controltype (str): control type name
+        submitted_date (str): submitted date as YYYY-MM-DD
+        mode (str): mode that was parsed
+        results (dict): decoded results of the mode.
+    """
+    try:
+        append_profiles(get_profile_store_path(settings=settings), [dict(name=name, controltype=controltype,
+            submitted_date=submitted_date, mode=mode, results=results)])
+    except (OSError, ValueError) as e:
+        logger.error(f"Couldn't add {name} {mode} to the profile store: {e}")
+        mark_profile_store_stale(settings=settings, reason=f"{name} {mode} not added: {e}")
+
+
+def load_profile_matrix(store:Path) -> tuple:
+    """
+    Loads the profile store as sparse triplets, keeping only the latest vector of each control and mode.
+
+    Args:
+        store (Path): profile store folder
+
+    Returns:
+        tuple: rows, cols and values arrays, the controls index and the vocabulary.
+    """
+    vocab = read_profile_vocab(store)
+    index = read_profile_index(store)
+    triplet_path = store.joinpath("triplets.bin")
+    if not triplet_path.exists() or not vocab:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0), index, vocab
+    triplets = np.fromfile(triplet_path.__str__(), dtype=triplet_dtype)
+    modes = sorted({feature.split(":", 1)[0] for feature in vocab})
+    mode_of_col = np.array([modes.index(feature.split(":", 1)[0]) for feature in vocab])
+    key = triplets['row'].astype(np.int64) * len(modes) + mode_of_col[triplets['col']]
+    latest = np.full(key.max() + 1, -1, dtype=np.int64)
+    np.maximum.at(latest, key, triplets['batch'])
+    triplets = triplets[(triplets['batch'] == latest[key]) & (triplets['value'] != 0)]
+    return triplets['row'].astype(np.int64), triplets['col'].astype(np.int64), triplets['value'].astype(np.float64), index, vocab
+
+
+def find_similar_controls(settings:dict, names:list, top_k:int=10, include_later:bool=False, ct_types:list=[]) -> dict:
+    """
+    Finds the controls with the most similar profiles by cosine similarity.
+    All the queried controls are scored in one sparse product.
+
+    Args:
+        settings (dict): settings passed down from click
+        names (list): names of the controls to find matches for.
+        top_k (int, optional): number of matches per control. Defaults to 10.
+        include_later (bool, optional): also match controls submitted after the queried control. Defaults to False.
+        ct_types (list, optional): only match these control types. Defaults to [] (all).
+
+    Returns:
+        dict: lists of dicts of name, controltype, submitted_date and similarity, best first, keyed by queried name.
+    """
+    if get_profile_store_stale(settings=settings):
+        logger.warning("The profile store is out of date with the database. Run rebuild-profiles.")
+    rows, cols, values, index, vocab = load_profile_matrix(get_profile_store_path(settings=settings))
+    positions = {entry[0]: ii for ii, entry in enumerate(index)}
+    found = {}
+    queries = []
+    for name in names:
+        if name not in positions:
+            logger.error(f"{name} isn't in the profile store. Run rebuild-profiles if it was parsed before profiles existed.")
+            found[name] = []
+        else:
+            queries.append(name)
+    if not queries:
+        return found
+    query_matrix = np.zeros((len(vocab), len(queries)))
+    for jj, name in enumerate(queries):
+        mask = rows == positions[name]
+        query_matrix[cols[mask], jj] = values[mask]
+    if sparse != None:
+        matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(index), len(vocab)))
+        scores = matrix.dot(query_matrix)
+    else:
+        # Same product without scipy: each stored value times the query's value of its column, summed per row.
+        scores = np.stack([np.bincount(rows, weights=values * query_matrix[cols, jj], minlength=len(index))
+            for jj in range(len(queries))], axis=1)
+    norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=len(index)))
+    query_norms = np.sqrt((query_matrix ** 2).sum(axis=0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = scores / (norms[:, None] * query_norms[None, :])
+    similarity[~np.isfinite(similarity)] = -1
+    dates = np.array([entry[2] for entry in index])
+    types = np.array([entry[1] for entry in index])
+    for jj, name in enumerate(queries):
+        candidate = np.ones(len(index), dtype=bool)
+        candidate[positions[name]] = False
+        if not include_later:
+            candidate &= dates <= dates[positions[name]]
+        if ct_types:
+            candidate &= np.isin(types, ct_types)
+        column = np.where(candidate, similarity[:, jj], -1)
+        top = np.argpartition(-column, min(top_k, len(column) - 1))[:top_k]
+        top = top[np.argsort(-column[top])]
+        found[name] = [dict(name=index[ii][0], controltype=index[ii][1], submitted_date=index[ii][2], similarity=float(column[ii]))
+            for ii in top if column[ii] > 0]
+    return {name: found[name] for name in names}
+
+
+def rebuild_profile_store(settings:dict, engine=None) -> int:
+    """
+    Recreates the profile store from the live controls, dropping replaced and archived ones.
+
+    Args:
+        settings (dict): settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        int: number of controls in the store.
+    """
+    if engine == None:
+        engine = make_engine(settings=settings)
+    store = get_profile_store_path(settings=settings)
+    store.mkdir(parents=True, exist_ok=True)
+    with StoreLock(store):
+        # Cleared first, so anything marking it stale while the rebuild runs is kept.
+        for item in ["stale", "vocab.json", "controls.tsv", "triplets.bin"]:
+            if store.joinpath(item).exists():
+                store.joinpath(item).unlink()
+    ct_types = get_all_Control_Types_names(settings=settings, engine=engine)
+    profiles = []
+    names = set()
+    for record in get_control_records_by_control_types(ct_types, settings={**settings, 'archive': None}, engine=engine):
+        names.add(record['name'])
+        for mode in settings['modes']:
+            if record[mode] != None:
+                profiles.append(dict(name=record['name'], controltype=record['controltype']['name'],
+                    submitted_date=record['submitted_date'], mode=mode, results=record[mode]))
+        # Append in batches to keep memory flat over large databases.
+        if len(profiles) >= 5000:
+            append_profiles(store, profiles)
+            profiles = []
+    if profiles:
+        append_profiles(store, profiles)
+    logger.info(f"Rebuilt profile store at {store} with {len(names)} controls.")
+    return len(names)
@@ -0,0 +1,168 @@
+import os
+import heapq
+import socket
+import logging
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from sqlalchemy.orm import Session
+from models import AnalysisRun
+from .db_functions import make_engine
+from .subsample_functions import get_subsample_config
+
+
+logger = logging.getLogger("controls.tools.schedule_functions")
+
+# Only the latest runs of each mode are fitted, so the model follows hardware and database changes.
+history_size = 500
+
+
+def get_input_bytes(folder:str) -> int:
+    """
+    Total size of a sample folder's fastq files, following links.
+
+    Args:
+        folder (str): sample folder
+
+    Returns:
+        int: bytes, 0 if the folder can't be read.
+    """
+    total = 0
+    try:
+        with os.scandir(Path(folder).__str__()) as entries:
+            for entry in entries:
+                if ".fastq" in entry.name:
+                    try:
+                        total += entry.stat().st_size
+                    except OSError:
+                        continue
+    except OSError:
+        return 0
+    return total
+
+
+def record_analysis_run(settings:dict, sample:str, mode:str, input_bytes:int, seconds:float, subsample:dict=None, engine=None):
+    """
+    Stores the run time of one analysis.
+
+    Args:
+        settings (dict): settings passed down from click.
+        sample (str): sample name
+        mode (str): mode run
+        input_bytes (int): size of the fastq files the analysis read
+        seconds (float): wall time of the analysis
+        subsample (dict, optional): subsampling of the input, as read from its sidecar. Defaults to None.
+        engine (engine, optional): engine used. Defaults to None.
+    """
+    if subsample == None:
+        subsample = dict(subsampled=False)
+    if engine == None:
+        session = Session(make_engine(settings=settings))
+    else:
+        session = Session(engine)
+    session.add(AnalysisRun(sample=sample, mode=mode, input_bytes=input_bytes, seconds=seconds,
+        node=socket.gethostname(), finished=datetime.now(), subsampled=subsample['subsampled'],
+        subsample_method=subsample.get('method', None), subsample_seed=str(subsample['seed']) if 'seed' in subsample else None,
+        reads_total=subsample.get('reads_total', None), reads_used=subsample.get('reads_used', None)))
+    session.commit()
+    session.close()
+
+
+def fit_cost_model(settings:dict, engine=None) -> dict:
+    """
+    Fits run time against input size for each mode with a straight line over the latest runs.
+    A mode whose runs are all the same size, or whose fit slopes downwards, uses its mean run time.
+
+    Args:
+        settings (dict): settings passed down from click.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        dict: (seconds per GB, fixed seconds, number of runs) keyed by mode.
+    """
+    if engine == None:
+        session = Session(make_engine(settings=settings))
+    else:
+        session = Session(engine)
+    model = {}
+    modes = [row[0] for row in session.query(AnalysisRun.mode).distinct()]
+    for mode in modes:
+        rows = session.query(AnalysisRun.input_bytes, AnalysisRun.seconds)\
+            .filter(AnalysisRun.mode == mode, AnalysisRun.seconds != None, AnalysisRun.input_bytes != None)\
+            .order_by(AnalysisRun.id.desc()).limit(history_size).all()
+        if not rows:
+            continue
+        sizes = np.array([row[0] for row in rows], dtype=float) / 1e9
+        seconds = np.array([row[1] for row in rows], dtype=float)
+        slope, intercept = 0.0, float(seconds.mean())
+        if len(np.unique(sizes)) > 1:
+            fit_slope, fit_intercept = np.polyfit(sizes, seconds, 1)
+            if fit_slope > 0:
+                slope, intercept = float(fit_slope), float(fit_intercept)
+        model[mode] = (slope, intercept, len(rows))
+        logger.debug(f"Cost model for {mode}: {slope:.1f}s/GB + {intercept:.1f}s from {len(rows)} runs.")
+    session.close()
+    return model
+
+
+def predict_seconds(model:dict, mode:str, input_bytes:int) -> float:
+    """
+    Predicts the run time of an analysis.
+
+    Args:
+        model (dict): as returned by fit_cost_model
+        mode (str): mode to run
+        input_bytes (int): size of the sample's fastq files
+
+    Returns:
+        float: seconds, None if the mode has no history.
+    """
+    if mode not in model:
+        return None
+    slope, intercept, count = model[mode]
+    return max(0.0, slope * input_bytes / 1e9 + intercept)
+
+
+def plan_longest_first(settings:dict, pending:list, engine=None) -> list:
+    """
+    Predicts the run time of pending analyses and orders them longest first, so the biggest samples
+    don't hold up the end of a run. Analyses with no history for their mode go last, largest first.
+
+    Args:
+        settings (dict): settings passed down from click.
+        pending (list): (folder, mode) of each pending analysis.
+        engine (engine, optional): engine used. Defaults to None.
+
+    Returns:
+        list: dicts of folder, sample, mode, input_bytes (expected to be read) and predicted (seconds or None).
+    """
+    model = fit_cost_model(settings=settings, engine=engine)
+    plan = []
+    for folder, mode in pending:
+        input_bytes = get_input_bytes(folder)
+        # Runs are fitted on the bytes the analysis read, so scale down modes subsampled by fraction.
+        config = get_subsample_config(settings, mode)
+        if config != None and config['max_reads'] == None:
+            input_bytes = int(input_bytes * config['fraction'])
+        plan.append(dict(folder=folder, sample=Path(folder).name, mode=mode, input_bytes=input_bytes,
+            predicted=predict_seconds(model, mode=mode, input_bytes=input_bytes)))
+    plan.sort(key=lambda item: (item['predicted'] != None, item['predicted'] or 0, item['input_bytes']), reverse=True)
+    return plan
+
+
+def estimate_makespan(predictions:list, workers:int=1) -> float:
+    """
+    Wall time of running the predictions in the given order on a number of workers, each job going to the
+    first worker free, as the queue does.
+
+    Args:
+        predictions (list): predicted seconds of each job, in run order.
+        workers (int, optional): number of parallel workers. Defaults to 1.
+
+    Returns:
+        float: seconds until the last job finishes.
+    """
+    loads = [0.0] * max(1, workers)
+    for seconds in predictions:
+        heapq.heappush(loads, heapq.heappop(loads) + seconds)
+    return max(loads)
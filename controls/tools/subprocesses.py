@@ -1,4 +1,4 @@
-from subprocess import check_output, CalledProcessError 
+from subprocess import check_output, CalledProcessError, Popen, PIPE, DEVNULL
 import logging
 import sys
 from pathlib import Path
@@ -34,12 +34,67 @@ def run_refseq_masher(settings:dict, folder:str, mode:str):
 #         except CalledProcessError as e:
 #                 logger.error(f"There was a problem running refseq_masher for {folder}: {e}.")
 
+def get_parallelism_args(mode:str, parallelism:int=1) -> list:
+    """
+    refseq_masher options for running a mode in parallel. Only contains takes --parallelism.
+
+    Args:
+        mode (str): 'contains' or 'matches'
+        parallelism (int, optional): mash threads. Defaults to 1.
+
+    Returns:
+        list: options to add after the mode.
+    """
+    if mode == "contains":
+        return ["--parallelism", str(parallelism)]
+    return []
+
+
+def make_refseq_masher_batch_command(settings:dict, folders:list, mode:str, parallelism:int=1) -> list:
+    """
+    Command running refseq_masher once on several sample folders.
+
+    Args:
+        settings (dict): the settings dictionary
+        folders (list): folders to run refseq masher on
+        mode (str): 'contains' or 'matches'
+        parallelism (int, optional): mash threads, for contains. Defaults to 1.
+
+    Returns:
+        list: command
+    """
+    command = ['refseq_masher']
+    if settings['verbose']:
+        command.append("--verbose")
+    return command + [mode] + get_parallelism_args(mode, parallelism) + [str(folder) for folder in folders]
+
+
+def run_refseq_masher_batch(settings:dict, folders:list, mode:str, parallelism:int=1):
+    """
+    Runs the refseq_masher command once on several sample folders.
+
+    Args:
+        settings (dict): the settings dictionary
+        folders (list): folders to run refseq masher on
+        mode (str): 'contains' or 'matches'
+        parallelism (int, optional): mash threads, for contains. Defaults to 1.
+
+    Returns:
+        bytes: combined output with a sample column, None on error.
+    """
+    command = make_refseq_masher_batch_command(settings, folders=folders, mode=mode, parallelism=parallelism)
+    logger.debug(f"Attempting refseq_masher on {len(folders)} folders...")
+    try:
+        return check_output(command)
+    except (CalledProcessError, OSError) as e:
+        logger.error(f"There was a problem running refseq_masher on {len(folders)} folders: {e}.")
+
+
 def run_kraken(settings:dict, folder:str, fastQ_pair:tuple, tsv_file:str="kraken.tsv"):
      logger.debug(f"Running Kraken2 on {fastQ_pair}")
      file1 = fastQ_pair[0]
      file2 = fastQ_pair[1]
-     try:
-        out = check_output(['kraken2', 
+     command = ['kraken2', 
                 '--db', 
                 settings['kraken2']['db_path'], 
                 "--paired", 
@@ -47,13 +102,93 @@ def run_kraken(settings:dict, folder:str, fastQ_pair:tuple, tsv_file:str="kraken
                 Path(folder).joinpath(tsv_file).absolute().__str__(), 
                 file1,
                 file2
-                ])
+                ]
+     # Memory mapping leaves the database in the page cache, so back to back runs (eg. from watch) skip reloading it.
+     if 'memory_mapping' in settings['kraken2'] and settings['kraken2']['memory_mapping']:
+        command.insert(3, "--memory-mapping")
+     try:
+        out = check_output(command)
         return out
      except CalledProcessError as e:
         logger.error(f"There was a problem running kraken for {folder}: {e}.")
 
 
 
+def run_mash_sketch(mash_bin:str, reads, sample:str, prefix:str, kmer:int=16, sketch_size:int=1000, min_copies:int=2) -> bool:
+    """
+    Sketches a sample's reads with mash, fed through stdin so a read pair becomes one sketch.
+
+    Args:
+        mash_bin (str): mash binary
+        reads (iterable): blocks of fastq bytes
+        sample (str): ID given to the sketch
+        prefix (str): output path without .msh
+        kmer (int, optional): k-mer size. Defaults to 16.
+        sketch_size (int, optional): hashes kept. Defaults to 1000.
+        min_copies (int, optional): copies of a k-mer needed to count it, filtering sequencing errors. Defaults to 2.
+
+    Returns:
+        bool: True if the sketch was written.
+    """
+    command = [mash_bin, "sketch", "-r", "-m", str(min_copies), "-k", str(kmer), "-s", str(sketch_size), "-I", sample, "-o", prefix, "-"]
+    logger.debug(f"Running {' '.join(command)}")
+    try:
+        process = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+    except OSError as e:
+        logger.error(f"Couldn't start mash: {e}.")
+        return False
+    try:
+        for block in reads:
+            process.stdin.write(block)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        logger.error(f"There was a problem running mash sketch for {sample}: {stderr.decode('utf-8', 'replace')}.")
+        return False
+    return True
+
+
+def run_mash_dist(mash_bin:str, reference:str, queries:list, threads:int=1) -> str:
+    """
+    Runs mash dist of query sketches against a reference sketch.
+
+    Args:
+        mash_bin (str): mash binary
+        reference (str): reference sketch
+        queries (list): query sketches
+        threads (int, optional): threads used. Defaults to 1.
+
+    Returns:
+        str: reference-ID, query-ID, distance, p-value and shared-hashes lines, None on error.
+    """
+    try:
+        return check_output([mash_bin, "dist", "-p", str(threads), reference] + list(queries)).decode("utf-8")
+    except (CalledProcessError, OSError) as e:
+        logger.error(f"There was a problem running mash dist against {reference}: {e}.")
+
+
+def run_mash_paste(mash_bin:str, prefix:str, sketches:list) -> bool:
+    """
+    Combines sketches into one file.
+
+    Args:
+        mash_bin (str): mash binary
+        prefix (str): output path without .msh
+        sketches (list): sketches to combine
+
+    Returns:
+        bool: True if the combined sketch was written.
+    """
+    try:
+        check_output([mash_bin, "paste", prefix] + list(sketches))
+        return True
+    except (CalledProcessError, OSError) as e:
+        logger.error(f"There was a problem running mash paste: {e}.")
+        return False
+
+
 def pull_from_irida(irida_settings:dict):
     """
     Runs commandline utility to pull samples from irida using settings found in config.yml
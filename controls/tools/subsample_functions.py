@@ -0,0 +1,269 @@
+import gzip
+import json
+import random
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from .misc import get_relevant_fastq_files
+
+
+logger = logging.getLogger("controls.tools.subsample_functions")
+
+gzip_magic = b"\x1f\x8b"
+
+
+def get_subsample_config(settings:dict, mode:str) -> dict:
+    """
+    Gets the subsampling of a mode from the subsample section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        mode (str): mode being run
+
+    Returns:
+        dict: max_reads, fraction, seed and temp_dir, None if the mode isn't subsampled.
+    """
+    try:
+        section = settings['subsample']
+        config = section[mode]
+    except (KeyError, TypeError):
+        return None
+    if config == None:
+        return None
+    max_reads = config.get('max_reads', None)
+    fraction = config.get('fraction', None)
+    if max_reads == None and fraction == None:
+        return None
+    if fraction != None and not 0 < float(fraction) <= 1:
+        logger.error(f"subsample {mode} fraction must be above 0 and at most 1, not subsampling.")
+        return None
+    return dict(max_reads=int(max_reads) if max_reads != None else None, fraction=float(fraction) if fraction != None else None,
+        seed=section.get('seed', 0) or 0, temp_dir=section.get('temp_dir', None))
+
+
+def open_fastq(path:Path):
+    """
+    Opens a fastq file for reading bytes, decompressing it if it's gzipped, whatever its name.
+
+    Args:
+        path (Path): fastq file
+
+    Returns:
+        file object
+    """
+    with open(path.__str__(), "rb") as f:
+        magic = f.read(2)
+    if magic == gzip_magic:
+        return gzip.open(path.__str__(), "rb")
+    return open(path.__str__(), "rb", buffering=1 << 20)
+
+
+def count_fastq_records(path:Path) -> int:
+    """
+    Counts the reads of a fastq file by counting lines in large blocks.
+
+    Args:
+        path (Path): fastq file
+
+    Returns:
+        int: number of reads
+    """
+    lines = 0
+    last = b"\n"
+    with open_fastq(path) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            lines += block.count(b"\n")
+            last = block[-1:]
+    # A final record without a trailing newline.
+    if last != b"\n":
+        lines += 1
+    return lines // 4
+
+
+def find_fastq_pair(folder:Path) -> tuple:
+    """
+    Finds the read pair of a sample folder, plain or gzipped.
+
+    Args:
+        folder (Path): sample folder
+
+    Returns:
+        tuple: the two fastq files in read order, None if there isn't one pair.
+    """
+    gzipped = sorted(folder.glob("*.fastq.gz"))
+    if len(gzipped) == 2 and not list(folder.glob("*.fastq")):
+        return tuple(gzipped)
+    pair = get_relevant_fastq_files(folder)
+    if pair == None or len(pair) != 2:
+        return None
+    return tuple(sorted(Path(item) for item in pair))
+
+
+def subsample_pair(pair:tuple, out_dir:Path, sample:str, max_reads:int=None, fraction:float=None, seed=0) -> dict:
+    """
+    Streams a read pair and writes a subsample of it, keeping mates together.
+    With max_reads the pairs are counted first, then a seeded uniform sample of their positions is kept, so only the
+    positions are held in memory. Otherwise each pair is kept with probability fraction. max_reads takes precedence.
+    The generator is seeded with the seed and sample name, so reruns of a sample keep the same reads.
+
+    Args:
+        pair (tuple): the two fastq files, plain or gzipped.
+        out_dir (Path): folder for the subsampled (uncompressed) files.
+        sample (str): sample name
+        max_reads (int, optional): number of pairs to keep. Defaults to None.
+        fraction (float, optional): fraction of pairs to keep. Defaults to None.
+        seed (optional): seed of the sampling. Defaults to 0.
+
+    Returns:
+        dict: subsampled (bool), method, seed, reads_total, reads_used, bytes_used and files.
+    """
+    rng = random.Random(f"{seed}:{sample}")
+    if max_reads != None:
+        method = "max_reads"
+        reads_total = count_fastq_records(pair[0])
+        if reads_total <= max_reads:
+            return dict(subsampled=False, method=method, seed=seed, reads_total=reads_total, reads_used=reads_total, bytes_used=None, files=list(pair))
+        keep = iter(sorted(rng.sample(range(reads_total), max_reads)))
+        keep_fn = None
+    else:
+        method = "fraction"
+        reads_total = None
+        keep = None
+        keep_fn = lambda: rng.random() < fraction
+    out_files = [out_dir.joinpath(Path(item).name.replace(".gz", "")) for item in pair]
+    next_keep = next(keep) if keep != None else None
+    count = 0
+    used = 0
+    with open_fastq(pair[0]) as in1, open_fastq(pair[1]) as in2, open(out_files[0].__str__(), "wb", buffering=1 << 20) as out1, open(out_files[1].__str__(), "wb", buffering=1 << 20) as out2:
+        for header1 in in1:
+            record1 = header1 + in1.readline() + in1.readline() + in1.readline()
+            record2 = in2.readline() + in2.readline() + in2.readline() + in2.readline()
+            if not record2:
+                raise ValueError(f"{pair[1]} has fewer reads than {pair[0]}.")
+            if keep != None:
+                selected = count == next_keep
+                if selected:
+                    next_keep = next(keep, None)
+            else:
+                selected = keep_fn()
+            if selected:
+                out1.write(record1)
+                out2.write(record2)
+                used += 1
+            count += 1
+            if keep != None and next_keep == None:
+                break
+        if keep == None and in2.readline():
+            raise ValueError(f"{pair[1]} has more reads than {pair[0]}.")
+    return dict(subsampled=True, method=method, seed=seed, reads_total=reads_total if reads_total != None else count,
+        reads_used=used, bytes_used=sum(item.stat().st_size for item in out_files), files=[item.__str__() for item in out_files])
+
+
+def get_subsample_sidecar_path(tsv_file:Path) -> Path:
+    """
+    Sidecar beside a results tsv recording how its input was subsampled.
+
+    Args:
+        tsv_file (Path): results tsv
+
+    Returns:
+        Path: sidecar json
+    """
+    tsv_file = Path(tsv_file)
+    return tsv_file.with_name(f"{tsv_file.stem}.subsample.json")
+
+
+def read_subsample_sidecar(tsv_file:Path) -> dict:
+    """
+    Reads the subsampling recorded beside a results tsv.
+
+    Args:
+        tsv_file (Path): results tsv
+
+    Returns:
+        dict: as written by SubsampledInput, None if the results weren't subsampled.
+    """
+    try:
+        with open(get_subsample_sidecar_path(tsv_file).__str__(), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_subsample_sidecar(tsv_file:Path, info:dict):
+    """
+    Records beside a results tsv how its input was subsampled.
+
+    Args:
+        tsv_file (Path): results tsv
+        info (dict): as returned by subsample_pair
+    """
+    with open(get_subsample_sidecar_path(tsv_file).__str__(), "w") as f:
+        json.dump({key: value for key, value in info.items() if key != "files"}, f)
+
+
+class SubsampledInput(object):
+    """
+    Input of one analysis: the sample folder and its read pair, or a temporary subsample of them if the mode is set
+    to be subsampled. The subsample is recorded in a sidecar beside the results tsv, if given, and removed on exit.
+    """
+    def __init__(self, settings:dict, folder:str, mode:str, tsv_file:Path=None):
+        self.settings = settings
+        self.folder = Path(folder)
+        self.mode = mode
+        self.tsv_file = Path(tsv_file) if tsv_file != None else None
+        self.temp_dir = None
+        self.info = None
+
+    def __enter__(self):
+        if self.tsv_file != None and get_subsample_sidecar_path(self.tsv_file).exists():
+            get_subsample_sidecar_path(self.tsv_file).unlink()
+        config = get_subsample_config(self.settings, self.mode)
+        if config == None:
+            return self
+        pair = find_fastq_pair(self.folder)
+        if pair == None:
+            logger.warning(f"No single read pair in {self.folder}, running {self.mode} on all of it.")
+            return self
+        self.temp_dir = Path(tempfile.mkdtemp(prefix=f"{self.folder.name}_{self.mode}_", dir=config['temp_dir']))
+        try:
+            self.info = subsample_pair(pair, out_dir=self.temp_dir, sample=self.folder.name, max_reads=config['max_reads'],
+                fraction=config['fraction'], seed=config['seed'])
+        except (OSError, ValueError, EOFError) as e:
+            logger.error(f"Couldn't subsample {self.folder.name} for {self.mode}, running on all reads: {e}")
+            self.cleanup()
+            return self
+        if not self.info['subsampled']:
+            self.cleanup()
+        else:
+            logger.debug(f"Subsampled {self.folder.name} for {self.mode}: {self.info['reads_used']} of {self.info['reads_total']} pairs.")
+        if self.tsv_file != None:
+            write_subsample_sidecar(self.tsv_file, self.info)
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def cleanup(self):
+        if self.temp_dir != None:
+            shutil.rmtree(self.temp_dir.__str__(), ignore_errors=True)
+            self.temp_dir = None
+
+    @property
+    def input_folder(self) -> Path:
+        """
+        Folder to run refseq_masher on.
+        """
+        if self.temp_dir != None:
+            return self.temp_dir
+        return self.folder
+
+    @property
+    def pair(self) -> tuple:
+        """
+        Read pair to run kraken2 on.
+        """
+        if self.temp_dir != None:
+            return tuple(self.info['files'])
+        return get_relevant_fastq_files(self.folder)
@@ -1,7 +1,10 @@
 import plotly.express as px
 import pandas as pd
+import numpy as np
 from pathlib import Path
-from plotly.graph_objects import Figure
+from plotly.graph_objects import Figure, Bar
+from plotly.offline import get_plotlyjs
+from .misc import get_window_suffix
 import logging
 
 logger = logging.getLogger("controls.tools.vis_functions")
@@ -19,9 +22,38 @@ def create_charts(settings:dict, df:pd.DataFrame, group_name:str) -> list:
     Returns:
         Figure: _description_
     """    
+    figs = []
+    df = prepare_chart_df(settings=settings, df=df)
+    run_ref = True
+    for mode in settings['modes']:
+        if mode == "contains" or mode == "matches":
+            if run_ref == True:
+                func = function_map["construct_refseq_chart"]
+                run_ref = False
+            else:
+                continue
+        else:
+            func = function_map[f"construct_{mode}_chart"]
+        fig = func(settings=settings, df=df, group_name=group_name, mode=mode)
+        figs.append(fig)
+    return figs
+    
+
+
+def prepare_chart_df(settings:dict, df:pd.DataFrame, aggregate:bool=True) -> pd.DataFrame:
+    """
+    Cleans up a control type's dataframe for charting: marks date parsed genera, drops reruns and sorts for stacking.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (pd.DataFrame): input dataframe
+        aggregate (bool, optional): bin old controls as set in html aggregate_after_days. Defaults to True.
+
+    Returns:
+        pd.DataFrame: dataframe ready for the chart constructors.
+    """
     from .excel_functions import get_unique_values_in_df_column, drop_reruns_from_df
     genera = []
-    figs = []
     for item in df['genus'].to_list():
         try:
             if item[-1] == "*":
@@ -34,35 +66,179 @@ def create_charts(settings:dict, df:pd.DataFrame, group_name:str) -> list:
     df['genera'] = genera
     df = df.dropna()
     df = drop_reruns_from_df(settings=settings, df=df)
+    if aggregate:
+        df = aggregate_old_data(settings=settings, df=df)
     sorts = ['submitted_date', "target", "genus"]
     sorts[-1:-1] = [settings['modes'][mode][0] for mode in settings['modes']]
     # Set descending for any columns that have "{mode}" in the header.
     ascending = [False if item.split("_")[0] in settings['modes'] or item == "target" else True for item in sorts]
     df = df.sort_values(by=sorts, ascending=ascending)
     logger.debug(f"Unique names: {get_unique_values_in_df_column(df, column_name='name')}")
-    run_ref = True
-    for mode in settings['modes']:
-        if mode == "contains" or mode == "matches":
-            if run_ref == True:
-                func = function_map["construct_refseq_chart"]
-                run_ref = False
-            else:
-                continue
-        else:
-            func = function_map[f"construct_{mode}_chart"]
-        fig = func(settings=settings, df=df, group_name=group_name, mode=mode)
-        figs.append(fig)
-    return figs
-    
+    return df
 
 
-def generic_figure_markers(fig:Figure, modes:list=[]) -> Figure:
+def recalculate_percent(df:pd.DataFrame, mode:str) -> pd.DataFrame:
+    """
+    Recalculates a kraken mode's percent column from its counts on each submitted date.
+
+    Args:
+        df (pd.DataFrame): dataframe containing all sample data for the group.
+        mode (str): kraken mode
+
+    Returns:
+        pd.DataFrame: dataframe with numeric count and recalculated percent columns.
+    """
+    df[f'{mode}_count'] = pd.to_numeric(df[f'{mode}_count'],errors='coerce')
+    # The actual percentage from kraken was off due to exclusion of NaN, recalculating.
+    df[f'{mode}_percent'] = 100 * df[f'{mode}_count'] / df.groupby('submitted_date')[f'{mode}_count'].transform('sum')
+    return df
+
+
+def get_plotlyjs_path(settings:dict) -> Path:
+    """
+    Writes one local copy of plotly.js to the output folder if there isn't one yet.
+
+    Args:
+        settings (dict): settings passed down from click
+
+    Returns:
+        Path: path to plotly.min.js
+    """
+    plotlyjs_path = Path(settings['folder']['output']).joinpath("plotly.min.js")
+    if not plotlyjs_path.exists():
+        logger.debug(f"Writing plotly.js to {plotlyjs_path}")
+        with open(plotlyjs_path, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+    return plotlyjs_path
+
+
+def get_html_setting(settings:dict, key:str, default=None):
+    """
+    Gets an option from the html section of the settings.
+
+    Args:
+        settings (dict): settings passed down from click
+        key (str): option name
+        default (optional): value if the option isn't set. Defaults to None.
+
+    Returns:
+        value of the option.
+    """
+    try:
+        value = settings['html'][key]
+    except (KeyError, TypeError):
+        return default
+    if value == None:
+        return default
+    return value
+
+
+def aggregate_old_data(settings:dict, df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Bins controls older than html aggregate_after_days into weekly or monthly bars.
+    Each bin shows the average control of the period: counts are summed, other results averaged over its controls.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (pd.DataFrame): dataframe containing all sample data for the group.
+
+    Returns:
+        pd.DataFrame: dataframe with old rows replaced by one row per bin, genus and target.
+    """
+    days = get_html_setting(settings=settings, key="aggregate_after_days")
+    if days == None or df.empty:
+        return df
+    dates = pd.to_datetime(df['submitted_date'])
+    old = dates < pd.Timestamp.today().normalize() - pd.Timedelta(days=int(days))
+    if not old.any():
+        return df
+    period = get_html_setting(settings=settings, key="aggregate_period", default="W")
+    old_df = df[old].copy()
+    old_df['submitted_date'] = dates[old].dt.to_period(period).dt.start_time.dt.strftime("%Y-%m-%d")
+    controls_per_bin = old_df.groupby('submitted_date')['name'].nunique()
+    mode_columns = [col for mode in settings['modes'] for col in settings['modes'][mode]]
+    value_columns = [col for col in mode_columns if not col.endswith("_hashes")]
+    for col in value_columns:
+        old_df[col] = pd.to_numeric(old_df[col], errors='coerce')
+    binned = old_df.groupby(['submitted_date', 'genus', 'target', 'genera'], as_index=False)[value_columns].sum()
+    divisor = binned['submitted_date'].map(controls_per_bin)
+    for col in value_columns:
+        if not col.endswith("_count"):
+            binned[col] = binned[col] / divisor
+    binned['name'] = divisor.astype(int).astype(str) + f" controls ({period} bin)"
+    for col in mode_columns:
+        if col.endswith("_hashes"):
+            binned[col] = ""
+    logger.debug(f"Aggregated {old.sum()} rows older than {days} days into {len(binned)} rows.")
+    return pd.concat([binned[df.columns], df[~old]], ignore_index=True)
+
+
+def use_minimal_hover(settings:dict, df:pd.DataFrame) -> bool:
+    """
+    Checks if a chart has more bar segments than html point_threshold and should drop hover details and labels.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (pd.DataFrame): dataframe being charted.
+
+    Returns:
+        bool: True if traces should be kept minimal.
+    """
+    threshold = get_html_setting(settings=settings, key="point_threshold")
+    return threshold != None and len(df) > int(threshold)
+
+
+def bucket_minor_genera(settings:dict, df:pd.DataFrame, group_name:str, value_column:str) -> pd.DataFrame:
+    """
+    Keeps the top N off-target genera by total abundance over the charted window and folds the rest into 'Other'.
+    Target genera are always kept. N comes from the control type's top_n, then html top_n.
+
+    Args:
+        settings (dict): settings passed down from click
+        df (pd.DataFrame): dataframe containing all sample data for the group.
+        group_name (str): controltype
+        value_column (str): column used to rank genera.
+
+    Returns:
+        pd.DataFrame: dataframe with at most N off-target genera plus 'Other'.
+    """
+    try:
+        top_n = settings['control_types'][group_name]['top_n']
+    except (KeyError, TypeError):
+        top_n = None
+    if top_n == None:
+        top_n = get_html_setting(settings=settings, key="top_n")
+    if top_n == None or df.empty:
+        return df
+    values = pd.to_numeric(df[value_column], errors='coerce').fillna(0)
+    totals = values.groupby(df['genus']).sum()
+    targets = df.loc[df['target'] == "Target", 'genus'].unique()
+    ranked = totals.drop(targets, errors='ignore').nlargest(int(top_n)).index
+    keep = df['genus'].isin(ranked) | (df['target'] == "Target")
+    if keep.all():
+        return df
+    logger.debug(f"Folding {df.loc[~keep, 'genus'].nunique()} genera of {group_name} into Other.")
+    other = df[~keep].copy()
+    other['genus'] = "Other"
+    mode_columns = [col for mode in settings['modes'] for col in settings['modes'][mode]]
+    value_columns = [col for col in mode_columns if not col.endswith("_hashes")]
+    for col in value_columns:
+        other[col] = pd.to_numeric(other[col], errors='coerce')
+    other = other.groupby(['name', 'submitted_date', 'target', 'genus', 'genera'], as_index=False)[value_columns].sum(min_count=1)
+    for col in mode_columns:
+        if col.endswith("_hashes"):
+            other[col] = ""
+    return pd.concat([df[keep], other[df.columns]], ignore_index=True)
+
+
+def generic_figure_markers(fig:Figure, modes:list=[], trace_modes:list=[]) -> Figure:
     """
     Adds standard layout to figure.
 
     Args:
         fig (Figure): Input figure.
         modes (list, optional): List of modes included in figure. Defaults to [].
+        trace_modes (list, optional): Index into modes of each trace in the figure. Defaults to [].
 
     Returns:
         Figure: Output figure with updated titles, rangeslider, buttons.
@@ -80,7 +256,7 @@ def generic_figure_markers(fig:Figure, modes:list=[]) -> Figure:
                 x=0.7,
                 y=1.2,
                 showactive=True,
-                buttons=make_buttons(modes=modes, fig_len=len(fig.data)),
+                buttons=make_buttons(modes=modes, trace_modes=trace_modes),
             )
         ]
     )
@@ -101,39 +277,73 @@ def generic_figure_markers(fig:Figure, modes:list=[]) -> Figure:
     return fig
 
 
-def make_buttons(modes:list, fig_len:int) -> list:
+def make_buttons(modes:list, trace_modes:list) -> list:
     """
     Creates list of buttons with one for each mode to be used in showing/hiding mode traces.
 
     Args:
         modes (list): list of modes used by main parser.
-        fig_len (int): number of traces in the figure
+        trace_modes (list): index into modes of each trace in the figure.
 
     Returns:
         list: list of buttons.
     """
-    from .misc import divide_chunks
     buttons = []
-    if len(modes) > 0:
-        for ii, mode in enumerate(modes):
-            # What I need to do is create a list of bools with the same length as the fig.data
-            mode_vis = [True] * fig_len
-            # And break it into {len(modes)} chunks
-            mode_vis = list(divide_chunks(mode_vis, len(modes)))
-            # Then, for each chunk, if the chunk index isn't equal to the index of the current mode, set to false
-            for jj, sublist in enumerate(mode_vis):
-                if jj != ii:
-                    mode_vis[jj] = [not elem for elem in mode_vis[jj]]
-            # Finally, flatten list.
-            mode_vis = [item for sublist in mode_vis for item in sublist]
-            # Now, make button to add to list
-            buttons.append(dict(label=mode, method="update", args=[
-                                {"visible": mode_vis},
-                                {"yaxis.title.text": mode},
-                            ]
-                        ))
+    trace_modes = np.asarray(trace_modes)
+    for ii, mode in enumerate(modes):
+        # A trace is visible only under the button of the mode it was built for.
+        buttons.append(dict(label=mode, method="update", args=[
+                            {"visible": (trace_modes == ii).tolist()},
+                            {"yaxis.title.text": mode},
+                        ]
+                    ))
     return buttons
 
+
+def build_bar_traces(df:pd.DataFrame, y:str, color:str, hover_columns:list, minimal:bool=False, visible:bool=True) -> list:
+    """
+    Builds one stacked bar trace per value of the color column straight from the frame's arrays.
+
+    Args:
+        df (pd.DataFrame): frame holding the chart data, already sorted.
+        y (str): column plotted on the y axis.
+        color (str): column whose values each get their own trace.
+        hover_columns (list): columns shown on hover.
+        minimal (bool, optional): leave out hover data and bar labels. Defaults to False.
+        visible (bool, optional): initial visibility of the traces. Defaults to True.
+
+    Returns:
+        list: go.Bar traces.
+    """
+    traces = []
+    if df.empty:
+        return traces
+    # Fixed colours per value, so the same genus looks the same under every mode button.
+    palette = px.colors.qualitative.Plotly
+    codes, uniques = pd.factorize(df[color])
+    # A stable sort on the codes keeps the frame's own order within each group.
+    order = np.argsort(codes, kind="stable")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    x_values = df['submitted_date'].to_numpy()[order]
+    y_values = df[y].to_numpy()[order]
+    if not minimal:
+        customdata = df[hover_columns].to_numpy()[order]
+        text = df['genera'].to_numpy()[order]
+        hover_lines = [f"{column}=%{{customdata[{ii}]}}" for ii, column in enumerate(hover_columns)]
+    for ii, rows in enumerate(np.split(np.arange(len(order)), bounds)):
+        name = str(uniques[ii])
+        trace = dict(x=x_values[rows], y=y_values[rows], name=name, legendgroup=name, visible=visible,
+            marker_color=palette[ii % len(palette)])
+        if minimal:
+            trace['hovertemplate'] = f"submitted_date=%{{x}}<br>{y}=%{{y}}<extra>{name}</extra>"
+        else:
+            trace['customdata'] = customdata[rows]
+            trace['text'] = text[rows]
+            trace['hovertemplate'] = "<br>".join([f"submitted_date=%{{x}}", f"{y}=%{{y}}", f"{color}={name}"] + hover_lines) + "<extra></extra>"
+        traces.append(Bar(**trace))
+    return traces
+
+
 def output_figures(settings:dict, figs:list, group_name:str):
     """
     Writes plotly figure to html file.
@@ -143,12 +353,25 @@ def output_figures(settings:dict, figs:list, group_name:str):
         fig (Figure): input figure object
         group_name (str): controltype
     """
-    with open(Path(settings['folder']['output']).joinpath(f'{group_name}.html'), "w") as f:
-        for fig in figs:
+    output_dir = Path(settings['folder']['output'])
+    if get_html_setting(settings=settings, key="plotlyjs", default="cdn") == "local":
+        # One copy of plotly.js beside the reports, for networks without CDN access.
+        get_plotlyjs_path(settings=settings)
+        include_plotlyjs = "directory"
+    else:
+        include_plotlyjs = "cdn"
+    html_path = output_dir.joinpath(f'{group_name}{get_window_suffix(settings)}.html')
+    with open(html_path, "w") as f:
+        for ii, fig in enumerate(figs):
             try:
-                f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+                # Only the first figure needs to load plotly.js.
+                f.write(fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs if ii == 0 else False))
             except AttributeError:
                 logger.error(f"The following figure was a string: {fig}")
+    budget = get_html_setting(settings=settings, key="size_budget_mb")
+    size = html_path.stat().st_size / 1e6
+    if budget != None and size > float(budget):
+        logger.warning(f"{html_path} is {size:.1f} MB, over the {budget} MB budget. Consider html aggregate_after_days or point_threshold.")
 
 # Below are the individual construction functions. They must be named "construct_{mode}_chart" and 
 # take only json_in and mode to hook into the main processor.
@@ -169,20 +392,17 @@ def construct_refseq_chart(settings:dict, df:pd.DataFrame, group_name:str, mode:
     # This overwrites the mode from the signature, might get confusing.
     fig = Figure()
     modes = ['contains', 'matches']
+    df = bucket_minor_genera(settings=settings, df=df, group_name=group_name, value_column=f"{modes[0]}_ratio")
+    minimal = use_minimal_hover(settings=settings, df=df)
+    trace_modes = []
     for ii, mode in enumerate(modes): 
-        bar = px.bar(df, x="submitted_date", 
-            y=f"{mode}_ratio", 
-            color="target", 
-            title=f"{group_name}_{mode}", 
-            barmode='stack', 
-            hover_data=["genus", "name", f"{mode}_hashes"], 
-            text="genera"
-        )
-        bar.update_traces(visible = ii == 0)
-        # Plotly express returns a full figure, so we have to use the data from that figure only.
-        fig.add_traces(bar.data)
-    # sys.exit(f"number of traces={len(fig.data)}")
-    return generic_figure_markers(fig=fig, modes=modes)
+        # Genera missing from a mode are left blank in the frame.
+        df[f'{mode}_ratio'] = pd.to_numeric(df[f'{mode}_ratio'], errors='coerce')
+        traces = build_bar_traces(df=df, y=f"{mode}_ratio", color="target", 
+            hover_columns=["genus", "name", f"{mode}_hashes"], minimal=minimal, visible=ii == 0)
+        fig.add_traces(traces)
+        trace_modes += [ii] * len(traces)
+    return generic_figure_markers(fig=fig, modes=modes, trace_modes=trace_modes)
 
 
 def construct_kraken_chart(settings:dict, df:pd.DataFrame, group_name:str, mode:str) -> Figure:
@@ -198,24 +418,19 @@ def construct_kraken_chart(settings:dict, df:pd.DataFrame, group_name:str, mode:
     Returns:
         Figure: initial figure with traces for modes
     """    
-    df[f'{mode}_count'] = pd.to_numeric(df[f'{mode}_count'],errors='coerce')
-    # The actual percentage from kraken was off due to exclusion of NaN, recalculating.
-    df[f'{mode}_percent'] = 100 * df[f'{mode}_count'] / df.groupby('submitted_date')[f'{mode}_count'].transform('sum')
+    df = bucket_minor_genera(settings=settings, df=df, group_name=group_name, value_column=f"{mode}_count")
+    df = recalculate_percent(df=df, mode=mode)
     modes = settings['modes'][mode]
+    minimal = use_minimal_hover(settings=settings, df=df)
     # This overwrites the mode from the signature, might get confusing.
     fig = Figure()
+    trace_modes = []
     for ii, entry in enumerate(modes):         
-        bar = px.bar(df, x="submitted_date", 
-            y=entry,
-            color="genus",
-            title=f"{group_name}_{entry}", 
-            barmode="stack", 
-            hover_data=["genus", "name", "target"],
-            text="genera",
-        )
-        bar.update_traces(visible = ii == 0)
-        fig.add_traces(bar.data)
-    return generic_figure_markers(fig=fig, modes=modes)
+        traces = build_bar_traces(df=df, y=entry, color="genus", 
+            hover_columns=["genus", "name", "target"], minimal=minimal, visible=ii == 0)
+        fig.add_traces(traces)
+        trace_modes += [ii] * len(traces)
+    return generic_figure_markers(fig=fig, modes=modes, trace_modes=trace_modes)
 
 ########This must be at bottom of module###########
 
@@ -0,0 +1,235 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger("controls.tools.watch_functions")
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+event_header = struct.Struct("iIII")
+
+# Filesystems where inotify doesn't see changes made by other machines.
+network_filesystems = ["nfs", "nfs4", "cifs", "smbfs", "smb3", "fuse.sshfs", "afs", "lustre", "gpfs"]
+
+
+def get_filesystem_type(path:Path) -> str:
+    """
+    Finds the filesystem type of the mount a path is on from /proc/mounts.
+
+    Args:
+        path (Path): path to check
+
+    Returns:
+        str: filesystem type, None if it can't be found.
+    """
+    path = Path(path).resolve().__str__()
+    best = ("", None)
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best[0]):
+                    best = (mount_point, fields[2])
+    except OSError:
+        return None
+    return best[1]
+
+
+def list_sample_folders(project_dir:Path) -> list:
+    """
+    Lists the sample folders of a project with scandir.
+
+    Args:
+        project_dir (Path): irida storage/project_name folder
+
+    Returns:
+        list: sample folder paths.
+    """
+    with os.scandir(project_dir.__str__()) as entries:
+        return [Path(entry.path) for entry in entries if entry.is_dir()]
+
+
+def get_fastq_signature(folder:Path) -> tuple:
+    """
+    Names, sizes and modification times of a folder's fastq files, used to tell when they stop changing.
+
+    Args:
+        folder (Path): sample folder
+
+    Returns:
+        tuple: sorted (name, size, mtime) of each fastq file.
+    """
+    signature = []
+    try:
+        with os.scandir(folder.__str__()) as entries:
+            for entry in entries:
+                if ".fastq" in entry.name:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # Dangling link, the file it points to hasn't arrived yet.
+                        continue
+                    signature.append((entry.name, stat.st_size, stat.st_mtime))
+    except OSError:
+        return ()
+    return tuple(sorted(signature))
+
+
+def has_fastq_pair(folder:Path) -> bool:
+    """
+    Checks if a sample folder holds a complete, non-empty FASTQ pair.
+
+    Args:
+        folder (Path): sample folder
+
+    Returns:
+        bool: True if there are at least two non-empty fastq files.
+    """
+    return len([item for item in get_fastq_signature(folder) if item[1] > 0]) >= 2
+
+
+class InotifyWatcher(object):
+    """
+    Watches the project folder and every sample folder in it with inotify through ctypes.
+    """
+    def __init__(self, project_dir:Path):
+        library = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.project_dir = Path(project_dir)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self.watches = {}
+        self.add_watch(self.project_dir)
+        for folder in list_sample_folders(self.project_dir):
+            self.add_watch(folder)
+
+    def add_watch(self, path:Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path.__str__()), watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger.error(f"Couldn't watch {path}: {os.strerror(errno)}")
+            return
+        self.watches[wd] = Path(path)
+
+    def poll(self, timeout:float) -> set:
+        """
+        Waits up to timeout seconds for changes.
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            set: sample folders that changed.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + event_header.size <= len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            name = data[offset + event_header.size:offset + event_header.size + length].rstrip(b"\0")
+            offset += event_header.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning the project folder.")
+                for folder in list_sample_folders(self.project_dir):
+                    if folder not in self.watches.values():
+                        self.add_watch(folder)
+                    changed.add(folder)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            try:
+                parent = self.watches[wd]
+            except KeyError:
+                continue
+            if parent == self.project_dir:
+                if mask & IN_ISDIR:
+                    folder = parent.joinpath(os.fsdecode(name))
+                    self.add_watch(folder)
+                    changed.add(folder)
+            else:
+                changed.add(parent)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Watches the project folder by comparing scandir listings, for network filesystems inotify can't see.
+    """
+    def __init__(self, project_dir:Path):
+        self.project_dir = Path(project_dir)
+        self.signatures = {folder: get_fastq_signature(folder) for folder in list_sample_folders(self.project_dir)}
+
+    def poll(self, timeout:float) -> set:
+        """
+        Sleeps for timeout seconds, then rescans.
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            set: sample folders that are new or whose fastq files changed.
+        """
+        time.sleep(timeout)
+        changed = set()
+        signatures = {}
+        for folder in list_sample_folders(self.project_dir):
+            signatures[folder] = get_fastq_signature(folder)
+            if self.signatures.get(folder) != signatures[folder]:
+                changed.add(folder)
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(project_dir:Path, force_polling:bool=False):
+    """
+    Uses inotify where it works, scandir polling on network filesystems, if asked for, or if inotify fails.
+
+    Args:
+        project_dir (Path): irida storage/project_name folder
+        force_polling (bool, optional): always poll. Defaults to False.
+
+    Returns:
+        InotifyWatcher | PollingWatcher: watcher
+    """
+    filesystem = get_filesystem_type(project_dir)
+    if force_polling or filesystem in network_filesystems:
+        logger.info(f"Polling {project_dir} ({filesystem}).")
+        return PollingWatcher(project_dir)
+    try:
+        watcher = InotifyWatcher(project_dir)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"inotify unavailable ({e}), polling {project_dir} instead.")
+        return PollingWatcher(project_dir)
+    logger.info(f"Watching {project_dir} with inotify.")
+    return watcher
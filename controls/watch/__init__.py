@@ -0,0 +1,80 @@
+from tools.db_functions import make_engine, get_all_Control_Sample_names_if_mode_not_empty, get_all_archived_Control_Sample_names
+from tools.watch_functions import make_watcher, list_sample_folders, has_fastq_pair
+from parse import parse_folder
+import signal
+import logging
+from pathlib import Path
+from datetime import datetime
+from time import monotonic
+
+logger = logging.getLogger("controls.watch")
+
+
+def main_watch(settings:dict, settle:float=60, interval:float=30, force_polling:bool=False):
+    """
+    Parses sample folders as they land in the irida storage, until interrupted.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        settle (float, optional): seconds a folder's fastq files must go unchanged before it is parsed. Defaults to 60.
+        interval (float, optional): seconds between rescans when polling. Defaults to 30.
+        force_polling (bool, optional): poll even if inotify is available. Defaults to False.
+    """
+    project_dir = Path(settings['irida']['storage']).joinpath(settings['irida']['project_name'])
+    # Kept for the life of the watch, along with the engine cached by make_engine.
+    engine = make_engine(settings=settings)
+    archived = set(get_all_archived_Control_Sample_names(settings=settings))
+    parsed = {mode: set(get_all_Control_Sample_names_if_mode_not_empty(mode=mode, settings=settings, engine=engine)) | archived for mode in settings['mode']}
+    watcher = make_watcher(project_dir, force_polling=force_polling)
+    # Folders waiting for their files to settle, with the time they last changed.
+    # Anything not yet parsed at startup is picked up straight away.
+    pending = {folder: 0.0 for folder in list_sample_folders(project_dir)
+        if any(folder.name not in parsed[mode] for mode in settings['mode'])}
+    logger.info(f"Watching {project_dir} with {len(pending)} folders outstanding.")
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    try:
+        while not stopping:
+            if pending:
+                # Wake up when the next pending folder will have settled.
+                timeout = max(1.0, min(interval, min(settle - (monotonic() - changed) for changed in pending.values())))
+            else:
+                timeout = interval
+            for folder in watcher.poll(timeout):
+                if any(folder.name not in parsed[mode] for mode in settings['mode']):
+                    pending[folder] = monotonic()
+            now = monotonic()
+            for folder in [folder for folder, changed in pending.items() if now - changed >= settle]:
+                del pending[folder]
+                if not has_fastq_pair(folder):
+                    # Its files will raise another change when they arrive.
+                    logger.debug(f"{folder} has no complete fastq pair yet.")
+                    continue
+                parse_watched_folder(settings=settings, folder=folder, parsed=parsed, engine=engine)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    logger.info(f"The WATCH run has ended at {datetime.now()}.")
+
+
+def parse_watched_folder(settings:dict, folder:Path, parsed:dict, engine=None):
+    """
+    Parses one settled folder for every mode it's missing. Failures are logged so the watch keeps running.
+
+    Args:
+        settings (dict): Settings passed down from click.
+        folder (Path): sample folder
+        parsed (dict): names already parsed, keyed by mode. Updated in place.
+        engine (engine, optional): engine used. Defaults to None.
+    """
+    for mode in settings['mode']:
+        if folder.name in parsed[mode]:
+            continue
+        logger.info(f"Parsing {folder.name} for {mode}.")
+        try:
+            parse_folder(settings=settings, folder=folder.__str__(), mode=mode, engine=engine)
+        except Exception as e:
+            logger.error(f"Parsing {folder.name} for {mode} failed: {e}")
+            continue
+        parsed[mode].add(folder.name)
@@ -0,0 +1,57 @@
+import cluster
+from cluster import main_cluster_run, get_retry_time, read_failures, get_done_path, get_failed_path, get_lease_key
+
+
+def make_settings(tmp_path, **cluster_settings) -> dict:
+    cluster_settings = dict(dict(max_attempts=3, backoff_seconds=0, lease_seconds=60), **cluster_settings)
+    return dict(irida=dict(storage=tmp_path.__str__()), mode=["contains"], modes=["contains", "matches", "kraken"], cluster=cluster_settings)
+
+
+def patch_cluster(monkeypatch, folders:list, parse):
+    """
+    Runs the cluster loop on the given folders without databases, parsing with parse.
+    """
+    monkeypatch.setattr(cluster, "make_engine", lambda **kwargs: None)
+    monkeypatch.setattr(cluster, "make_staging_settings", lambda settings, staging_dir, node: dict(settings, db_path=staging_dir.joinpath(f"{node}.db").__str__()))
+    monkeypatch.setattr(cluster, "create_staging_db", lambda settings, staging_settings: None)
+    monkeypatch.setattr(cluster, "check_samples_against_database", lambda settings, mode, engine: list(folders))
+    monkeypatch.setattr(cluster, "plan_longest_first", lambda settings, pending, engine: [dict(folder=folder, mode=mode) for folder, mode in pending])
+    monkeypatch.setattr(cluster, "is_parsed", lambda name, mode, engine: False)
+    monkeypatch.setattr(cluster, "parse_folder", parse)
+
+
+def test_retry_time_backs_off_then_gives_up():
+    settings = dict(cluster=dict(max_attempts=3, backoff_seconds=60))
+    assert get_retry_time(settings, None) == 0
+    assert get_retry_time(settings, dict(attempts=1, last=100)) == 160
+    assert get_retry_time(settings, dict(attempts=2, last=100)) == 220
+    assert get_retry_time(settings, dict(attempts=3, last=100)) == None
+
+
+def test_failing_sample_ends_the_run(tmp_path, monkeypatch):
+    calls = []
+    def parse(settings, folder, mode, engine):
+        calls.append(folder)
+        raise RuntimeError("refseq_masher failed")
+    patch_cluster(monkeypatch, [tmp_path.joinpath("S1").__str__()], parse)
+    settings = make_settings(tmp_path)
+    assert main_cluster_run(settings, node="node1", poll_interval=0.1) == 0
+    assert len(calls) == 3
+    lease_dir = tmp_path.joinpath(".controls_cluster", "leases")
+    key = get_lease_key("S1", "contains")
+    failures = read_failures(lease_dir, key)
+    assert failures['attempts'] == 3
+    assert failures['error'] == "RuntimeError: refseq_masher failed"
+    assert not get_done_path(lease_dir, key).exists()
+
+
+def test_unwritten_control_is_a_failure(tmp_path, monkeypatch):
+    results = [False, True]
+    patch_cluster(monkeypatch, [tmp_path.joinpath("S1").__str__()], lambda settings, folder, mode, engine: results.pop(0))
+    settings = make_settings(tmp_path)
+    assert main_cluster_run(settings, node="node1", poll_interval=0.1) == 1
+    lease_dir = tmp_path.joinpath(".controls_cluster", "leases")
+    key = get_lease_key("S1", "contains")
+    assert get_done_path(lease_dir, key).exists()
+    # A sample that went through clears its failures.
+    assert not get_failed_path(lease_dir, key).exists()
@@ -0,0 +1,80 @@
+from datetime import date, datetime
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from models import Base, Control, ControlType, ControlScore
+from tools.db_functions import add_control_to_db, get_control_type_watermark, archive_controls
+from tools.codec_functions import encode_results
+from tools.profile_functions import get_profile_store_stale, rebuild_profile_store, read_profile_index, get_profile_store_path
+from archive import main_archive
+
+
+def make_database(tmp_path, archive:bool=False):
+    """
+    Controls database with one control type, and the settings pointing at it.
+    """
+    settings = dict(db_path=tmp_path.joinpath("controls.db").__str__(), modes=dict(contains=None))
+    if archive:
+        settings['archive'] = dict(db_path=tmp_path.joinpath("archive.db").__str__())
+    engine = create_engine(f"sqlite:///{settings['db_path']}")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add(ControlType(name="EN-NOS", targets=["Escherichia"]))
+    session.commit()
+    session.close()
+    return settings, engine
+
+
+def write_control(settings, engine, name:str, submitted_date:datetime, ratio:float=0.9):
+    session = Session(engine)
+    control = Control(name=name, submitted_date=submitted_date)
+    control.controltype = session.query(ControlType).first()
+    control.contains = encode_results({"Escherichia": dict(contains_ratio=ratio)})
+    session.close()
+    add_control_to_db(control, mode="contains", settings=settings, engine=engine)
+
+
+def test_watermark_follows_writes_not_encoding(tmp_path):
+    settings, engine = make_database(tmp_path)
+    write_control(settings, engine, "EN-NOS-1", datetime(2023, 1, 2))
+    first = get_control_type_watermark("EN-NOS", settings=settings, engine=engine)
+    assert first == dict(max_id=1, last_update="2023-01-02", count=1, version=1)
+    # Re-encoding the stored results, as compact does, isn't a change.
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE _control_samples SET contains = contains || ' '"))
+    assert get_control_type_watermark("EN-NOS", settings=settings, engine=engine) == first
+    # A re-parse with new values of the same length is.
+    write_control(settings, engine, "EN-NOS-1", datetime(2023, 1, 2), ratio=0.8)
+    assert get_control_type_watermark("EN-NOS", settings=settings, engine=engine) == dict(first, version=2)
+
+
+def test_watermark_reads_the_archive_when_the_window_reaches_it(tmp_path):
+    settings, engine = make_database(tmp_path, archive=True)
+    write_control(settings, engine, "EN-NOS-1", datetime(2022, 6, 1))
+    write_control(settings, engine, "EN-NOS-2", datetime(2023, 6, 1))
+    before = get_control_type_watermark("EN-NOS", settings=settings, engine=engine)
+    assert archive_controls(settings, cutoff=date(2023, 1, 1), engine=engine) == 1
+    # The whole history is the same controls, only split over two files.
+    assert get_control_type_watermark("EN-NOS", settings=settings, engine=engine) == before
+    assert get_control_type_watermark("EN-NOS", settings=settings, engine=engine, since=date(2023, 1, 1))['count'] == 1
+
+
+def test_archive_drops_scores_and_marks_profiles_stale(tmp_path):
+    settings, engine = make_database(tmp_path, archive=True)
+    write_control(settings, engine, "EN-NOS-1", datetime(2022, 6, 1))
+    write_control(settings, engine, "EN-NOS-2", datetime(2023, 6, 1))
+    session = Session(engine)
+    for control in session.query(Control):
+        session.add(ControlScore(control_id=control.id, submitted_date=control.submitted_date.date(), mode="contains",
+            metric="off_target_fraction", genus="", value=0.0, samples=0))
+    session.commit()
+    session.close()
+    assert main_archive(settings, before=date(2023, 1, 1)) == 1
+    session = Session(engine)
+    assert [score.control.name for score in session.query(ControlScore)] == ["EN-NOS-2"]
+    session.close()
+    assert get_profile_store_stale(settings) == ["controls submitted before 2023-01-01 archived"]
+    # Nothing left to move, nothing marked.
+    rebuild_profile_store(settings, engine=engine)
+    assert main_archive(settings, before=date(2023, 1, 1)) == 0
+    assert get_profile_store_stale(settings) == []
+    assert [entry[0] for entry in read_profile_index(get_profile_store_path(settings))] == ["EN-NOS-2"]
@@ -0,0 +1,13 @@
+import pandas as pd
+from tools.excel_functions import drop_reruns_from_df
+
+
+def test_drop_reruns_keeps_the_latest_run():
+    df = pd.DataFrame(dict(name=["EN-NOS-1", "EN-NOS-1-R2", "EN-NOS-1-R9", "EN-NOS-1-R10", "EN-NOS-2"]))
+    for regex in [r"-R\d+", r"(-R\d+)", r"(-R)\d+", r"(?P<rerun>-R)(\d+)"]:
+        assert list(drop_reruns_from_df(dict(rerun_regex=regex), df)['name']) == ["EN-NOS-1-R10", "EN-NOS-2"], regex
+
+
+def test_drop_reruns_without_reruns():
+    df = pd.DataFrame(dict(name=["EN-NOS-1", "EN-NOS-2"]))
+    assert list(drop_reruns_from_df(dict(rerun_regex=r"(-R)\d+"), df)['name']) == ["EN-NOS-1", "EN-NOS-2"]
@@ -0,0 +1,70 @@
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from models import Base, Control, ControlType, ControlSummary, ControlStatistic, ControlScore
+import tools.hook_functions as hook_functions
+from tools.db_functions import add_control_to_db
+from tools.codec_functions import encode_results
+from tools.hook_functions import run_post_write_hooks
+from tools.anomaly_functions import rebuild_control_statistics
+from tools.profile_functions import get_profile_store_stale, read_profile_index, get_profile_store_path, rebuild_profile_store
+
+
+def make_database(tmp_path):
+    """
+    Controls database with one control type, and the settings pointing at it.
+    """
+    settings = dict(db_path=tmp_path.joinpath("controls.db").__str__(), modes=dict(contains=None))
+    engine = create_engine(f"sqlite:///{settings['db_path']}")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add(ControlType(name="EN-NOS", targets=["Escherichia"]))
+    session.commit()
+    session.close()
+    return settings, engine
+
+
+def write_control(settings, engine, name:str):
+    session = Session(engine)
+    control = Control(name=name, submitted_date=datetime(2023, 1, 2))
+    control.controltype = session.query(ControlType).first()
+    control.contains = encode_results({"Escherichia": dict(contains_ratio=0.9), "Salmonella": dict(contains_ratio=0.1)})
+    session.close()
+    control_id, old_value = add_control_to_db(control, mode="contains", settings=settings, engine=engine)
+    run_post_write_hooks(settings=settings, control_id=control_id, mode="contains", old_value=old_value, engine=engine)
+    return control_id
+
+
+def test_hooks_follow_the_write(tmp_path):
+    settings, engine = make_database(tmp_path)
+    control_id = write_control(settings, engine, "EN-NOS-1")
+    session = Session(engine)
+    assert session.query(ControlSummary).count() == 2
+    assert session.query(ControlScore).filter_by(control_id=control_id).count() == 3
+    session.close()
+    assert [entry[0] for entry in read_profile_index(get_profile_store_path(settings))] == ["EN-NOS-1"]
+    assert get_profile_store_stale(settings) == []
+
+
+def test_failed_hook_leaves_the_others_and_marks_stale(tmp_path, monkeypatch):
+    settings, engine = make_database(tmp_path)
+    def fail(**kwargs):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(hook_functions, "update_control_statistics", fail)
+    monkeypatch.setattr(hook_functions, "add_control_profile", fail)
+    write_control(settings, engine, "EN-NOS-1")
+    session = Session(engine)
+    # The control and its summaries were still written.
+    assert session.query(Control).count() == 1
+    assert session.query(ControlSummary).count() == 2
+    # No statistics yet, so a stale placeholder is left for the rebuild to find.
+    assert [row.stale for row in session.query(ControlStatistic)] == [True]
+    session.close()
+    assert get_profile_store_stale(settings) == ["control 1 contains not added: disk full"]
+    monkeypatch.undo()
+    assert rebuild_control_statistics(settings, engine=engine, stale_only=True) == 1
+    assert rebuild_profile_store(settings, engine=engine) == 1
+    assert get_profile_store_stale(settings) == []
+    session = Session(engine)
+    assert not any(row.stale for row in session.query(ControlStatistic))
+    session.close()
@@ -0,0 +1,136 @@
+import sys
+import socket
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from models import Job
+import jobs
+from jobs import claim_job, finish_job, worker_loop
+
+
+def make_queue(db_path, jobs:list):
+    """
+    Queue database holding the given (sample, priority, predicted_seconds) jobs.
+    """
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": 30})
+    Job.__table__.create(engine)
+    session = Session(engine)
+    now = datetime.now()
+    for sample, priority, predicted in jobs:
+        session.add(Job(sample=sample, folder=f"/storage/{sample}", mode="contains", state="queued", priority=priority,
+            predicted_seconds=predicted, attempts=0, max_attempts=2, enqueued=now, available_at=now))
+    session.commit()
+    session.close()
+    return engine
+
+
+def test_claim_order(tmp_path):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("small", 0, 10), ("big", 0, 100), ("unknown", 0, None), ("urgent", 1, 1)])
+    claimed = []
+    while True:
+        claim = claim_job(engine, worker="host:1")
+        if claim == None:
+            break
+        claimed.append(claim['sample'])
+    assert claimed == ["urgent", "big", "small", "unknown"]
+
+
+def test_claim_skips_backed_off_jobs(tmp_path):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("sample", 0, 10)])
+    session = Session(engine)
+    session.query(Job).update({Job.available_at: datetime.now() + timedelta(hours=1)})
+    session.commit()
+    session.close()
+    assert claim_job(engine, worker="host:1") == None
+
+
+def claim_all(db_path:str, worker:str, results):
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": 30})
+    claimed = []
+    while True:
+        claim = claim_job(engine, worker=worker)
+        if claim == None:
+            break
+        claimed.append(claim['id'])
+    results.put(claimed)
+
+
+def test_concurrent_workers_claim_each_job_once(tmp_path):
+    db_path = tmp_path.joinpath("queue.db")
+    engine = make_queue(db_path, [(f"sample{ii}", 0, ii) for ii in range(200)])
+    engine.dispose()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=claim_all, args=(db_path.__str__(), f"host:{ii}", results)) for ii in range(6)]
+    for process in processes:
+        process.start()
+    claimed = [job_id for process in processes for job_id in results.get(timeout=120)]
+    for process in processes:
+        process.join()
+    assert sorted(claimed) == list(range(1, 201))
+
+
+def test_failed_job_retried_then_failed(tmp_path):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("sample", 0, 10)])
+    claim = claim_job(engine, worker="host:1")
+    finish_job(engine, claim=claim, seconds=1, error="boom", backoff=0)
+    session = Session(engine)
+    job = session.query(Job).one()
+    assert job.state == "queued" and job.error == "boom"
+    session.close()
+    claim = claim_job(engine, worker="host:1")
+    assert claim['attempts'] == 2
+    finish_job(engine, claim=claim, seconds=1, error="boom again", backoff=0)
+    session = Session(engine)
+    assert session.query(Job).one().state == "failed"
+    session.close()
+
+
+def test_finish_ignores_reclaimed_job(tmp_path):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("sample", 0, 10)])
+    claim = claim_job(engine, worker="host:1")
+    finish_job(engine, claim={**claim, 'claim_token': "stale"}, seconds=1)
+    session = Session(engine)
+    assert session.query(Job).one().state == "running"
+    session.close()
+    finish_job(engine, claim=claim, seconds=1)
+    session = Session(engine)
+    assert session.query(Job).one().state == "done"
+    session.close()
+
+
+def run_worker(engine, monkeypatch, parse):
+    monkeypatch.setattr(jobs, "make_engine", lambda settings: engine)
+    monkeypatch.setattr(jobs, "parse_folder", parse)
+    worker_loop(dict(jobs=dict(backoff_seconds=0)), exit_when_empty=True, poll_interval=0.1)
+
+
+def test_unwritten_control_fails_the_job(tmp_path, monkeypatch):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("sample", 0, 10)])
+    calls = []
+    def parse(settings, folder, mode, engine):
+        calls.append(folder)
+        return False
+    run_worker(engine, monkeypatch, parse)
+    session = Session(engine)
+    job = session.query(Job).one()
+    assert job.state == "failed" and job.attempts == 2
+    assert job.error == "No control was written from the sample's results."
+    session.close()
+    assert len(calls) == 2
+
+
+def test_dead_workers_job_is_requeued_by_the_loop(tmp_path, monkeypatch):
+    engine = make_queue(tmp_path.joinpath("queue.db"), [("sample", 0, 10)])
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    session = Session(engine)
+    session.query(Job).update({Job.state: "running", Job.attempts: 1, Job.claim_token: "gone", Job.worker: f"{socket.gethostname()}:{dead.pid}"})
+    session.commit()
+    session.close()
+    run_worker(engine, monkeypatch, lambda settings, folder, mode, engine: True)
+    session = Session(engine)
+    job = session.query(Job).one()
+    assert job.state == "done" and job.attempts == 2
+    session.close()
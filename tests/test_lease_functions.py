@@ -0,0 +1,143 @@
+import time
+import multiprocessing
+from pathlib import Path
+from tools.lease_functions import read_lease, write_lease_file, acquire_lease, renew_lease, release_lease, LeaseKeeper
+
+
+def write_expired_lease(lease_dir:Path, key:str, node:str="crashed") -> Path:
+    path = lease_dir.joinpath(f"{key}.lease")
+    write_lease_file(path, dict(key=key, node=node, host="gone", pid=0, token="old", expires=time.time() - 1))
+    return path
+
+
+def test_acquire_is_exclusive(tmp_path):
+    lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+    assert lease != None
+    assert acquire_lease(tmp_path, key="sample__contains", node="b", ttl=60) == None
+    assert read_lease(Path(lease['path']))['node'] == "a"
+    release_lease(lease)
+    assert not Path(lease['path']).exists()
+    assert acquire_lease(tmp_path, key="sample__contains", node="b", ttl=60) != None
+
+
+def test_release_leaves_other_holders_lease(tmp_path):
+    lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+    # Taken over by another node after expiring.
+    write_lease_file(Path(lease['path']), {**lease, 'token': "other", 'node': "b"})
+    release_lease(lease)
+    assert read_lease(Path(lease['path']))['node'] == "b"
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    write_expired_lease(tmp_path, "sample__contains")
+    lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+    assert lease != None
+    assert read_lease(Path(lease['path']))['token'] == lease['token']
+    # Nothing is left behind by the reclaim.
+    assert [item.name for item in tmp_path.iterdir()] == ["sample__contains.lease"]
+
+
+def reclaim(lease_dir:str, node:str, start, results):
+    start.wait()
+    lease = acquire_lease(Path(lease_dir), key="sample__contains", node=node, ttl=60)
+    results.put((node, lease['token'] if lease != None else None))
+
+
+def test_expired_lease_reclaimed_by_one_process(tmp_path):
+    for attempt in range(5):
+        lease_dir = tmp_path.joinpath(str(attempt))
+        lease_dir.mkdir()
+        write_expired_lease(lease_dir, "sample__contains")
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=reclaim, args=(lease_dir.__str__(), f"node{ii}", start, results)) for ii in range(8)]
+        for process in processes:
+            process.start()
+        start.set()
+        outcomes = [results.get(timeout=30) for process in processes]
+        for process in processes:
+            process.join()
+        winners = [(node, token) for node, token in outcomes if token != None]
+        assert len(winners) == 1
+        assert read_lease(lease_dir.joinpath("sample__contains.lease"))['token'] == winners[0][1]
+
+
+def run_node(lease_dir:str, keys:list, node:str, results):
+    """
+    Cut down cluster run loop: claim each key, 'parse' it, mark it done, release it.
+    """
+    lease_dir = Path(lease_dir)
+    done = []
+    with LeaseKeeper(ttl=5, heartbeat=0.5) as keeper:
+        for key in keys:
+            if lease_dir.joinpath(f"{key}.done").exists():
+                continue
+            lease = acquire_lease(lease_dir, key=key, node=node, ttl=5)
+            if lease == None:
+                continue
+            keeper.add(lease)
+            try:
+                if lease_dir.joinpath(f"{key}.done").exists():
+                    continue
+                time.sleep(0.01)
+                if keeper.holds(lease):
+                    lease_dir.joinpath(f"{key}.done").write_text(node)
+                    done.append(key)
+            finally:
+                keeper.remove(lease)
+    results.put(done)
+
+
+def test_nodes_share_work_without_overlap(tmp_path):
+    keys = [f"sample{ii}__contains" for ii in range(100)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_node, args=(tmp_path.__str__(), keys, f"node{ii}", results)) for ii in range(4)]
+    for process in processes:
+        process.start()
+    done = [key for process in processes for key in results.get(timeout=60)]
+    for process in processes:
+        process.join()
+    assert sorted(done) == sorted(keys)
+    assert not list(tmp_path.glob("*.lease"))
+
+
+def test_renew_extends_held_lease(tmp_path):
+    lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=1)
+    before = lease['expires']
+    assert renew_lease(lease, ttl=60)
+    assert lease['expires'] > before
+    assert read_lease(Path(lease['path']))['expires'] == lease['expires']
+
+
+def test_renew_refuses_taken_or_expired_lease(tmp_path):
+    lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+    write_lease_file(Path(lease['path']), {**lease, 'token': "other", 'node': "b"})
+    assert not renew_lease(lease, ttl=60)
+    assert read_lease(Path(lease['path']))['node'] == "b"
+    expired = acquire_lease(tmp_path, key="other__contains", node="a", ttl=60)
+    expired['expires'] = time.time() - 1
+    assert not renew_lease(expired, ttl=60)
+
+
+def test_keeper_marks_lost_lease(tmp_path):
+    with LeaseKeeper(ttl=60, heartbeat=0.05) as keeper:
+        lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+        keeper.add(lease)
+        time.sleep(0.2)
+        assert keeper.holds(lease)
+        # Another node reclaims it, eg. after this one stalled past its expiry.
+        write_lease_file(Path(lease['path']), {**lease, 'token': "other", 'node': "b"})
+        deadline = time.time() + 5
+        while keeper.holds(lease) and time.time() < deadline:
+            time.sleep(0.05)
+        assert not keeper.holds(lease)
+        keeper.remove(lease)
+    # The other node's lease is left alone.
+    assert read_lease(Path(lease['path']))['node'] == "b"
+
+
+def test_keeper_releases_on_exit(tmp_path):
+    with LeaseKeeper(ttl=60, heartbeat=10) as keeper:
+        lease = acquire_lease(tmp_path, key="sample__contains", node="a", ttl=60)
+        keeper.add(lease)
+    assert not Path(lease['path']).exists()
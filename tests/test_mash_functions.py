@@ -0,0 +1,44 @@
+import os
+import tools.mash_functions as mash_functions
+from tools.mash_functions import digest_inputs, get_sample_sketch, get_sketch_dir
+
+
+def make_sample(root, name:str):
+    folder = root.joinpath(name)
+    folder.mkdir()
+    for read in ["R1", "R2"]:
+        folder.joinpath(f"{name}_{read}.fastq").write_text("@a\nACGT\n+\nIIII\n")
+    return folder
+
+
+def test_digest_sees_files_rewritten_in_place(tmp_path):
+    folder = make_sample(tmp_path, "S1")
+    pair = tuple(sorted(folder.glob("*.fastq")))
+    params = dict(kmer=16, sketch_size=400, min_copies=8, subsample=None)
+    before = digest_inputs(pair, params)
+    # Same size, same first and last bytes, only written later.
+    stat = pair[0].stat()
+    os.utime(pair[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert digest_inputs(pair, params) != before
+
+
+def test_sketch_is_copied_out_of_the_store(tmp_path, monkeypatch):
+    sketched = []
+    def fake_sketch(mash_bin, blocks, sample, prefix, kmer, sketch_size, min_copies):
+        sketched.append(sample)
+        with open(f"{prefix}.msh", "wb") as f:
+            f.write(b"".join(blocks))
+        return True
+    monkeypatch.setattr(mash_functions, "run_mash_sketch", fake_sketch)
+    settings = dict(mash=dict(sketch_dir=tmp_path.joinpath("store").__str__()))
+    folder = make_sample(tmp_path, "S1")
+    first = get_sample_sketch(settings, folder=folder.__str__(), mode="matches", copy_dir=tmp_path)
+    assert first.parent == tmp_path and first.exists()
+    copy_dir = tmp_path.joinpath("copies")
+    copy_dir.mkdir()
+    second = get_sample_sketch(settings, folder=folder.__str__(), mode="matches", copy_dir=copy_dir)
+    assert sketched == ["S1"]
+    # Evicting it from the store doesn't take the copy with it.
+    for item in get_sketch_dir(settings).glob("*.msh"):
+        item.unlink()
+    assert second.read_bytes() == first.read_bytes()
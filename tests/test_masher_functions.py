@@ -0,0 +1,145 @@
+import pandas as pd
+from pathlib import Path
+import tools.masher_functions as masher_functions
+from tools.subprocesses import make_refseq_masher_batch_command
+from tools.masher_functions import match_sample_label, split_masher_table, run_refseq_masher_chunk, run_refseq_masher_batches
+
+
+def make_folders(root:Path, names:list) -> list:
+    folders = []
+    for name in names:
+        folder = root.joinpath(name)
+        folder.mkdir()
+        folder.joinpath(f"{name}_R1.fastq").write_text("@a\nACGT\n+\nIIII\n")
+        folder.joinpath(f"{name}_R2.fastq").write_text("@a\nACGT\n+\nIIII\n")
+        folders.append(folder.__str__())
+    return folders
+
+
+def test_batch_command_parallelism_only_for_contains():
+    settings = dict(verbose=False)
+    assert make_refseq_masher_batch_command(settings, folders=["a", "b"], mode="contains", parallelism=4) == \
+        ["refseq_masher", "contains", "--parallelism", "4", "a", "b"]
+    assert make_refseq_masher_batch_command(settings, folders=["a", "b"], mode="matches", parallelism=4) == \
+        ["refseq_masher", "matches", "a", "b"]
+    assert make_refseq_masher_batch_command(dict(verbose=True), folders=["a"], mode="matches") == \
+        ["refseq_masher", "--verbose", "matches", "a"]
+
+
+fake_refseq_masher = {
+    "__init__.py": "",
+    "const.py": """
+MASH_SCREEN_ORDERED_COLUMNS = ["sample", "identity", "parallelism", "match_id"]
+MASH_DIST_ORDERED_COLUMNS = ["sample", "distance", "match_id"]
+""",
+    # Counts how often the taxonomy table is read, as the real module does on import.
+    "taxonomy.py": """
+import os
+with open(os.environ["FAKE_TAXONOMY_LOG"], "a") as f:
+    f.write("read\\n")
+def merge_ncbi_taxonomy_info(df):
+    return df.assign(taxonomic_genus="Salmonella")
+""",
+    "utils.py": """
+from pathlib import Path
+def collect_inputs(inputs):
+    return [], [(sorted(str(item) for item in Path(folder).glob("*.fastq")), Path(folder).name) for folder in inputs]
+def order_output_columns(df, cols):
+    return df[[col for col in cols if col in df.columns] + [col for col in df.columns if col not in cols]]
+""",
+    "mash/__init__.py": "",
+    "mash/screen.py": """
+import pandas as pd
+def vs_refseq(inputs, mash_bin="mash", sample_name=None, max_pvalue=0.01, min_identity=0.9, parallelism=1):
+    if sample_name == "nothing":
+        return None
+    return pd.DataFrame(dict(match_id=["ref1"], identity=[0.99], parallelism=[parallelism], sample=[sample_name]))
+""",
+    "mash/dist.py": """
+import pandas as pd
+def fastq_vs_refseq(fastqs, mash_bin="mash", sample_name=None, tmp_dir="/tmp", k=16, s=400, m=8):
+    return pd.DataFrame(dict(match_id=[f"ref{ii}" for ii in range(10)], distance=[ii / 100 for ii in range(10)], sample=sample_name))
+def fasta_vs_refseq(fasta_path, mash_bin="mash", sample_name=None, tmp_dir="/tmp", k=16, s=400):
+    return fastq_vs_refseq([fasta_path], sample_name=sample_name)
+""",
+}
+
+
+def test_worker_runs_refseq_masher_functions(tmp_path, monkeypatch):
+    for name, source in fake_refseq_masher.items():
+        path = tmp_path.joinpath("lib", "refseq_masher", name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    log = tmp_path.joinpath("taxonomy.log")
+    monkeypatch.setenv("FAKE_TAXONOMY_LOG", log.__str__())
+    monkeypatch.syspath_prepend(tmp_path.joinpath("lib").__str__())
+    folders = make_folders(tmp_path, ["S1", "nothing"])
+    worker = masher_functions.MasherWorker()
+    try:
+        contains = worker.run("contains", inputs=folders, parallelism=3, timeout=60)
+        assert list(contains['sample']) == ["S1"] and list(contains['parallelism']) == [3]
+        assert contains.columns[0] == "sample" and "taxonomic_genus" in contains.columns
+        matches = worker.run("matches", inputs=folders[:1], parallelism=3, timeout=60)
+        assert list(matches['match_id']) == [f"ref{ii}" for ii in range(5)]
+        # Nothing found is an empty table, not an error.
+        assert worker.run("contains", inputs=folders[1:], timeout=60).empty
+    finally:
+        worker.close()
+    # refseq_masher, and its taxonomy table, were loaded once for all three runs.
+    assert log.read_text().splitlines() == ["read"]
+
+
+def test_chunk_passes_parallelism_to_the_worker(monkeypatch):
+    calls = []
+    def fake_inprocess(settings, inputs, mode, parallelism=1):
+        calls.append((mode, parallelism))
+        return pd.DataFrame(dict(sample=["a"]))
+    monkeypatch.setattr(masher_functions, "run_refseq_masher_inprocess", fake_inprocess)
+    settings = dict(verbose=False, refseq_masher=dict(backend="inprocess", parallelism=3))
+    run_refseq_masher_chunk(settings, folders=["a"], mode="contains")
+    assert calls == [("contains", 3)]
+
+
+def test_match_sample_label(tmp_path):
+    folders = make_folders(tmp_path, ["EN-NOS-1", "EN-NOS-2"])
+    assert match_sample_label("EN-NOS-2", folders) == folders[1]
+    # Labels taken from fastq names rather than the folder.
+    assert match_sample_label("EN-NOS-1_R1", folders) == folders[0]
+    assert match_sample_label("unknown", folders) == None
+
+
+def test_split_masher_table(tmp_path):
+    folders = make_folders(tmp_path, ["S1", "S2", "S3"])
+    table = pd.DataFrame(dict(sample=["S1", "S2", "S1"], taxonomic_genus=["Salmonella", "Escherichia", "Shigella"]))
+    split = split_masher_table(table, folders)
+    assert list(split[folders[0]]['taxonomic_genus']) == ["Salmonella", "Shigella"]
+    assert list(split[folders[1]]['taxonomic_genus']) == ["Escherichia"]
+    # Every label was matched, so a folder without rows found nothing.
+    assert len(split[folders[2]]) == 0
+
+
+def test_split_masher_table_leaves_out_folders_with_unmatched_labels(tmp_path):
+    folders = make_folders(tmp_path, ["S1", "S2"])
+    table = pd.DataFrame(dict(sample=["S1", "mystery"], taxonomic_genus=["Salmonella", "Escherichia"]))
+    split = split_masher_table(table, folders)
+    assert list(split) == [folders[0]]
+
+
+def test_failed_chunk_is_left_for_the_parse(tmp_path, monkeypatch):
+    folders = make_folders(tmp_path, ["S1", "S2", "S3"])
+    chunks = []
+    def fake_chunk(settings, folders, mode):
+        chunks.append(folders)
+        if len(chunks) == 1:
+            return None
+        return pd.DataFrame(dict(sample=[Path(folder).name for folder in folders], taxonomic_genus=["Salmonella"] * len(folders)))
+    recorded = []
+    monkeypatch.setattr(masher_functions, "run_refseq_masher_chunk", fake_chunk)
+    monkeypatch.setattr(masher_functions, "record_analysis_run", lambda **kwargs: recorded.append(kwargs['sample']))
+    settings = dict(verbose=False, refseq_masher=dict(batch_size=2))
+    assert run_refseq_masher_batches(settings, folders=folders, mode="contains") == 1
+    assert chunks == [folders[:2], folders[2:]]
+    assert not Path(folders[0]).joinpath("S1_contains.tsv").exists()
+    assert not Path(folders[1]).joinpath("S2_contains.tsv").exists()
+    assert Path(folders[2]).joinpath("S3_contains.tsv").exists()
+    assert recorded == ["S3"]
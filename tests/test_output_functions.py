@@ -0,0 +1,19 @@
+import pandas as pd
+from tools.output_functions import write_full_output, get_full_output_path, open_full_output
+
+
+def read_lines(settings) -> list:
+    with open_full_output(get_full_output_path(settings), "r") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def test_full_output_carries_over_unregenerated_types(tmp_path):
+    settings = dict(folder=dict(output=tmp_path.__str__()), gzip=True)
+    # 'EN' starts 'EN-NOS', and '/' is escaped in the output.
+    ct_types = ["EN", "EN-NOS", "MCS/NOS"]
+    frames = {ct_type: pd.DataFrame(dict(genus=["Salmonella", "Escherichia"], ratio=[0.1, 0.2])) for ct_type in ct_types}
+    write_full_output(settings, ct_types=ct_types, frames=frames)
+    first = read_lines(settings)
+    assert len(first) == 6
+    write_full_output(settings, ct_types=ct_types, frames={"EN": pd.DataFrame(dict(genus=["Shigella"], ratio=[0.3]))})
+    assert read_lines(settings) == ['{"controltype":"EN","genus":"Shigella","ratio":0.3}'] + first[2:]
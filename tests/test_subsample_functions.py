@@ -0,0 +1,103 @@
+import gzip
+from pathlib import Path
+from tools.subsample_functions import count_fastq_records, subsample_pair, get_subsample_config, SubsampledInput, \
+    read_subsample_sidecar
+
+
+def write_pair(folder:Path, reads:int, gzipped:bool=False) -> tuple:
+    """
+    Writes a read pair whose mates share their read number.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    files = []
+    for mate in (1, 2):
+        lines = "".join(f"@read{ii}/{mate}\nACGT\n+\nIIII\n" for ii in range(reads))
+        if gzipped:
+            path = folder.joinpath(f"{folder.name}_R{mate}.fastq.gz")
+            with gzip.open(path.__str__(), "wt") as f:
+                f.write(lines)
+        else:
+            path = folder.joinpath(f"{folder.name}_R{mate}.fastq")
+            path.write_text(lines)
+        files.append(path)
+    return tuple(files)
+
+
+def read_names(path:Path) -> list:
+    lines = Path(path).read_text().splitlines()
+    return [line.rsplit("/", 1)[0] for line in lines[0::4]]
+
+
+def test_count_fastq_records(tmp_path):
+    pair = write_pair(tmp_path.joinpath("sample"), reads=25, gzipped=True)
+    assert count_fastq_records(pair[0]) == 25
+    # A last record without a trailing newline still counts.
+    plain = tmp_path.joinpath("plain.fastq")
+    plain.write_text("@a\nA\n+\nI\n@b\nC\n+\nI")
+    assert count_fastq_records(plain) == 2
+
+
+def test_max_reads_keeps_mates_together(tmp_path):
+    pair = write_pair(tmp_path.joinpath("sample"), reads=1000, gzipped=True)
+    out_dir = tmp_path.joinpath("out")
+    out_dir.mkdir()
+    info = subsample_pair(pair, out_dir=out_dir, sample="sample", max_reads=100, seed=1)
+    assert info['subsampled'] and info['method'] == "max_reads"
+    assert info['reads_total'] == 1000 and info['reads_used'] == 100
+    first, second = read_names(info['files'][0]), read_names(info['files'][1])
+    assert len(first) == 100 and first == second
+    assert len(set(first)) == 100
+
+
+def test_subsample_is_reproducible(tmp_path):
+    pair = write_pair(tmp_path.joinpath("sample"), reads=500)
+    picked = []
+    for run, seed in enumerate([7, 7, 8]):
+        out_dir = tmp_path.joinpath(f"out{run}")
+        out_dir.mkdir()
+        info = subsample_pair(pair, out_dir=out_dir, sample="sample", max_reads=50, seed=seed)
+        picked.append(read_names(info['files'][0]))
+    assert picked[0] == picked[1]
+    assert picked[0] != picked[2]
+
+
+def test_fraction(tmp_path):
+    pair = write_pair(tmp_path.joinpath("sample"), reads=2000)
+    out_dir = tmp_path.joinpath("out")
+    out_dir.mkdir()
+    info = subsample_pair(pair, out_dir=out_dir, sample="sample", fraction=0.25, seed=3)
+    assert info['method'] == "fraction" and info['reads_total'] == 2000
+    assert 400 < info['reads_used'] < 600
+    assert read_names(info['files'][0]) == read_names(info['files'][1])
+
+
+def test_small_sample_not_subsampled(tmp_path):
+    pair = write_pair(tmp_path.joinpath("sample"), reads=10)
+    info = subsample_pair(pair, out_dir=tmp_path, sample="sample", max_reads=100)
+    assert not info['subsampled'] and info['reads_used'] == 10
+    assert info['files'] == list(pair)
+
+
+def test_config():
+    settings = dict(subsample=dict(seed=5, kraken=dict(fraction=0.5), contains=dict(max_reads=10), matches=dict(fraction=2)))
+    assert get_subsample_config(settings, "kraken")['fraction'] == 0.5
+    assert get_subsample_config(settings, "contains") == dict(max_reads=10, fraction=None, seed=5, temp_dir=None)
+    assert get_subsample_config(settings, "matches") == None
+    assert get_subsample_config({}, "kraken") == None
+
+
+def test_subsampled_input(tmp_path):
+    folder = tmp_path.joinpath("sample")
+    write_pair(folder, reads=300)
+    tsv_file = folder.joinpath("sample_contains.tsv")
+    settings = dict(subsample=dict(temp_dir=tmp_path.__str__(), contains=dict(max_reads=30)))
+    with SubsampledInput(settings, folder=folder, mode="contains", tsv_file=tsv_file) as subsampled:
+        temp_dir = subsampled.input_folder
+        assert temp_dir != folder
+        assert [count_fastq_records(Path(item)) for item in subsampled.pair] == [30, 30]
+    assert not temp_dir.exists()
+    assert read_subsample_sidecar(tsv_file)['reads_used'] == 30
+    # Without subsampling the sidecar of an earlier run is removed.
+    with SubsampledInput({}, folder=folder, mode="contains", tsv_file=tsv_file) as subsampled:
+        assert subsampled.input_folder == folder
+    assert read_subsample_sidecar(tsv_file) == None